@@ -0,0 +1,727 @@
+#!/usr/bin/env python
+
+# Offline benchmarks for the URL shortener utilities.
+# Copyright (c) 2009-2012, Mario Vilas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice,this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Offline benchmarks for the URL shortener utilities.
+
+A local HTTP server stands in for every URL shortener service in the
+L{shorturl.api} table, the TinyURL preview pages used by L{tinyurlfs} and the
+password protected redirection chains used by L{itomxfs}. Requests are sent
+to it by setting the C{http_proxy} environment variable, so the code being
+measured is exactly the same that talks to the real services.
+
+Each scenario runs a number of operations from a pool of worker threads and
+reports the throughput and latency percentiles as JSON, so results can be
+compared across versions to catch regressions. The C{striped} scenario
+transfers files with L{tinyurlfs} spreading the blocks over all of its
+L{tinyurlfs.carriers}. The C{transfer} scenario moves the blocks through the
+L{transfer} engine into memory instead, to measure the overhead of the
+engine alone. The C{startup} scenario imports each of the
+L{startup_modules} in a new interpreter, and reports how long the import
+took and how many modules it loaded. The C{codec} scenario reads, encodes,
+scrapes and decodes single blocks of each of the L{codec_sizes} like
+L{tinyurlfs} does, also in a new interpreter, and reports the throughput
+and how many bytes were allocated for each block, measured in blocks.
+
+@type scenarios: list of str
+@var  scenarios: Names of the available benchmark scenarios.
+
+@type startup_modules: list of str
+@var  startup_modules: Modules whose import is measured by the C{startup}
+    scenario.
+
+@type codec_sizes: list of int
+@var  codec_sizes: Block sizes in bytes used by the C{codec} scenario.
+"""
+
+__all__ = ['FakeServices', 'run_scenario', 'run_benchmarks', 'scenarios']
+
+import os
+import sys
+import json
+import time
+import random
+import Queue
+import tempfile
+import subprocess
+import threading
+import urllib2
+import urlparse
+import optparse
+import BaseHTTPServer
+import SocketServer
+
+import shorturl
+import itomxfs
+import transfer
+import tinyurlfs
+
+scenarios = ['shorturl', 'longurl', 'besturl', 'hideurl',
+             'itomxfs', 'tinyurlfs', 'striped', 'transfer', 'startup',
+             'codec']
+
+# Modules imported by the startup scenario.
+startup_modules = ['shorthosts', 'shorturl']
+
+# Block sizes of the codec scenario.
+codec_sizes = [262144, 1048576, 4194304]
+
+#------------------------------------------------------------------------------
+
+class FakeServices(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server that emulates the URL shortener services.
+
+    It's meant to be used as an HTTP proxy, so it gets the full URL of each
+    request and can tell which service it was meant for.
+
+    @type latency: float
+    @ivar latency: Delay in seconds added to each response.
+
+    @type jitter: float
+    @ivar jitter: Maximum random delay in seconds added on top of C{latency}.
+
+    @type requests: int
+    @ivar requests: Number of requests served.
+    """
+
+    daemon_threads      = True
+    allow_reuse_address = True
+    request_queue_size  = 64       # the file stores connect in bursts
+
+    def __init__(self, latency = 0.0, jitter = 0.0, address = ('127.0.0.1', 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeServiceHandler)
+        self.latency  = latency
+        self.jitter   = jitter
+        self.requests = 0
+        self.links    = dict()     # short URL -> (long URL, password)
+        self.previews = dict()     # tinyurl code -> data
+        self.counter  = 0
+        self.lock     = threading.Lock()
+        self.thread   = None
+
+        # Split each API format string into the prefix before the long URL.
+        self.prefixes = list()
+        for service, fmt in shorturl.api.iteritems():
+            self.prefixes.append( (fmt.split('%s')[0], service) )
+        self.prefixes.sort(reverse = True)
+
+    def start(self):
+        """Serve requests from a background thread, and send all the HTTP
+        requests of this process to us."""
+        self.thread = threading.Thread(target = self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        os.environ['http_proxy'] = 'http://%s:%d' % self.server_address
+        urllib2.install_opener( urllib2.build_opener() )
+
+    def stop(self):
+        """Stop serving requests."""
+        self.shutdown()
+        self.server_close()
+        shorturl.connections.clear()
+        os.environ.pop('http_proxy', None)
+        urllib2.install_opener(None)
+
+    def new_code(self, length = 6):
+        with self.lock:
+            self.counter = self.counter + 1
+            number = self.counter
+        digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+        code   = ''
+        while number:
+            number, digit = divmod(number, len(digits))
+            code = digits[digit] + code
+        return code.rjust(length, '0')
+
+    def delay(self):
+        with self.lock:
+            self.requests = self.requests + 1
+        seconds = self.latency
+        if self.jitter:
+            seconds = seconds + random.uniform(0, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+class FakeServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler for L{FakeServices}.
+
+    This is a private class and you shouldn't need to use it.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    # Send each response right away like a real web server would, otherwise
+    # persistent connections stall on delayed ACKs.
+    wbufsize                = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, body = '', headers = None, content_type = 'text/html'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_form(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form   = urlparse.parse_qs(self.rfile.read(length), True)
+        return dict( (key, values[0]) for key, values in form.iteritems() )
+
+    def do_GET(self):
+        self.server.delay()
+        url  = self.path
+        host = urlparse.urlparse(url)[1].lower()
+
+        # TinyURL preview pages, with the data split in lines like the
+        # real ones to exercise the HTML scraper.
+        if host == 'preview.tinyurl.com':
+            code = urlparse.urlparse(url)[2].lstrip('/')
+            data = self.server.previews.get(code)
+            if data is None:
+                return self.reply(404, 'Not found')
+            return self.reply(200, preview_page(data))
+
+        # Shortener APIs.
+        for prefix, service in self.server.prefixes:
+            if url.startswith(prefix):
+                target = urllib2.unquote( url[ len(prefix) : ].split('&')[0] )
+                return self.shorten(service, target)
+
+        # Short URLs.
+        if url in self.server.links:
+            target, password = self.server.links[url]
+            if password:
+                return self.reply(200, '<form method="post">Password: '
+                                  '<input name="pass"></form>')
+            return self.reply(301, '', {'Location': target})
+        if host == 'ito.mx':
+            return self.reply(200, '<H3 class="error">No such URL</H3>')
+        return self.reply(404, 'Not found')
+
+    def do_POST(self):
+        self.server.delay()
+        url  = self.path
+        form = self.read_form()
+
+        # The ito.mx API used by the file store.
+        if url == 'http://ito.mx/?module=ShortURL&file=Add&mode=API':
+            short_url = 'http://ito.mx/%s' % form.get('tag', '')
+            with self.server.lock:
+                if short_url in self.server.links:
+                    return self.reply(200, '<h3>Tag already taken</h3>')
+                self.server.links[short_url] = (form.get('url', ''),
+                                                form.get('pass', ''))
+            return self.reply(200, short_url)
+
+        # The TinyURL API used by the file store.
+        if url == 'http://tinyurl.com/api-create.php':
+            return self.shorten('tinyurl.com', form.get('url', ''))
+
+        # Password protected ito.mx URLs.
+        if url in self.server.links:
+            target, password = self.server.links[url]
+            if form.get('pass', '') != password:
+                return self.reply(200, '<H3 class="error">Wrong password</H3>')
+            return self.reply(302, '', {'Location': target})
+        return self.reply(404, 'Not found')
+
+    def shorten(self, service, target):
+        if service == 'tinyurl.com':
+            code = 'y' + self.server.new_code(6)
+            self.server.previews[code] = target
+        else:
+            code = self.server.new_code(4)
+        short_url = 'http://%s/%s' % (service, code)
+        self.server.links[short_url] = (target, None)
+        self.reply(200, short_url + '\n', content_type = 'text/plain')
+
+#------------------------------------------------------------------------------
+
+def preview_page(data):
+    """
+    This is a private function and you shouldn't need to use it.
+
+    @type  data: str
+    @param data: Target URL of a TinyURL short URL.
+
+    @rtype:  str
+    @return: Preview page, with the URL split in lines like the real ones.
+    """
+    lines = [ data[ i : i + 80 ] for i in xrange(0, len(data), 80) ]
+    return ('<html><body><p>This TinyURL redirects to:</p>'
+            '<blockquote><b>\n%s\n</b></blockquote></body></html>'
+            % '<br />\n'.join(lines))
+
+def percentile(ordered, fraction):
+    """
+    @type  ordered: list of float
+    @param ordered: Sorted samples.
+
+    @type  fraction: float
+    @param fraction: Percentile between C{0.0} and C{1.0}.
+
+    @rtype:  float
+    @return: Sample at the given percentile, or C{None} if there are none.
+    """
+    if not ordered:
+        return None
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+def run_pool(operations, concurrency):
+    """Run the given callables from a pool of worker threads.
+
+    This is a private function and you shouldn't need to use it.
+
+    @rtype:  tuple(float, list of float, list of str)
+    @return: Total elapsed time, the latency of each successful operation,
+        and the error message of each failed one.
+    """
+    work      = Queue.Queue()
+    latencies = list()
+    errors    = list()
+    lock      = threading.Lock()
+    for operation in operations:
+        work.put(operation)
+
+    def worker():
+        while 1:
+            try:
+                operation = work.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            try:
+                operation()
+            except Exception, e:
+                with lock:
+                    errors.append('%s: %s' % (e.__class__.__name__, e))
+            else:
+                elapsed = time.time() - start
+                with lock:
+                    latencies.append(elapsed)
+
+    threads = [ threading.Thread(target = worker) for i in xrange(concurrency) ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start, latencies, errors
+
+def run_scenario(name, count = 100, concurrency = 1, file_size = 65536):
+    """Run a single benchmark scenario against the fake services.
+
+    The fake services must be already running, see L{FakeServices}.
+
+    @type  name: str
+    @param name: Scenario name, see L{scenarios}.
+
+    @type  count: int
+    @param count: Number of operations to run. For the file stores, each
+        operation is a full upload and download of a file.
+
+    @type  concurrency: int
+    @param concurrency: Number of worker threads.
+
+    @type  file_size: int
+    @param file_size: Size in bytes of the files used by the file stores.
+
+    @rtype:  dict
+    @return: Scenario results.
+    """
+    cleanup = list()
+    tag     = '%x' % random.getrandbits(32)
+
+    if name == 'shorturl':
+        operations = [ (lambda i = i: shorturl.shorturl(
+                        'http://www.example.com/%s/%d' % (tag, i), 'tinyurl.com'))
+                       for i in xrange(count) ]
+    elif name == 'longurl':
+        short_urls = [ shorturl.shorturl('http://www.example.com/%s/%d' % (tag, i),
+                                         'tinyurl.com')
+                       for i in xrange(count) ]
+        operations = [ (lambda u = u: shorturl.longurl(u)) for u in short_urls ]
+    elif name == 'besturl':
+        operations = [ (lambda i = i: shorturl.besturl(
+                        'http://www.example.com/%s/%d' % (tag, i)))
+                       for i in xrange(count) ]
+    elif name == 'hideurl':
+        operations = [ (lambda i = i: shorturl.hideurl(
+                        'http://www.example.com/%s/%d' % (tag, i), 3))
+                       for i in xrange(count) ]
+    elif name in ('itomxfs', 'tinyurlfs', 'striped'):
+        operations = list()
+        for i in xrange(count):
+            fd, original = tempfile.mkstemp(prefix = 'bench-%s-%d-' % (tag, i))
+            os.write(fd, os.urandom(file_size))
+            os.close(fd)
+            cleanup.append(original)
+            if name == 'itomxfs':
+                operations.append(lambda original = original:
+                                  transfer_itomxfs(original))
+            elif name == 'tinyurlfs':
+                operations.append(lambda original = original:
+                                  transfer_tinyurlfs(original, cleanup))
+            else:
+                operations.append(lambda original = original:
+                                  transfer_tinyurlfs(original, cleanup,
+                                                     tinyurlfs.carriers))
+    elif name == 'startup':
+        imports    = dict( (module, list()) for module in startup_modules )
+        operations = [ (lambda module = module:
+                        imports[module].append( measure_import(module) ))
+                       for module in ( startup_modules[i % len(startup_modules)]
+                                       for i in xrange(count) ) ]
+    elif name == 'codec':
+        codecs     = dict( (size, list()) for size in codec_sizes )
+        operations = [ (lambda size = size:
+                        codecs[size].append( measure_codec(size) ))
+                       for size in ( codec_sizes[i % len(codec_sizes)]
+                                     for i in xrange(count) ) ]
+    elif name == 'transfer':
+        backend    = transfer.MemoryBackend(tinyurlfs.block_size)
+        data       = os.urandom(file_size)
+        operations = [ (lambda: transfer_memory(backend, data))
+                       for i in xrange(count) ]
+    else:
+        raise ValueError, "Unknown scenario: %s" % name
+
+    try:
+        elapsed, latencies, errors = run_pool(operations, concurrency)
+    finally:
+        for filename in cleanup:
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+    latencies.sort()
+    result = {
+        'scenario':    name,
+        'operations':  count,
+        'concurrency': concurrency,
+        'errors':      len(errors),
+        'seconds':     elapsed,
+        'throughput':  (len(latencies) / elapsed) if elapsed else None,
+        'latency': {
+            'min':  percentile(latencies, 0.0),
+            'p50':  percentile(latencies, 0.5),
+            'p90':  percentile(latencies, 0.9),
+            'p99':  percentile(latencies, 0.99),
+            'max':  percentile(latencies, 1.0),
+        },
+    }
+    if name in ('itomxfs', 'tinyurlfs', 'striped', 'transfer'):
+        result['file_size'] = file_size
+        result['bytes_per_second'] = (
+            (2.0 * file_size * len(latencies) / elapsed) if elapsed else None)
+    if name == 'startup':
+        result['imports'] = dict()
+        for module, samples in imports.iteritems():
+            seconds = sorted( sample[0] for sample in samples )
+            result['imports'][module] = {
+                'p50':     percentile(seconds, 0.5),
+                'p90':     percentile(seconds, 0.9),
+                'modules': max( [ sample[1] for sample in samples ] or [None] ),
+            }
+    if name == 'codec':
+        result['codec'] = dict()
+        for size, samples in codecs.iteritems():
+            encode = sorted( sample[0] for sample in samples )
+            decode = sorted( sample[1] for sample in samples )
+            result['codec'][size] = {
+                'encode_bytes_per_second': percentile(encode, 0.5),
+                'decode_bytes_per_second': percentile(decode, 0.5),
+                'encode_allocated_blocks': max( [ sample[2] for sample in samples ] or [None] ),
+                'decode_allocated_blocks': max( [ sample[3] for sample in samples ] or [None] ),
+            }
+    if errors:
+        result['first_error'] = errors[0]
+    return result
+
+def transfer_itomxfs(original):
+    """Upload and download a file with L{itomxfs} and compare the result.
+
+    This is a private function and you shouldn't need to use it.
+    """
+    url = itomxfs.upload(original, 'password')
+    filename, data = itomxfs.download(url, 'password')
+    if data != open(original, 'rb').read():
+        raise RuntimeError, "Downloaded data doesn't match"
+
+def transfer_tinyurlfs(original, cleanup, services = None):
+    """Upload and download a file with L{tinyurlfs} and compare the result.
+
+    This is a private function and you shouldn't need to use it.
+    """
+    encoded    = original + '.txt'
+    downloaded = original + '.out'
+    cleanup.extend( [encoded, downloaded] )
+    tinyurlfs.upload(original, encoded, services = services)
+    tinyurlfs.download(encoded, downloaded)
+    if open(downloaded, 'rb').read() != open(original, 'rb').read():
+        raise RuntimeError, "Downloaded data doesn't match"
+
+def measure_import(module):
+    """Import a module in a new interpreter.
+
+    This is a private function and you shouldn't need to use it.
+
+    @rtype:  tuple(float, int)
+    @return: Seconds spent importing the module, and number of modules
+        loaded by the import.
+    """
+    script = ('import sys, time\n'
+              'before = len(sys.modules)\n'
+              'start = time.time()\n'
+              'import %s\n'
+              'print time.time() - start, len(sys.modules) - before\n'
+              % module)
+    process = subprocess.Popen( [sys.executable, '-c', script],
+                        stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                        cwd = os.path.dirname(os.path.abspath(__file__)) )
+    output, error = process.communicate()
+    if process.returncode:
+        raise RuntimeError, error.strip().splitlines()[-1]
+    seconds, modules = output.split()
+    return float(seconds), int(modules)
+
+def measure_codec(size, count = 4):
+    """Encode and decode some blocks in a new interpreter, see L{run_codec}.
+
+    This is a private function and you shouldn't need to use it.
+
+    @rtype:  tuple(float, float, float, float)
+    @return: Encoding and decoding throughput in bytes per second, and
+        bytes allocated to encode and to decode each block, in blocks.
+    """
+    script = ('import sys, benchmark\n'
+              'benchmark.run_codec(int(sys.argv[1]), int(sys.argv[2]))\n')
+
+    # Make glibc map every large allocation on its own and give it back as
+    # soon as it's freed, so each one shows up in the page faults instead
+    # of reusing the memory of the previous block.
+    environ = dict(os.environ)
+    environ['MALLOC_MMAP_THRESHOLD_'] = '65536'
+    process = subprocess.Popen( [sys.executable, '-c', script,
+                                 str(size), str(count)],
+                        stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                        cwd = os.path.dirname(os.path.abspath(__file__)),
+                        env = environ )
+    output, error = process.communicate()
+    if process.returncode:
+        raise RuntimeError, error.strip().splitlines()[-1]
+    return tuple( float(value) for value in output.split() )
+
+def run_codec(size, count):
+    """Read some blocks of random data from a file, and encode, scrape from
+    a preview page and decode each one like L{tinyurlfs} does. Prints the
+    encoding and decoding throughput, and how many bytes were allocated on
+    average to encode and to decode each block, measured in blocks.
+
+    Python 2 can't trace allocations, so they're counted with the minor
+    page faults instead: a new buffer faults once for each page written
+    to. This is only accurate when glibc maps each large allocation on its
+    own, see L{measure_codec}. Building the preview page isn't counted.
+
+    This is a private function and you shouldn't need to use it.
+    """
+
+    # Only available on Unix, so it's imported here.
+    import resource
+
+    def faults():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+
+    fd, original = tempfile.mkstemp(prefix = 'bench-codec-')
+    try:
+        for i in xrange(0, size * count, 65536):
+            os.write(fd, os.urandom(min(65536, size * count - i)))
+        os.close(fd)
+        backend  = transfer.Backend()
+        encoding = 0.0
+        decoding = 0.0
+        encoded  = 0
+        decoded  = 0
+        with open(original, 'rb') as infile:
+            blocks = transfer.read_buffers(infile, size, 1)
+            while 1:
+                before = faults()
+                start  = time.time()
+                block  = next(blocks, None)
+                if block is None:
+                    break
+                text   = backend.encode(block)
+                encoding = encoding + time.time() - start
+                encoded  = encoded + faults() - before
+                page   = preview_page(text)
+                del text
+                before = faults()
+                start  = time.time()
+                data   = backend.decode(tinyurlfs.scrape_block(page, original))
+                decoding = decoding + time.time() - start
+                decoded  = decoded + faults() - before
+                del page
+                if tinyurlfs.block_checksum(data) != \
+                                tinyurlfs.block_checksum(block):
+                    raise RuntimeError, "Decoded data doesn't match"
+                del data
+    finally:
+        os.unlink(original)
+    pages = float(resource.getpagesize()) / (size * count)
+    print size * count / encoding, size * count / decoding, \
+          encoded * pages, decoded * pages
+
+def transfer_memory(backend, data):
+    """Store and read back some data with the L{transfer} engine and compare
+    the result.
+
+    This is a private function and you shouldn't need to use it.
+    """
+    size   = backend.block_size
+    blocks = ( data[ i : i + size ] for i in xrange(0, len(data), size) )
+    references = [ reference for block, reference, elapsed
+                   in transfer.put_blocks(backend, blocks) ]
+    if ''.join( block for block, elapsed
+                in transfer.get_blocks(backend, references) ) != data:
+        raise RuntimeError, "Read back data doesn't match"
+
+def run_benchmarks(names = None, count = 100, concurrency = 1, latency = 0.0,
+                   jitter = 0.0, file_size = 65536):
+    """Start the fake services and run the benchmark scenarios.
+
+    @type  names: list of str
+    @param names: Scenarios to run. Defaults to all of them.
+
+    @type  count: int
+    @param count: Number of operations per scenario.
+
+    @type  concurrency: int
+    @param concurrency: Number of worker threads.
+
+    @type  latency: float
+    @param latency: Delay in seconds injected in each response.
+
+    @type  jitter: float
+    @param jitter: Maximum random delay in seconds added to C{latency}.
+
+    @type  file_size: int
+    @param file_size: Size in bytes of the files used by the file stores.
+
+    @rtype:  dict
+    @return: Configuration and results of each scenario.
+    """
+    if not names:
+        names = scenarios
+    server = FakeServices(latency, jitter)
+    server.start()
+    try:
+        results = list()
+        for name in names:
+            shorturl.health = shorturl.HealthRegistry()
+            shorturl.chains.clear()
+            results.append( run_scenario(name, count, concurrency, file_size) )
+    finally:
+        server.stop()
+    return {
+        'config': {
+            'count':       count,
+            'concurrency': concurrency,
+            'latency':     latency,
+            'jitter':      jitter,
+            'file_size':   file_size,
+            'python':      sys.version.split()[0],
+            'timestamp':   time.time(),
+        },
+        'results': results,
+    }
+
+#------------------------------------------------------------------------------
+
+def main(argv):
+    """Called internally when the module is used like a command line script.
+
+    This is a private function and you shouldn't need to use it.
+    """
+    usage  = "%prog [options] [scenarios...]"
+    parser = optparse.OptionParser(usage = usage,
+        epilog = "Available scenarios: %s" % ', '.join(scenarios))
+    parser.add_option("-n", "--count", type="int", metavar="N",
+                      help="operations per scenario [default: %default]")
+    parser.add_option("-c", "--concurrency", type="int", metavar="THREADS",
+                      help="number of worker threads [default: %default]")
+    parser.add_option("-l", "--latency", type="float", metavar="SECONDS",
+                      help="delay injected in each response [default: %default]")
+    parser.add_option("-j", "--jitter", type="float", metavar="SECONDS",
+                      help="random delay added to the latency [default: %default]")
+    parser.add_option("-s", "--file-size", type="int", metavar="BYTES",
+                      help="file size for the file stores [default: %default]")
+    parser.add_option("-b", "--block-size", type="int", metavar="BYTES",
+                      help="TinyURL file store block size [default: %default]")
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help="write the results to this file [default: stdout]")
+    parser.add_option("-k", "--keepalive", action="store_true",
+                      help="reuse HTTP connections between requests")
+    parser.set_defaults(
+        count       = 100,
+        concurrency = 4,
+        latency     = 0.0,
+        jitter      = 0.0,
+        file_size   = 65536,
+        block_size  = 16384,
+    )
+    (options, arguments) = parser.parse_args(argv)
+    names = arguments[1:]
+    for name in names:
+        if name not in scenarios:
+            parser.error("unknown scenario: %s" % name)
+
+    # Don't pause between requests, we want to measure our own overhead.
+    itomxfs.pause        = 0
+    tinyurlfs.block_size = options.block_size
+    shorturl.keepalive   = bool(options.keepalive)
+
+    report = run_benchmarks(names, options.count, options.concurrency,
+                            options.latency, options.jitter, options.file_size)
+    text = json.dumps(report, indent = 1, sort_keys = True)
+    if options.output:
+        with open(options.output, 'w') as fd:
+            fd.write(text + '\n')
+    else:
+        print text
+
+# Run the main() function when loaded as a command line script.
+if __name__ == '__main__':
+    main(sys.argv)
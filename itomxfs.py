@@ -46,72 +46,84 @@
     consume too much bandwidth.
     This is a private variable and you shouldn't need to use it.
 
-@type max_tries: int
-@var  max_tries: Number of retries when trying to create a shortened URL and
-    it already exists.
-    This is a private variable and you shouldn't need to use it.
+@type timeout: float
+@var  timeout: Timeout in seconds for each HTTP request. The C{deadline}
+    argument of L{upload} and L{download} limits the time spent by the whole
+    transfer instead.
 
 @type verbose: bool
 @var  verbose: Global verbose flag. Set to C{True} to print debug messages, or
     C{False} for the default behavior (don't print anything).
     This is a private variable and you shouldn't need to use it.
+
+The global variables above are only the defaults, see L{Settings}.
 """
 
-__all__ = ['upload', 'download']
+__all__ = ['upload', 'download', 'Settings', 'ItoMxBackend']
 
+import sys
 import zlib
-import time
 import random
 import urllib2
 from os import path
+from shorturl import as_deadline, read_response, Progress
+import shorturl
+import transfer
 
 nonce_size  = 2             # size in bytes of the random nonce, before encoding
 tag_size    = 128           # size in bytes of each data chunk, before encoding
 pause       = 0.5           # pause between HTTP requests
-max_tries   = 3             # number of retries in case of error
+timeout     = 10            # 10 seconds timeout for HTTP requests
 verbose     = False         # set to true to print debug messages
 
-def add_url(url, tag, password):
-    """Adds a new shortened URL to the ito.mx database.
+class Settings(object):
+    """Settings of the file store for a transfer, used like
+    L{tinyurlfs.Settings}.
 
-    This is a private function and you shouldn't need to use it.
+    The settings not given are copied from the global variables of this
+    module when the object is created.
 
-    @type  url: str
-    @param url: Target of the shortened URL. It must be a valid URL but not
-        necessarily point to an existent resource. The ito.mx service also
-        lets you create shortened URLs to other shortened URLs.
+    @type tag_size: int
+    @ivar tag_size: Size in bytes of each chunk of data, see L{tag_size}.
 
-    @type  tag: str
-    @param tag: Desired URL tag. If the URL was already taken the call fails.
+    @type pause: float
+    @ivar pause: Time to wait between requests.
 
-    @type  password: str
-    @param password: Password to protect the target of the shortened URL.
+    @type timeout: float
+    @ivar timeout: Timeout in seconds for each HTTP request.
 
-    @rtype:  str
-    @return: Shortened URL.
+    @type verbose: bool
+    @ivar verbose: C{True} to print debug messages.
 
-    @raise RuntimeError: An error occured while trying to shorten the URL.
-    @raise urllib2.HTTPError: A network error occured while accessing the URL
-        shortener service.
+    @type client: L{shorturl.Client}
+    @ivar client: Client used for the requests.
     """
-    global verbose
-    url      = urllib2.quote(url)
-    tag      = urllib2.quote(tag)
-    password = urllib2.quote(password)
-    request  = 'pass=%(password)s&tag=%(tag)s&url=%(url)s' % vars()
-    response = urllib2.urlopen('http://ito.mx/?module=ShortURL&file=Add&mode=API', request)
-    headers  = response.info()
-    url      = response.read()
-    if headers.get('Content-Type', None) == 'application/x-www-form-urlencoded':
-        url = urllib2.unquote(url)
-    url = url.strip()
-    if not url.startswith('http://ito.mx/'):
-        url = url.replace('<h3>', '')
-        url = url.replace('</h3>', '')
-        raise RuntimeError, "Failed to create new URL, reason: %s" % url
-    if verbose:
-        print "Created: %s" % url
-    return url
+
+    def __init__(self, tag_size = None, pause = None, timeout = None,
+                 verbose = None, client = None):
+        """
+        @type  client: L{shorturl.Client}
+        @param client: Client used for the requests. Defaults to
+            L{shorturl.default_client}.
+
+        @see: The global variables of this module for the other settings.
+        """
+        defaults = globals()
+        if tag_size is None:
+            tag_size = defaults['tag_size']
+        if pause is None:
+            pause = defaults['pause']
+        if timeout is None:
+            timeout = defaults['timeout']
+        if verbose is None:
+            verbose = defaults['verbose']
+        if client is None:
+            client = shorturl.default_client
+        self.tag_size = tag_size
+        self.pause    = pause
+        self.timeout  = timeout
+        self.verbose  = verbose
+        self.client   = client
 
 def calc_nonce():
     """Returns a randomly generated nonce.
@@ -158,7 +170,149 @@ def decompress(data):
     """
     return zlib.decompress(data)
 
-def upload(filename, password):
+class ItoMxBackend(transfer.Backend):
+    """Stores blocks in the tags of ito.mx short URLs.
+
+    Each short URL is password protected and redirects to the short URL of
+    the next block, so the blocks form a chain. The data is in the tag
+    itself, after a random nonce, and reading a block is just a matter of
+    following it to find the next one.
+
+    The settings not given are taken from the L{Settings}.
+
+    @type password: str
+    @ivar password: Password that protects the short URLs.
+
+    @type pause: float
+    @ivar pause: Time to wait before each request.
+
+    @type timeout: float
+    @ivar timeout: Timeout in seconds for each HTTP request.
+    """
+
+    name    = 'ito.mx'
+    chained = True
+    workers = 1
+
+    def __init__(self, password, tag_size = None, pause = None,
+                 timeout = None, verbose = None, client = None,
+                 settings = None):
+        if settings is None:
+            settings = Settings()
+        if tag_size is None:
+            tag_size = settings.tag_size
+        if pause is None:
+            pause = settings.pause
+        if timeout is None:
+            timeout = settings.timeout
+        if verbose is None:
+            verbose = settings.verbose
+        if client is None:
+            client = settings.client
+        transfer.Backend.__init__(self, client)
+        self.password   = password
+        self.block_size = tag_size // 2
+        self.pause      = pause
+        self.timeout    = timeout
+        self.verbose    = verbose
+
+    def decode(self, text):
+        try:
+            return transfer.Backend.decode(self, text)
+        except TypeError:
+            raise RuntimeError, "Broken chain! Bad tag: %s" % text
+
+    def put_block(self, text, deadline, stage, link = None):
+
+        # Use a new nonce on each try, in case the last one collided.
+        with transfer.tracer.span('pause'):
+            deadline.sleep(self.pause, stage)
+        nonce = calc_nonce().encode('hex')
+        return self.add_url(link, '%s-%s' % (nonce, text), deadline, stage)
+
+    def get_block(self, reference, deadline, stage):
+        nonce, tag = split_url(reference)
+        if self.verbose:
+            print "Reading: %s" % reference
+        response = self.client.open_url(reference,
+                                        'pass=%s' % urllib2.quote(self.password),
+                                        deadline, stage, limit = self.timeout)
+        response.close()
+        return tag, response.geturl()
+
+    def add_url(self, url, tag, deadline = None, stage = 'creating a URL'):
+        """Adds a new shortened URL to the ito.mx database.
+
+        This is a private method and you shouldn't need to use it.
+
+        @type  url: str
+        @param url: Target of the shortened URL. It must be a valid URL but
+            not necessarily point to an existent resource. The ito.mx service
+            also lets you create shortened URLs to other shortened URLs.
+
+        @type  tag: str
+        @param tag: Desired URL tag. If the URL was already taken the call
+            fails.
+
+        @type  deadline: L{shorturl.Deadline}
+        @param deadline: Time budget for the whole transfer, or C{None}.
+
+        @type  stage: str
+        @param stage: Description of the step of the transfer, for timeout
+            errors.
+
+        @rtype:  str
+        @return: Shortened URL.
+
+        @raise RuntimeError: An error occured while trying to shorten the URL.
+        @raise shorturl.DeadlineExceeded: The deadline expired.
+        @raise urllib2.HTTPError: A network error occured while accessing the
+            URL shortener service.
+        """
+        url      = urllib2.quote(url)
+        tag      = urllib2.quote(tag)
+        password = urllib2.quote(self.password)
+        request  = 'pass=%(password)s&tag=%(tag)s&url=%(url)s' % vars()
+        response = self.client.open_url(
+                        'http://ito.mx/?module=ShortURL&file=Add&mode=API',
+                        request, deadline, stage, limit = self.timeout)
+        headers  = response.info()
+        url      = read_response(response, deadline, stage, self.timeout)
+        if headers.get('Content-Type', None) == 'application/x-www-form-urlencoded':
+            url = urllib2.unquote(url)
+        url = url.strip()
+        if not url.startswith('http://ito.mx/'):
+            url = url.replace('<h3>', '')
+            url = url.replace('</h3>', '')
+            raise RuntimeError, "Failed to create new URL, reason: %s" % url
+        if self.verbose:
+            print "Created: %s" % url
+        return url
+
+def split_url(url):
+    """Split an ito.mx URL created by L{upload} into its nonce and tag.
+
+    This is a private function and you shouldn't need to use it.
+
+    @type  url: str
+    @param url: Short URL.
+
+    @rtype:  tuple(str, str)
+    @return: Nonce and hex encoded tag. The nonce of the header starts with
+        C{p}, or C{z} if the data is compressed.
+
+    @raise RuntimeError: The URL wasn't created by L{upload}.
+    """
+    if not url.startswith('http://ito.mx/'):
+        raise RuntimeError, "Broken chain! Bad URL: %s" % url
+    url_path = url[14:]
+    p = url_path.find('-')
+    if p < 1:
+        raise RuntimeError, "Broken chain! Bad tag: %s" % url
+    return url_path[ : p ], url_path[ p + 1 : ]
+
+def upload(filename, password, deadline = None, progress = None,
+           settings = None):
     """Upload a file and write the encoded version.
 
     The file can be downloaded passing the encoded file to the L{download}
@@ -170,20 +324,37 @@ def upload(filename, password):
     @type  password: str
     @param password: Password to protect the uploaded file.
 
+    @type  deadline: L{shorturl.Deadline} or float
+    @param deadline: Time limit in seconds for the whole upload, or C{None}
+        to only apply the per-request L{timeout}.
+
+    @type  progress: L{shorturl.Progress}
+    @param progress: Progress reporter, or C{None}. The size is measured
+        after compression.
+
+    @type  settings: L{Settings}
+    @param settings: Settings of the transfer, or C{None} for the defaults
+        taken from the global variables of this module.
+
     @raise RuntimeError: An error occured while trying to upload the file.
+    @raise shorturl.DeadlineExceeded: The deadline expired.
     @raise urllib2.HTTPError: A network error occured while accessing the URL
         shortener service.
     """
-    global tag_size
-    global pause
-    global max_tries
-    global verbose
-
-    data = open(filename, 'rb').read()
-    data, zipped = compress(data)
-    data = data.encode('hex')
-    data = [ data[ i : i + tag_size ] for i in xrange(0, len(data), tag_size) ]
-    data.reverse()
+    deadline = as_deadline(deadline)
+    backend  = ItoMxBackend(password, settings = settings)
+    with transfer.tracer.span('read'):
+        data = open(filename, 'rb').read()
+    with transfer.tracer.span('compress', size = len(data)):
+        data, zipped = compress(data)
+    size = backend.block_size
+    data = [ buffer(data, i, size) for i in xrange(0, len(data), size) ]
+    if progress is not None:
+        if progress.total is None:
+            progress.total = sum( len(block) for block in data )
+        if progress.total_blocks is None:
+            progress.total_blocks = len(data)
+        progress.start()
 
     hex_filename = path.split(filename)[1].encode('hex')
     first_nonce  = calc_nonce().encode('hex')
@@ -192,34 +363,38 @@ def upload(filename, password):
     else:
         tag_filename = 'p%s-%s' % (first_nonce, hex_filename)
     url = 'http://ito.mx/%s' % tag_filename
-    if verbose:
+    if backend.verbose:
         print "Uploading: %s" % url
     try:
-        temp = urllib2.urlopen(url).read()
+        stage = "checking %s" % url
+        temp  = transfer.call(backend, 'check',
+                              lambda: read_response(
+                                backend.client.open_url(url, None, deadline,
+                                                        stage,
+                                                        limit = backend.timeout),
+                                deadline, stage, backend.timeout),
+                              deadline, stage)
         if not '<H3 class="error">' in temp:
             raise RuntimeError, "URL already exists: %s" % url
         del temp
     except urllib2.HTTPError:
         pass
 
-    for tag in data:
-        tries = 0
-        while 1:
-            try:
-                time.sleep(pause)
-                nonce = calc_nonce().encode('hex')
-                url   = add_url(url, '%s-%s' % (nonce, tag), password)
-                break
-            except urllib2.HTTPError, e:
-                if verbose:
-                    print "Error: %s" % str(e)
-                tries += 1
-                if tries > max_tries:
-                    raise
-    url = add_url(url, tag_filename, password)
+    # The last block links back to the header, which links to the first.
+    for block, url, elapsed in transfer.put_chain(backend, data, deadline, url):
+        if progress is not None:
+            progress.update(len(block), elapsed)
+    stage = "uploading the header"
+    url   = transfer.call(backend, 'upload',
+                          lambda: backend.add_url(url, tag_filename, deadline,
+                                                  stage),
+                          deadline, stage)
+    if progress is not None:
+        progress.finish()
     return url
 
-def download(url, password):
+def download(url, password, deadline = None, progress = None,
+             settings = None):
     """Download a file uploaded with L{upload}.
 
     @type  url: str
@@ -229,36 +404,33 @@ def download(url, password):
     @type  password: str
     @param password: Password used to protect the file.
 
+    @type  deadline: L{shorturl.Deadline} or float
+    @param deadline: Time limit in seconds for the whole download, or C{None}
+        to only apply the per-request L{timeout}.
+
+    @type  progress: L{shorturl.Progress}
+    @param progress: Progress reporter, or C{None}. The total size is not
+        known until the whole chain is read.
+
+    @type  settings: L{Settings}
+    @param settings: Settings of the transfer, or C{None} for the defaults
+        taken from the global variables of this module.
+
     @rtype:  tuple(str, str)
     @return: The name and contents of the downloaded file.
 
     @raise RuntimeError: An error occured while trying to download the file.
+    @raise shorturl.DeadlineExceeded: The deadline expired.
     @raise urllib2.HTTPError: A network error occured while accessing the URL
         shortener service.
     """
-    global pause
-    global max_tries
-    global verbose
-
-    ordered = list()
-    visited = set()
-    first   = None
-    zipped  = None
-    while 1:
-        if not url.startswith('http://ito.mx/'):
-            raise RuntimeError, "Broken chain! Bad URL: %s" % url
-        url_path = url[14:]
-        p = url_path.find('-')
-        if p < 1:
-            raise RuntimeError, "Broken chain! Bad tag: %s" % url
-        nonce = url_path[ : p ]
-        tag   = url_path[ p + 1 : ]
-        try:
-            tag = tag.decode('hex')
-        except Exception:
-            raise RuntimeError, "Broken chain! Bad tag: %s" % url
-        if tag in visited:
-            break
+    deadline = as_deadline(deadline)
+    backend  = ItoMxBackend(password, settings = settings)
+    ordered  = list()
+    first    = None
+    zipped   = None
+    for reference, tag, elapsed in transfer.get_chain(backend, url, deadline):
+        nonce, encoded = split_url(reference)
         is_p = nonce.startswith('p')
         is_z = nonce.startswith('z')
         if is_p or is_z:
@@ -266,16 +438,15 @@ def download(url, password):
                 raise RuntimeError, "Broken chain! Duplicate headers found"
             first  = len(ordered)
             zipped = is_z
-        visited.add(tag)
         ordered.append(tag)
-        if verbose:
-            print "Reading: %s" % url
-        response = urllib2.urlopen(url, 'pass=%s' % password)
-        url = response.geturl()
+        if progress is not None:
+            progress.update(len(tag), elapsed)
     if first is None:
         raise RuntimeError, "Broken chain! No header found"
+    if progress is not None:
+        progress.finish()
 
-    if verbose:
+    if backend.verbose:
         print "Merging %d parts" % (len(ordered) - 1)
     filename = ordered[first]
     if first == 0:
@@ -287,7 +458,8 @@ def download(url, password):
         del ordered
     merged = ''.join(merged)
     if zipped:
-        merged = decompress(merged)
+        with transfer.tracer.span('decompress', size = len(merged)):
+            merged = decompress(merged)
     return filename, merged
 
 def main(argv):
@@ -299,24 +471,44 @@ def main(argv):
     @param argv: Command line arguments.
     """
     global verbose
+    progress = None
+    profile  = None
+    for option in ('--progress', '--progress=line', '--progress=json'):
+        if option in argv:
+            argv = [ arg for arg in argv if arg != option ]
+            progress = Progress(output = option[11:] or 'line')
+            verbose  = False
+    for option in argv:
+        if option == '--profile' or option.startswith('--profile='):
+            argv    = [ arg for arg in argv if arg != option ]
+            profile = option[10:]
     if '--help' in argv or '-h' in argv or len(argv) != 4 or argv[1].lower() not in ('upload', 'download'):
         print "Ito.mx file uploading and downloading"
         print "by Mario Vilas (mvilas at gmail dot com)"
         print
-        print "%s upload <filename> <password>" % argv[0]
-        print "%s download <url> <password>" % argv[0]
+        print "%s [--progress[=json]] [--profile[=trace.json]] upload <filename> <password>" % argv[0]
+        print "%s [--progress[=json]] [--profile[=trace.json]] download <url> <password>" % argv[0]
         return
-    _, command, target, password = argv
-    command = command.lower()
-    if command == 'download':
-        filename, data = download(target, password)
-        if verbose:
-            print "Writing: %s" % filename
-        open(filename, 'w+b').write(data)
-    else:
-        url = upload(target, password)
-        if not verbose:
-            print url
+    if profile is not None:
+        transfer.tracer = transfer.Tracer()
+    try:
+        _, command, target, password = argv
+        command = command.lower()
+        if command == 'download':
+            filename, data = download(target, password, progress = progress)
+            if verbose:
+                print "Writing: %s" % filename
+            with transfer.tracer.span('write'):
+                open(filename, 'w+b').write(data)
+        else:
+            url = upload(target, password, progress = progress)
+            if not verbose:
+                print url
+    finally:
+        if profile is not None:
+            print >> sys.stderr, transfer.tracer.format_summary()
+            if profile:
+                transfer.tracer.save(profile)
 
 # Run the main() function when invoked from the command line.
 if __name__ == "__main__":
@@ -340,5 +532,3 @@ if __name__ == "__main__":
 #   * Configurable block size.
 #   * Configurable pause between requests.
 #   * Resume an upload or a download.
-#
-# * Measure the speed of the trasfers.
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+# Supported URL shortener services and URL classification.
+# Copyright (c) 2009-2012, Mario Vilas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice,this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Supported URL shortener services and URL classification.
+
+This module only has the table of services and the functions that tell short
+URLs apart, without any networking code, so it's cheap to import in
+processes that only need to classify URLs, like log parsers. Everything here
+is also available from L{shorturl}, which loads the HTTP stack.
+
+@type shorteners: set of str
+@var  shorteners: Supported URL shortener services.
+    See the sources for the full list.
+
+@type api: dict of str
+@var  api: URL shortener API format strings.
+    This is a private variable and you shouldn't need to use it.
+"""
+
+__all__ = ['shorteners', 'is_short_url', 'url_host']
+
+import re
+
+#------------------------------------------------------------------------------
+
+# Currently supported URL shortener services.
+# All of them issue an HTTP GET request and expect a simple text response.
+api = {
+    'is.gd'         :   'http://is.gd/api.php?longurl=%s',
+    'ito.mx'        :   'http://ito.mx/?module=ShortURL&file=Add&mode=API&url=%s',
+    'migre.me'      :   'http://migre.me/api.txt?url=%s',
+    'ta.gd'         :   'http://tinyarro.ws/api-create.php?host=ta.gd&suggest=_nounicode&utfpure=1&url=%s',
+    'tinyurl.com'   :   'http://tinyurl.com/api-create.php?url=%s',
+    'x90.es'        :   'http://x90.es/api.php?action=shorturl&format=simple&url=%s',
+    'xrl.us'        :   'http://metamark.net/api/rest/simple?long_url=%s',
+
+#------------------------------------#
+# Unsupported URL shortener services #
+#------------------------------------#
+
+# These used to work when this library was first published, but have since
+# either changed or deprecated their public APIs or made them authenticated.
+#'    bit.ly'        :   'http://bit.ly/api?url=%s',
+#    'cli.gs'        :   'http://cli.gs/api/v1/cligs/create?appid=urlshorten.py&url=%s',
+#    'cru.ms'        :   'http://cru.ms/?module=ShortURL&file=Add&mode=API&url=%s',
+
+# These used to work when this library was first published, but no longer exist.
+#    'easyuri.com'   :   'http://easyuri.com/api.php?link=%s',
+#    'kl.am'         :   'http://kl.am/api/shorten/?url=%s&format=text',
+#    'onodot.com'    :   'http://onodot.com/api.php?url=%s',
+#    'shrten.com'    :   'http://shrten.com/api?url=%s',
+#    'www.thisurl.com':  'http://www.thisurl.com/?module=ShortURL&file=Add&mode=API&url=%s',
+#    'www.piurl.com' :   'http://www.piurl.com/api.php?url=%s',
+#    'pra.im'        :   'http://pra.im/api.php?url=%s',
+#    'snick.me'      :   'http://snick.me/api/create.text?url=%s',
+#    'thurly.net'    :   'http://thurly.net/api.php?id=%s',
+#    'tr.im'         :   'http://api.tr.im/v1/trim_simple?url=%s',
+#    'u.nu'          :   'http://u.nu/unu-api-simple?url=%s',
+#    'urlz.at'       :   'http://urlz.at/yourls-api.php?action=shorturl&format=simple&url=%s',
+#    'zi.ma'         :   'http://zi.ma/?module=ShortURL&file=Add&mode=API&url=%s',
+
+}
+
+# Exported the service names only and keep the API strings private.
+shorteners = set( api.keys() )
+
+#------------------------------------------------------------------------------
+
+# Scheme and network location of a URL, split like urlparse does.
+host_pattern = re.compile(r'^(?:[a-zA-Z0-9+.-]+:)?//([^/?#]*)')
+
+def url_host(url):
+    """Get the network location of a URL, in lowercase.
+
+    This gives the same result as C{urlparse.urlparse(url)[1].lower()},
+    without having to import L{urlparse}.
+
+    >>> url_host('http://X90.es/5CA')
+    'x90.es'
+
+    @type  url: str
+    @param url: URL to parse.
+
+    @rtype:  str
+    @return: Network location, or an empty string if the URL has none.
+    """
+    match = host_pattern.match(url)
+    if match is None:
+        return ''
+    return match.group(1).lower()
+
+def is_short_url(url):
+    """Determine if the given URL was shortened using one of the supported URL
+    shortener services.
+
+    >>> is_short_url('http://x90.es/5CA')
+    True
+    >>> is_short_url('http://www.example.com/')
+    False
+
+    @type  url: str
+    @param url: URL to query.
+
+    @rtype:  bool
+    @return: C{True} if the URL was shortened, C{False} otherwise.
+    """
+
+    # This only checks the hostname belongs to one of the supported services.
+    # It could be improved by checking the URL against a regular expression.
+    return url_host(url) in shorteners
@@ -34,432 +34,3756 @@
 
 @type shorteners: set of str
 @var  shorteners: Supported URL shortener services.
-    See the sources for the full list.
+    See the sources for the full list. Processes that only need this and
+    L{is_short_url} can import them from L{shorthosts} instead, which is
+    much faster to load.
+
+@type health: L{HealthRegistry}
+@var  health: Health statistics for each URL shortener service. Used by
+    L{besturl} and L{hideurl} to skip failing services and try the fastest
+    ones first. Call L{HealthRegistry.load} and L{HealthRegistry.save} to keep
+    the statistics across runs.
 
 @type verbose: bool
 @var  verbose: Global verbose flag. Set to C{True} to print debug messages, or
     C{False} for the default behavior (don't print anything).
     This is a private variable and you shouldn't need to use it.
 
-@type api: dict of str
-@var  api: URL shortener API format strings.
-    This is a private variable and you shouldn't need to use it.
-"""
+@type inflight: L{SingleFlight}
+@var  inflight: Coalesces concurrent calls to shorten or expand the same URL,
+    so they share a single request. Call L{SingleFlight.stats} to find out how
+    many requests were saved.
+
+@type hedger: L{Hedger}
+@var  hedger: Sends hedged requests for the hops of L{hideurl} when asked to.
+    Call L{Hedger.stats} to get the hedge rate and how many calls were won by
+    hedged requests.
+
+@type chains: L{ChainCache}
+@var  chains: Redirections found by L{expand_chain}, so hops shared by many
+    redirection chains are only requested once.
+
+@type metrics: L{Metrics}
+@var  metrics: Counters and latency histograms for every network call made by
+    this module and the file stores. Disabled by default, set
+    C{metrics.enabled} to C{True} to start collecting them.
+
+@type retries: L{RetryPolicy}
+@var  retries: Retry policy for every network call made by this module and
+    the file stores. Transient errors are retried with exponential backoff.
+
+@type timeout: float
+@var  timeout: Default timeout in seconds for each network call. The
+    C{deadline} argument accepted by most functions limits the time spent by
+    the whole operation instead.
+
+@type keepalive: bool
+@var  keepalive: Set to C{True} to send the HTTP requests over persistent
+    connections kept in a pool, or C{False} for the default behavior (a new
+    connection for each request).
+
+@type links: L{LinkIndex}
+@var  links: Index of known links consulted by L{longurl} before going to the
+    network, or C{None} to always go to the network. Links expanded while
+    the index is in use are remembered so they can be merged into it later.
+
+@type default_client: L{Client}
+@var  default_client: Client used by the functions of this module. It's
+    configured by the global variables above, so changing them changes it.
+    Create other L{Client} objects to run differently tuned workloads at the
+    same time.
+
+@type daemon_socket: str
+@var  daemon_socket: Default address of the daemon (see L{serve}), either
+    the pathname of a Unix socket or C{host:port} for a TCP socket.
+
+@type api: dict of str
+@var  api: URL shortener API format strings.
+    This is a private variable and you shouldn't need to use it.
+"""
+
+__all__ = ['shorturl', 'longurl', 'hideurl', 'besturl', 'is_short_url', 'shorteners',
+           'health', 'HealthRegistry', 'ServiceHealth',
+           'Deadline', 'DeadlineExceeded', 'inflight', 'SingleFlight',
+           'hedger', 'Hedger', 'expand_chain', 'chains', 'ChainCache',
+           'metrics', 'Metrics', 'Progress', 'retries', 'RetryPolicy',
+           'serve', 'DaemonClient', 'connect_daemon', 'expand_text',
+           'links', 'LinkIndex', 'Client', 'default_client', 'RateLimiter',
+           'probe', 'shorturl_many']
+
+import os
+import re
+import sys
+import mmap
+import time
+import struct
+import itertools
+import random
+import Queue
+import socket
+import httplib
+import StringIO
+import collections
+import threading
+import SocketServer
+import urllib2
+import urlparse
+
+# The table of services lives in a module of its own, so it can be imported
+# without the HTTP stack. See L{shorthosts}.
+from shorthosts import api, shorteners, is_short_url, url_host
+
+#------------------------------------------------------------------------------
+
+# Global verbose flag.
+verbose = False
+
+# Default timeout in seconds for each network call.
+timeout = 10.0
+
+# Set to True to reuse HTTP connections between requests.
+keepalive = False
+
+# Default address of the daemon.
+daemon_socket = '~/.shorturl.sock'
+
+#------------------------------------------------------------------------------
+
+class ServiceHealth(object):
+    """Rolling health statistics for a single URL shortener service.
+
+    This is a private class and you shouldn't need to use it.
+
+    @type service: str
+    @ivar service: Hostname of the URL shortener service.
+
+    @type latency: float
+    @ivar latency: Exponentially weighted moving average of the response time
+        in seconds, or C{None} if the service was never used.
+
+    @type successes: int
+    @ivar successes: Number of successful calls.
+
+    @type failures: int
+    @ivar failures: Number of failed calls.
+
+    @type error_rate: float
+    @ivar error_rate: Exponentially weighted moving average of the error rate,
+        between C{0.0} and C{1.0}.
+
+    @type consecutive: int
+    @ivar consecutive: Number of failures since the last successful call.
+
+    @type last_failure: float
+    @ivar last_failure: Timestamp of the last failure, or C{None}.
+
+    @type last_error: str
+    @ivar last_error: Description of the last error, or C{None}.
+
+    @type opened: float
+    @ivar opened: Timestamp when the circuit was opened, or C{None} if the
+        circuit is closed.
+
+    @type samples: list of float
+    @ivar samples: Response times of the most recent successful calls.
+    """
+
+    # Instance variables saved by HealthRegistry.save().
+    _fields = ('latency', 'successes', 'failures', 'error_rate',
+               'consecutive', 'last_failure', 'last_error', 'opened',
+               'samples')
+
+    # Maximum number of response times to keep in the samples list.
+    max_samples = 64
+
+    def __init__(self, service):
+        self.service      = service
+        self.latency      = None
+        self.successes    = 0
+        self.failures     = 0
+        self.error_rate   = 0.0
+        self.consecutive  = 0
+        self.last_failure = None
+        self.last_error   = None
+        self.opened       = None
+        self.samples      = []
+
+    def _update_latency(self, elapsed, alpha):
+        if self.latency is None:
+            self.latency = elapsed
+        else:
+            self.latency = (alpha * elapsed) + ((1.0 - alpha) * self.latency)
+
+    def expected_latency(self, default):
+        """Estimate the time the next call to this service will take.
+
+        Failures are penalized in proportion to the error rate, since each
+        one means we'll have to spend another call on a different service.
+
+        @type  default: float
+        @param default: Latency to assume for services never used before.
+
+        @rtype:  float
+        @return: Expected latency in seconds.
+        """
+        latency = self.latency
+        if latency is None:
+            latency = default
+        return latency * (1.0 + self.error_rate)
+
+    def latency_percentile(self, percentile, default):
+        """Estimate the response time of successful calls to this service
+        at the given percentile, based on the most recent calls.
+
+        @type  percentile: float
+        @param percentile: Percentile between C{0.0} and C{1.0}.
+
+        @type  default: float
+        @param default: Latency to assume for services never used before.
+
+        @rtype:  float
+        @return: Latency in seconds.
+        """
+        if not self.samples:
+            return default
+        ordered = sorted(self.samples)
+        index   = int(percentile * len(ordered))
+        return ordered[ min(index, len(ordered) - 1) ]
+
+class HealthRegistry(object):
+    """Tracks the health of each URL shortener service.
+
+    The registry keeps rolling latency and error rate statistics for each
+    service, and implements a simple circuit breaker: after C{threshold}
+    consecutive failures the service is considered to be down and is skipped
+    for C{cooldown} seconds. After that a single call is allowed through to
+    probe it. If the probe succeeds the circuit is closed again, otherwise
+    the service is skipped for another C{cooldown} seconds.
+
+    It's safe to share a registry between threads.
+
+    @type threshold: int
+    @ivar threshold: Consecutive failures needed to open the circuit.
+
+    @type cooldown: float
+    @ivar cooldown: Seconds to wait before probing a failing service again.
+
+    @type alpha: float
+    @ivar alpha: Smoothing factor for the moving averages. Higher values give
+        more weight to recent calls.
+
+    @type default_latency: float
+    @ivar default_latency: Latency to assume for services never used before.
+    """
+
+    def __init__(self, threshold = 3, cooldown = 60.0, alpha = 0.3,
+                 default_latency = 1.0):
+        self.threshold       = threshold
+        self.cooldown        = cooldown
+        self.alpha           = alpha
+        self.default_latency = default_latency
+        self._stats          = dict()
+        self._probing        = dict()     # service -> time of the probe
+        self._lock           = threading.Lock()
+
+    def _get(self, service):
+        # Must be called with the lock held.
+        try:
+            return self._stats[service]
+        except KeyError:
+            stats = ServiceHealth(service)
+            self._stats[service] = stats
+            return stats
+
+    def get(self, service):
+        """Get the statistics for a service.
+
+        @type  service: str
+        @param service: Hostname of the URL shortener service.
+
+        @rtype:  L{ServiceHealth}
+        @return: Statistics for the service. Don't modify them.
+        """
+        with self._lock:
+            return self._get(service)
+
+    def latency_percentile(self, service, percentile):
+        """Estimate the response time of successful calls to a service at
+        the given percentile.
+
+        @type  service: str
+        @param service: Hostname of the URL shortener service.
+
+        @type  percentile: float
+        @param percentile: Percentile between C{0.0} and C{1.0}.
+
+        @rtype:  float
+        @return: Latency in seconds.
+        """
+        with self._lock:
+            stats = self._stats.get(service)
+            if stats is None:
+                return self.default_latency
+            return stats.latency_percentile(percentile, self.default_latency)
+
+    def record_success(self, service, elapsed):
+        """Record a successful call to a service.
+
+        @type  service: str
+        @param service: Hostname of the URL shortener service.
+
+        @type  elapsed: float
+        @param elapsed: Time taken by the call in seconds.
+        """
+        with self._lock:
+            stats = self._get(service)
+            stats._update_latency(elapsed, self.alpha)
+            stats.samples.append(elapsed)
+            del stats.samples[ : -ServiceHealth.max_samples ]
+            stats.successes   = stats.successes + 1
+            stats.error_rate  = (1.0 - self.alpha) * stats.error_rate
+            stats.consecutive = 0
+            stats.opened      = None
+            self._probing.pop(service, None)
+
+    def record_failure(self, service, error, elapsed):
+        """Record a failed call to a service.
+
+        @type  service: str
+        @param service: Hostname of the URL shortener service.
+
+        @type  error: Exception
+        @param error: The error that caused the call to fail.
+
+        @type  elapsed: float
+        @param elapsed: Time taken by the call in seconds.
+        """
+        now = time.time()
+        with self._lock:
+            stats = self._get(service)
+            stats._update_latency(elapsed, self.alpha)
+            stats.failures     = stats.failures + 1
+            stats.error_rate   = self.alpha + ((1.0 - self.alpha) * stats.error_rate)
+            stats.consecutive  = stats.consecutive + 1
+            stats.last_failure = now
+            stats.last_error   = str(error) or error.__class__.__name__
+            if stats.consecutive >= self.threshold:
+                stats.opened = now
+            self._probing.pop(service, None)
+
+    def is_available(self, service):
+        """Determine if a service can be called right now.
+
+        When the cooldown period for a failing service expires, this method
+        returns C{True} only once until the result of the probe is recorded.
+
+        @type  service: str
+        @param service: Hostname of the URL shortener service.
+
+        @rtype:  bool
+        @return: C{True} if the circuit is closed or a probe is allowed,
+            C{False} if the service should be skipped.
+        """
+        with self._lock:
+            stats = self._stats.get(service)
+            if stats is None or stats.opened is None:
+                return True
+            return self._claim(service, stats, time.time())
+
+    def _claim(self, service, stats, now):
+        # Must be called with the lock held.
+        # A probe that's never reported back, for example because the caller
+        # picked another service in the end, is given up after a cooldown.
+        if now - stats.opened < self.cooldown:
+            return False
+        claimed = self._probing.get(service)
+        if claimed is not None and now - claimed < self.cooldown:
+            return False
+        self._probing[service] = now
+        return True
+
+    def rank(self, services):
+        """Sort the given services from best to worst, and drop the ones
+        whose circuit is open.
+
+        Services with the same expected latency are sorted randomly, so
+        the load is spread among services we know nothing about.
+
+        When the cooldown of a failing service expires, only the first caller
+        gets it back, to probe it. It's left out for everyone else until the
+        result of the probe is recorded.
+
+        @type  services: list of str
+        @param services: Hostnames of the URL shortener services.
+
+        @rtype:  list of str
+        @return: Services sorted by expected latency.
+        """
+        now = time.time()
+        ranked = list()
+        with self._lock:
+            for service in services:
+                stats = self._stats.get(service)
+                if stats is None:
+                    expected = self.default_latency
+                else:
+                    if stats.opened is not None and \
+                            not self._claim(service, stats, now):
+                        continue
+                    expected = stats.expected_latency(self.default_latency)
+                ranked.append( (expected, random.random(), service) )
+        ranked.sort()
+        return [ service for (expected, _, service) in ranked ]
+
+    def load(self, filename):
+        """Load the statistics saved by a previous run.
+
+        Missing or unreadable files are silently ignored, so it's safe to call
+        this method before the first run.
+
+        @type  filename: str
+        @param filename: Name of the file to load the statistics from.
+        """
+        import json
+        try:
+            with open(filename, 'r') as fd:
+                saved = json.load(fd)
+        except (IOError, ValueError):
+            return
+        with self._lock:
+            for service, fields in saved.iteritems():
+                stats = self._get(str(service))
+                for name in ServiceHealth._fields:
+                    if name in fields:
+                        setattr(stats, name, fields[name])
+
+    def save(self, filename):
+        """Save the statistics so they can be loaded by future runs.
+
+        @type  filename: str
+        @param filename: Name of the file to save the statistics to.
+        """
+        import json
+        with self._lock:
+            saved = dict()
+            for service, stats in self._stats.iteritems():
+                saved[service] = dict(
+                    (name, getattr(stats, name)) for name in ServiceHealth._fields )
+        temp = '%s.%d.tmp' % (filename, os.getpid())
+        with open(temp, 'w') as fd:
+            json.dump(saved, fd, indent = 1, sort_keys = True)
+        os.rename(temp, filename)
+
+# Health statistics shared by all the functions in this module.
+health = HealthRegistry()
+
+#------------------------------------------------------------------------------
+
+class Metrics(object):
+    """In-process registry of counters and latency histograms.
+
+    Metrics are disabled by default. While disabled every method returns
+    right away, so the instrumentation costs next to nothing. Set the
+    C{enabled} attribute to C{True} to start collecting them.
+
+    Each metric is identified by its name and a set of labels, for example
+    C{metrics.increment('retries_total', service='ito.mx')}. Hooks can be
+    added to forward every update to an external monitoring system.
+
+    It's safe to share the registry between threads.
+
+    @type enabled: bool
+    @ivar enabled: C{True} to collect metrics, C{False} to ignore them.
+
+    @type buckets: tuple of float
+    @ivar buckets: Upper bounds in seconds of the histogram buckets.
+    """
+
+    def __init__(self, enabled = False,
+                 buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                            1.0, 2.5, 5.0, 10.0, 30.0)):
+        self.enabled     = enabled
+        self.buckets     = tuple(buckets)
+        self._counters   = dict()
+        self._histograms = dict()
+        self._hooks      = list()
+        self._lock       = threading.Lock()
+
+    def add_hook(self, hook):
+        """Add a function to be called on every update.
+
+        The hook is called with the kind of metric (C{'counter'} or
+        C{'histogram'}), the metric name, a dictionary of labels and the
+        value. It's called from whatever thread made the update, so it should
+        be quick and thread safe.
+
+        @type  hook: callable
+        @param hook: Hook function.
+        """
+        with self._lock:
+            self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """Remove a function added with L{add_hook}.
+
+        @type  hook: callable
+        @param hook: Hook function.
+        """
+        with self._lock:
+            self._hooks.remove(hook)
+
+    def increment(self, name, value = 1, **labels):
+        """Increment a counter.
+
+        @type  name: str
+        @param name: Metric name.
+
+        @type  value: int
+        @param value: Amount to add to the counter.
+
+        @param labels: Labels for the metric.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            hooks = self._hooks
+        for hook in hooks:
+            hook('counter', name, labels, value)
+
+    def observe(self, name, seconds, **labels):
+        """Add a measurement to a latency histogram.
+
+        @type  name: str
+        @param name: Metric name.
+
+        @type  seconds: float
+        @param seconds: Measured time in seconds.
+
+        @param labels: Labels for the metric.
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = [ [0] * len(self.buckets), 0.0, 0 ]
+                self._histograms[key] = histogram
+            counts = histogram[0]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[index] = counts[index] + 1
+            histogram[1] = histogram[1] + seconds
+            histogram[2] = histogram[2] + 1
+            hooks = self._hooks
+        for hook in hooks:
+            hook('histogram', name, labels, seconds)
+
+    def request(self, service, operation, elapsed, error = None, size = None):
+        """Record a network call.
+
+        @type  service: str
+        @param service: Hostname of the service called.
+
+        @type  operation: str
+        @param operation: What the call was for: C{'shorten'}, C{'expand'},
+            C{'upload'} or C{'download'}.
+
+        @type  elapsed: float
+        @param elapsed: Time taken by the call in seconds.
+
+        @type  error: Exception
+        @param error: Exception raised by the call, or C{None} on success.
+
+        @type  size: int
+        @param size: Payload bytes moved by the call, if it matters.
+        """
+        if not self.enabled:
+            return
+        if error is None:
+            outcome = 'ok'
+        else:
+            outcome = error.__class__.__name__
+        self.increment('requests_total', service = service,
+                       operation = operation, outcome = outcome)
+        self.observe('request_seconds', elapsed, service = service,
+                     operation = operation)
+        if size:
+            self.increment('bytes_total', size, service = service,
+                           operation = operation)
+
+    def reset(self):
+        """Forget all the collected metrics."""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self):
+        """
+        @rtype:  dict
+        @return: Copy of the collected metrics, in the format written by
+            L{to_json}.
+        """
+        with self._lock:
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self._counters.iteritems())
+            ]
+            histograms = [
+                {'name': name, 'labels': dict(labels),
+                 'buckets': zip(self.buckets, histogram[0]),
+                 'sum': histogram[1], 'count': histogram[2]}
+                for (name, labels), histogram in sorted(self._histograms.iteritems())
+            ]
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_json(self):
+        """
+        @rtype:  str
+        @return: Collected metrics as a JSON document.
+        """
+        import json
+        return json.dumps(self.snapshot(), indent = 1, sort_keys = True)
+
+    def to_prometheus(self, prefix = 'shorturl_'):
+        """
+        @type  prefix: str
+        @param prefix: Prefix for the metric names.
+
+        @rtype:  str
+        @return: Collected metrics in the Prometheus text exposition format.
+        """
+        def format_labels(labels, extra = ()):
+            pairs = sorted(labels.items()) + list(extra)
+            if not pairs:
+                return ''
+            return '{%s}' % ','.join(
+                '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                for key, value in pairs )
+        snapshot = self.snapshot()
+        lines    = []
+        declared = set()
+        for counter in snapshot['counters']:
+            name = prefix + counter['name']
+            if name not in declared:
+                declared.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, format_labels(counter['labels']),
+                                      counter['value']))
+        for histogram in snapshot['histograms']:
+            name   = prefix + histogram['name']
+            labels = histogram['labels']
+            if name not in declared:
+                declared.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            for bound, count in histogram['buckets']:
+                lines.append('%s_bucket%s %d' % (name,
+                        format_labels(labels, [('le', repr(bound))]), count))
+            lines.append('%s_bucket%s %d' % (name,
+                        format_labels(labels, [('le', '+Inf')]), histogram['count']))
+            lines.append('%s_sum%s %r' % (name, format_labels(labels), histogram['sum']))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), histogram['count']))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def save(self, filename):
+        """Write the collected metrics to a file. Files ending with C{.prom}
+        use the Prometheus text format, all others are written as JSON.
+
+        @type  filename: str
+        @param filename: Output file name.
+        """
+        if filename.endswith('.prom'):
+            data = self.to_prometheus()
+        else:
+            data = self.to_json()
+        with open(filename, 'w') as fd:
+            fd.write(data)
+
+# Metrics collected by this module and the file stores, disabled by default.
+metrics = Metrics()
+
+#------------------------------------------------------------------------------
+
+class Progress(object):
+    """Progress and throughput reporting for file transfers.
+
+    The file stores call L{update} after each block is transferred. Every
+    C{interval} seconds, and once more when the transfer finishes, the
+    current numbers are passed to the callback function (if any) and
+    reported on the output stream (if requested), either as a status line
+    that's rewritten in place or as one JSON event per line.
+
+    The numbers reported are those returned by L{snapshot}.
+
+    @type total: int
+    @ivar total: Total bytes to transfer, or C{None} if unknown.
+
+    @type total_blocks: int
+    @ivar total_blocks: Total blocks to transfer, or C{None} if unknown.
+        Used to calculate the percentage when the size is unknown.
+    """
+
+    def __init__(self, total = None, total_blocks = None, callback = None,
+                 output = None, interval = 1.0, stream = None, label = ''):
+        """
+        @type  total: int
+        @param total: Total bytes to transfer, or C{None} if unknown.
+
+        @type  total_blocks: int
+        @param total_blocks: Total blocks to transfer, or C{None} if unknown.
+
+        @type  callback: callable
+        @param callback: Function called with the L{snapshot} dictionary.
+
+        @type  output: str
+        @param output: C{'line'} for a status line, C{'json'} for JSON
+            events, or C{None} to write nothing.
+
+        @type  interval: float
+        @param interval: Seconds between reports.
+
+        @type  stream: file
+        @param stream: Where to write the reports. Defaults to C{sys.stderr}.
+
+        @type  label: str
+        @param label: Name of the transfer, included in the reports.
+        """
+        if output not in (None, 'line', 'json'):
+            raise ValueError, "Unknown progress output: %r" % output
+        self.total        = total
+        self.total_blocks = total_blocks
+        self.callback     = callback
+        self.output       = output
+        self.interval     = interval
+        self.stream       = stream
+        self.label        = label
+        self.bytes        = 0
+        self.blocks       = 0
+        self.latencies    = []
+        self.started      = None
+        self.reported     = None
+        self._lock        = threading.Lock()
+
+    def start(self):
+        """Start measuring. Called automatically by the first update."""
+        with self._lock:
+            if self.started is None:
+                self.started  = time.time()
+                self.reported = self.started
+
+    def update(self, size, latency = None, blocks = 1):
+        """Record the transfer of a block.
+
+        @type  size: int
+        @param size: Number of bytes transferred.
+
+        @type  latency: float
+        @param latency: Time in seconds spent transferring the block.
+
+        @type  blocks: int
+        @param blocks: Number of blocks transferred.
+        """
+        now = time.time()
+        with self._lock:
+            if self.started is None:
+                self.started  = now
+                self.reported = now
+            self.bytes  = self.bytes + size
+            self.blocks = self.blocks + blocks
+            if latency is not None:
+                self.latencies.append(latency)
+            due = now - self.reported >= self.interval
+            if due:
+                self.reported = now
+        if due:
+            self.report()
+
+    def finish(self):
+        """Report the final numbers."""
+        self.report(final = True)
+
+    def snapshot(self):
+        """
+        @rtype:  dict
+        @return: Current progress, with the following keys:
+            - C{label}: name of the transfer.
+            - C{bytes}, C{total}: bytes done and total bytes (or C{None}).
+            - C{blocks}, C{total_blocks}: blocks done and total blocks.
+            - C{percent}: percentage done, or C{None} if unknown.
+            - C{elapsed}: seconds since the transfer started.
+            - C{bytes_per_second}, C{blocks_per_second}: average speed.
+            - C{eta}: estimated seconds left, or C{None} if unknown.
+            - C{latency}: per-block latency percentiles (C{p50}, C{p90},
+              C{p99} and C{max}) in seconds, or C{None} if unknown.
+        """
+        with self._lock:
+            now       = time.time()
+            started   = self.started or now
+            elapsed   = now - started
+            done      = self.bytes
+            blocks    = self.blocks
+            latencies = sorted(self.latencies)
+        fraction = None
+        if self.total:
+            fraction = float(done) / self.total
+        elif self.total_blocks:
+            fraction = float(blocks) / self.total_blocks
+        elif self.total == 0 or self.total_blocks == 0:
+            fraction = 1.0
+        bytes_per_second  = None
+        blocks_per_second = None
+        if elapsed > 0:
+            bytes_per_second  = done / elapsed
+            blocks_per_second = blocks / elapsed
+        eta = None
+        if fraction is not None and fraction > 0:
+            eta = max(0.0, elapsed / fraction - elapsed)
+        latency = None
+        if latencies:
+            def pick(p):
+                return latencies[ min(len(latencies) - 1, int(p * len(latencies))) ]
+            latency = {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99),
+                       'max': latencies[-1]}
+        percent = None
+        if fraction is not None:
+            percent = min(100.0, 100.0 * fraction)
+        return {
+            'label':             self.label,
+            'bytes':             done,
+            'total':             self.total,
+            'blocks':            blocks,
+            'total_blocks':      self.total_blocks,
+            'percent':           percent,
+            'elapsed':           elapsed,
+            'bytes_per_second':  bytes_per_second,
+            'blocks_per_second': blocks_per_second,
+            'eta':               eta,
+            'latency':           latency,
+        }
+
+    def report(self, final = False):
+        """Report the current progress to the callback and output stream.
+
+        @type  final: bool
+        @param final: C{True} if the transfer has finished.
+        """
+        snapshot = self.snapshot()
+        snapshot['final'] = final
+        if self.callback is not None:
+            self.callback(snapshot)
+        if self.output is None:
+            return
+        stream = self.stream or sys.stderr
+        if self.output == 'json':
+            import json
+            stream.write(json.dumps(snapshot, sort_keys = True) + '\n')
+        else:
+            stream.write('\r' + format_progress(snapshot))
+            if final:
+                stream.write('\n')
+        stream.flush()
+
+def format_progress(snapshot):
+    """Format a L{Progress.snapshot} as a single status line.
+
+    This is a private function and you shouldn't need to use it.
+    """
+    def size(value):
+        for unit in ('B', 'KB', 'MB', 'GB'):
+            if value < 1024 or unit == 'GB':
+                return '%.1f %s' % (value, unit)
+            value = value / 1024.0
+    parts = []
+    if snapshot['label']:
+        parts.append(snapshot['label'])
+    if snapshot['percent'] is not None:
+        parts.append('%5.1f%%' % snapshot['percent'])
+    done = size(snapshot['bytes'])
+    if snapshot['total'] is not None:
+        done = '%s / %s' % (done, size(snapshot['total']))
+    parts.append(done)
+    if snapshot['bytes_per_second'] is not None:
+        parts.append('%s/s' % size(snapshot['bytes_per_second']))
+        parts.append('%.1f blocks/s' % snapshot['blocks_per_second'])
+    if snapshot['latency'] is not None:
+        parts.append('p50 %.0f ms, p99 %.0f ms' % (
+                     snapshot['latency']['p50'] * 1000,
+                     snapshot['latency']['p99'] * 1000))
+    if snapshot['eta'] is not None and not snapshot.get('final'):
+        eta = int(snapshot['eta'])
+        parts.append('ETA %d:%02d:%02d' % (eta // 3600, (eta // 60) % 60, eta % 60))
+    return ' | '.join(parts).ljust(79)
+
+#------------------------------------------------------------------------------
+
+class DeadlineExceeded(Exception):
+    """Raised when an operation runs out of time.
+
+    @type stage: str
+    @ivar stage: Description of what was being done when time ran out.
+    """
+
+    def __init__(self, stage):
+        Exception.__init__(self, "Deadline exceeded while %s" % stage)
+        self.stage = stage
+
+class Deadline(object):
+    """Time budget for an operation that may span many network calls.
+
+    The same deadline object can be passed along to every step of the
+    operation, and each network call will only be allowed to spend the time
+    that's left of it. Deadlines can't be extended once created.
+
+    @type expires: float
+    @ivar expires: Timestamp when the deadline expires, or C{None} if the
+        operation has no time limit (only per-call timeouts apply).
+    """
+
+    def __init__(self, seconds = None):
+        """
+        @type  seconds: float
+        @param seconds: Time budget in seconds, or C{None} for no time limit.
+        """
+        if seconds is None:
+            self.expires = None
+        else:
+            self.expires = time.time() + seconds
+
+    def remaining(self):
+        """
+        @rtype:  float
+        @return: Seconds left until the deadline expires, or C{None} if there
+            is no time limit. May be negative if the deadline has expired.
+        """
+        if self.expires is None:
+            return None
+        return self.expires - time.time()
+
+    def expired(self):
+        """
+        @rtype:  bool
+        @return: C{True} if the deadline has expired, C{False} otherwise.
+        """
+        return self.expires is not None and self.expires <= time.time()
+
+    def check(self, stage):
+        """Make sure the deadline hasn't expired yet.
+
+        @type  stage: str
+        @param stage: Description of what's about to be done.
+
+        @raise DeadlineExceeded: The deadline has expired.
+        """
+        if self.expired():
+            raise DeadlineExceeded(stage)
+
+    def timeout(self, stage, limit = None):
+        """Calculate the timeout for the next network call.
+
+        @type  stage: str
+        @param stage: Description of what's about to be done.
+
+        @type  limit: float
+        @param limit: Per-call timeout in seconds. Defaults to L{timeout}.
+
+        @rtype:  float
+        @return: The per-call timeout, or the time left until the deadline
+            expires if that's shorter.
+
+        @raise DeadlineExceeded: The deadline has expired.
+        """
+        if limit is None:
+            limit = timeout
+        remaining = self.remaining()
+        if remaining is None:
+            return limit
+        if remaining <= 0:
+            raise DeadlineExceeded(stage)
+        if limit is None or remaining < limit:
+            return remaining
+        return limit
+
+    def sleep(self, seconds, stage):
+        """Sleep, unless the deadline would expire before waking up.
+
+        @type  seconds: float
+        @param seconds: Time to sleep in seconds.
+
+        @type  stage: str
+        @param stage: Description of what we're waiting for.
+
+        @raise DeadlineExceeded: The deadline would expire while sleeping.
+        """
+        remaining = self.remaining()
+        if remaining is not None and remaining < seconds:
+            raise DeadlineExceeded(stage)
+        time.sleep(seconds)
+
+def as_deadline(deadline):
+    """Convert the C{deadline} argument accepted by most functions into a
+    L{Deadline} object.
+
+    This is a private function and you shouldn't need to use it.
+
+    @type  deadline: L{Deadline} or float
+    @param deadline: Either a L{Deadline} object, a number of seconds, or
+        C{None} for no time limit.
+
+    @rtype:  L{Deadline}
+    @return: Deadline object.
+    """
+    if isinstance(deadline, Deadline):
+        return deadline
+    return Deadline(deadline)
+
+def is_timeout(error):
+    """Determine if the given exception was caused by a socket timeout.
+
+    This is a private function and you shouldn't need to use it.
+    """
+    if isinstance(error, socket.timeout):
+        return True
+    if isinstance(error, urllib2.URLError) and \
+            not isinstance(error, urllib2.HTTPError):
+        return isinstance(error.reason, socket.timeout)
+    return False
+
+def open_url(url, data = None, deadline = None, stage = 'sending a request',
+             opener = None, limit = None):
+    """Send an HTTP request, applying the per-call timeout and the remaining
+    time of the deadline.
+
+    This is a private function and you shouldn't need to use it.
+
+    @type  url: str or urllib2.Request
+    @param url: URL to open.
+
+    @type  data: str
+    @param data: Data for POST requests, or C{None} for GET requests.
+
+    @type  deadline: L{Deadline} or float
+    @param deadline: Time budget for the operation, or C{None}.
+
+    @type  stage: str
+    @param stage: Description of what's being done, used in timeout errors.
+
+    @type  opener: urllib2.OpenerDirector
+    @param opener: URL opener to use, or C{None} for the default opener.
+
+    @type  limit: float
+    @param limit: Per-call timeout in seconds. Defaults to L{timeout}.
+
+    @rtype:  file
+    @return: Response object returned by C{urllib2}.
+
+    @raise DeadlineExceeded: The deadline expired.
+    @raise urllib2.URLError: A network error occured.
+    """
+    deadline = as_deadline(deadline)
+    try:
+        if opener is None:
+            if keepalive:
+                opener = build_opener()
+            else:
+                return urllib2.urlopen(url, data, deadline.timeout(stage, limit))
+        return opener.open(url, data, deadline.timeout(stage, limit))
+    except (socket.timeout, urllib2.URLError), e:
+        if is_timeout(e) and deadline.expired():
+            raise DeadlineExceeded(stage)
+        raise
+
+def read_response(response, deadline = None, stage = 'reading a response',
+                  limit = None):
+    """Read the body of an HTTP response, applying the per-call timeout and
+    the remaining time of the deadline to each socket operation.
+
+    This is a private function and you shouldn't need to use it.
+
+    @type  response: file
+    @param response: Response object returned by L{open_url}.
+
+    @type  deadline: L{Deadline} or float
+    @param deadline: Time budget for the operation, or C{None}.
+
+    @type  stage: str
+    @param stage: Description of what's being done, used in timeout errors.
+
+    @type  limit: float
+    @param limit: Per-call timeout in seconds. Defaults to L{timeout}.
+
+    @rtype:  str
+    @return: Response body.
+
+    @raise DeadlineExceeded: The deadline expired.
+    @raise socket.error: A network error occured.
+    """
+    deadline = as_deadline(deadline)
+    chunks   = []
+    while 1:
+
+        # Dig the socket out of the response to update its timeout.
+        # If urllib2 changes its internals we'll just keep the first timeout.
+        remaining = deadline.timeout(stage, limit)
+        try:
+            response.fp._sock.fp._sock.settimeout(remaining)
+        except AttributeError:
+            pass
+
+        try:
+            chunk = response.read(65536)
+        except socket.timeout:
+            if deadline.expired():
+                raise DeadlineExceeded(stage)
+            raise
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+#------------------------------------------------------------------------------
+
+class ConnectionPool(object):
+    """Pool of persistent HTTP connections, kept open between requests to
+    save the cost of connecting each time.
+
+    It's safe to share the pool between threads. Each connection is used by
+    a single thread at a time.
+
+    @type max_idle: int
+    @ivar max_idle: Maximum number of idle connections kept for each host.
+
+    @type created: int
+    @ivar created: Number of connections opened.
+
+    @type reused: int
+    @ivar reused: Number of requests sent over an already open connection.
+    """
+
+    def __init__(self, max_idle = 4):
+        self.max_idle = max_idle
+        self.created  = 0
+        self.reused   = 0
+        self._idle    = dict()
+        self._lock    = threading.Lock()
+
+    def get(self, host, timeout):
+        """Get a connection to the given host.
+
+        @type  host: str
+        @param host: Host name and optional port.
+
+        @type  timeout: float
+        @param timeout: Socket timeout for the connection.
+
+        @rtype:  tuple(httplib.HTTPConnection, bool)
+        @return: Connection and C{True} if it was already open.
+        """
+        with self._lock:
+            idle = self._idle.get(host)
+            if idle:
+                connection = idle.pop()
+                self.reused = self.reused + 1
+            else:
+                connection = None
+                self.created = self.created + 1
+        if connection is None:
+            return httplib.HTTPConnection(host, timeout = timeout), False
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection, True
+
+    def put(self, host, connection):
+        """Give back a connection so it can be used again.
+
+        @type  host: str
+        @param host: Host name and optional port.
+
+        @type  connection: httplib.HTTPConnection
+        @param connection: Connection returned by L{get}, whose last
+            response has been fully read.
+        """
+        with self._lock:
+            idle = self._idle.setdefault(host, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        """Close all the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, dict()
+        for connections in idle.itervalues():
+            for connection in connections:
+                connection.close()
+
+class HTTPKeepAliveHandler(urllib2.HTTPHandler):
+    """HTTP handler that sends requests over pooled persistent connections.
+
+    Responses are read in full before returning, so the connection can go
+    back to the pool right away. That's fine for the small responses of
+    the URL shortener services.
+
+    This is a private class and you shouldn't need to use it.
+    """
+
+    def __init__(self, pool):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+
+    def http_open(self, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers = dict( (name.title(), value) for name, value in headers.iteritems() )
+        headers['Connection'] = 'keep-alive'
+
+        # A pooled connection may have been closed by the server while idle,
+        # so if it fails try again once with a new connection.
+        while 1:
+            connection, reused = self.pool.get(host, req.timeout)
+            try:
+                if connection.sock is None:
+                    connection.connect()
+
+                    # Headers and body go in separate writes, don't let
+                    # Nagle's algorithm hold back the body.
+                    connection.sock.setsockopt(socket.IPPROTO_TCP,
+                                               socket.TCP_NODELAY, 1)
+                connection.request(req.get_method(), req.get_selector(),
+                                   req.data, headers)
+                response = connection.getresponse()
+                body     = response.read()
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+                if reused and not isinstance(e, socket.timeout):
+                    continue
+                if isinstance(e, socket.timeout):
+                    raise
+                raise urllib2.URLError(e)
+            break
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(host, connection)
+
+        result = urllib2.addinfourl(StringIO.StringIO(body), response.msg,
+                                    req.get_full_url())
+        result.code = response.status
+        result.msg  = response.reason
+        return result
+
+def build_opener(*handlers):
+    """Build a URL opener with the given handlers, sending the requests over
+    pooled connections when L{keepalive} is enabled.
+
+    This is a private function and you shouldn't need to use it.
+
+    @rtype:  urllib2.OpenerDirector
+    @return: URL opener.
+    """
+    if keepalive:
+        handlers = handlers + ( HTTPKeepAliveHandler(connections), )
+    return urllib2.build_opener(*handlers)
+
+# Persistent connections, used when keepalive is enabled.
+connections = ConnectionPool()
+
+#------------------------------------------------------------------------------
+
+class RetryPolicy(object):
+    """Decides when and how long to wait before retrying a network call.
+
+    Only transient errors are retried: connection errors, timeouts, and HTTP
+    responses with a status code in C{retry_statuses}. Anything else, like an
+    error message from the API, is raised right away.
+
+    The wait between tries grows exponentially from C{base_delay} up to
+    C{max_delay}, with some random jitter so many clients failing at the same
+    time don't all come back at the same time. If the server sent a
+    C{Retry-After} header the wait is at least that long.
+
+    The policy also keeps a retry budget shared by all the calls made with
+    it: each retry spends a token, and each successful call earns back
+    C{budget_ratio} tokens, up to C{budget_max}. When the tokens run out
+    errors are raised without retrying, so a service that's down isn't
+    flooded with retries.
+
+    It's safe to share a policy between threads.
+
+    @type max_tries: int
+    @ivar max_tries: Maximum number of tries for each call, including the
+        first one.
+
+    @type base_delay: float
+    @ivar base_delay: Seconds to wait before the first retry.
+
+    @type max_delay: float
+    @ivar max_delay: Maximum seconds to wait between tries.
+
+    @type multiplier: float
+    @ivar multiplier: Growth factor of the wait after each retry.
+
+    @type jitter: float
+    @ivar jitter: Fraction of the wait that's randomized, between C{0.0}
+        (no jitter) and C{1.0} (anything from zero to the full wait).
+
+    @type retry_statuses: set of int
+    @ivar retry_statuses: HTTP status codes considered transient.
+
+    @type budget_ratio: float
+    @ivar budget_ratio: Tokens earned by each successful call.
+
+    @type budget_max: float
+    @ivar budget_max: Maximum number of tokens.
+
+    @type retries: int
+    @ivar retries: Number of retries made.
+
+    @type exhausted: int
+    @ivar exhausted: Number of times a retry was denied by the budget.
+    """
+
+    def __init__(self, max_tries = 3, base_delay = 0.5, max_delay = 30.0,
+                 multiplier = 2.0, jitter = 0.5,
+                 retry_statuses = (408, 429, 500, 502, 503, 504),
+                 budget_ratio = 0.1, budget_max = 10.0):
+        self.max_tries      = max_tries
+        self.base_delay     = base_delay
+        self.max_delay      = max_delay
+        self.multiplier     = multiplier
+        self.jitter         = jitter
+        self.retry_statuses = set(retry_statuses)
+        self.budget_ratio   = budget_ratio
+        self.budget_max     = budget_max
+        self.retries        = 0
+        self.exhausted      = 0
+        self._tokens        = budget_max
+        self._lock          = threading.Lock()
+
+    def is_retryable(self, error):
+        """
+        @type  error: Exception
+        @param error: Exception raised by a network call.
+
+        @rtype:  bool
+        @return: C{True} if the error is transient and the call may be
+            retried, C{False} if it's fatal.
+        """
+        if isinstance(error, DeadlineExceeded):
+            return False
+        if isinstance(error, urllib2.HTTPError):
+            return error.code in self.retry_statuses
+        return isinstance(error, (IOError, httplib.HTTPException))
+
+    def retry_after(self, error):
+        """
+        @type  error: Exception
+        @param error: Exception raised by a network call.
+
+        @rtype:  float
+        @return: Seconds the server asked us to wait before retrying, or
+            C{None} if it didn't say.
+        """
+        if not isinstance(error, urllib2.HTTPError) or error.headers is None:
+            return None
+        value = error.headers.get('Retry-After')
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+
+        # Dates are rare here and the email package is slow to load.
+        import email.utils
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+    def backoff(self, tries, error = None):
+        """
+        @type  tries: int
+        @param tries: Number of tries made so far.
+
+        @type  error: Exception
+        @param error: Exception raised by the last try.
+
+        @rtype:  float
+        @return: Seconds to wait before the next try.
+        """
+        delay = self.base_delay * (self.multiplier ** (tries - 1))
+        delay = min(delay, self.max_delay)
+        delay = delay - random.uniform(0, self.jitter * delay)
+        retry_after = self.retry_after(error)
+        if retry_after is not None and retry_after > delay:
+            delay = retry_after
+        return delay
+
+    def _spend_token(self):
+        with self._lock:
+            if self._tokens < 1.0:
+                self.exhausted = self.exhausted + 1
+                return False
+            self._tokens  = self._tokens - 1.0
+            self.retries = self.retries + 1
+            return True
+
+    def _earn_token(self):
+        with self._lock:
+            self._tokens = min(self.budget_max, self._tokens + self.budget_ratio)
+
+    def call(self, function, deadline = None, stage = 'sending a request',
+             service = None, operation = None, echo = None):
+        """Call a function, retrying it on transient errors.
+
+        @type  function: callable
+        @param function: Function to call, without arguments.
+
+        @type  deadline: L{Deadline} or float
+        @param deadline: Time limit for all the tries, or C{None}. Waiting
+            past the deadline raises L{DeadlineExceeded}.
+
+        @type  stage: str
+        @param stage: Description of the call, used in timeout errors.
+
+        @type  service: str
+        @param service: Hostname of the service, used in the metrics.
+
+        @type  operation: str
+        @param operation: Type of operation, used in the metrics.
+
+        @type  echo: bool
+        @param echo: C{True} to print the errors before retrying.
+            Defaults to the L{verbose} flag of this module.
+
+        @return: Value returned by the function.
+        """
+        global verbose
+        deadline = as_deadline(deadline)
+        if echo is None:
+            echo = verbose
+        tries = 0
+        while 1:
+            tries = tries + 1
+            try:
+                result = function()
+            except Exception, e:
+                if tries >= self.max_tries or not self.is_retryable(e):
+                    raise
+                if not self._spend_token():
+                    raise
+                delay = self.backoff(tries, e)
+                if echo:
+                    print "Error: %s" % str(e)
+                    print "Retrying in %.1f seconds..." % delay
+                metrics.increment('retries_total', service = service,
+                                  operation = operation)
+                deadline.sleep(delay, stage)
+                continue
+            self._earn_token()
+            return result
+
+    def stats(self):
+        """
+        @rtype:  dict( str S{->} int or float )
+        @return: Number of retries made, retries denied by the budget, and
+            tokens left in the budget.
+        """
+        with self._lock:
+            return {'retries': self.retries, 'exhausted': self.exhausted,
+                    'tokens': self._tokens}
+
+# Retry policy for every network call made by this module and the file stores.
+retries = RetryPolicy()
+
+#------------------------------------------------------------------------------
+
+class SingleFlight(object):
+    """Coalesces concurrent identical calls into a single one.
+
+    When a call is made while another one with the same key is still in
+    flight, the second caller doesn't make the call itself but waits for the
+    first one to finish, and gets the same return value or exception.
+
+    It's safe to share this object between threads.
+
+    @type calls: int
+    @ivar calls: Number of calls actually made.
+
+    @type coalesced: int
+    @ivar coalesced: Number of calls that waited for another identical call
+        instead of being made.
+    """
+
+    def __init__(self):
+        self.calls     = 0
+        self.coalesced = 0
+        self._flights  = dict()
+        self._lock     = threading.Lock()
+
+    def do(self, key, deadline, function, *args, **kwargs):
+        """Call a function, unless an identical call is already in flight.
+
+        @type  key: tuple
+        @param key: Identifies the call. Calls with the same key are expected
+            to return the same result.
+
+        @type  deadline: L{Deadline} or float
+        @param deadline: Time limit for waiting on another call, or C{None}.
+            It's not passed to the function, so include it in the arguments
+            if the function also takes it.
+
+        @type  function: callable
+        @param function: Function to call.
+
+        @return: The value returned by the function.
+
+        @raise DeadlineExceeded: The deadline expired while waiting for the
+            call in flight to finish.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = [threading.Event(), None, None]
+                self.calls = self.calls + 1
+                leader = True
+            else:
+                self.coalesced = self.coalesced + 1
+                leader = False
+        if not leader:
+            metrics.increment('coalesced_total', operation = key[0])
+
+        # Wait for the call in flight and share its results.
+        if not leader:
+            event = flight[0]
+            event.wait( as_deadline(deadline).remaining() )
+            if not event.is_set():
+                raise DeadlineExceeded("waiting for a request in flight")
+            if flight[2] is not None:
+                raise flight[2][0], flight[2][1], flight[2][2]
+            return flight[1]
+
+        # Make the call ourselves and wake up the callers waiting for it.
+        try:
+            flight[1] = function(*args, **kwargs)
+            return flight[1]
+        except:
+            flight[2] = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight[0].set()
+
+    def stats(self):
+        """
+        @rtype:  dict( str S{->} int )
+        @return: Number of calls made and coalesced.
+        """
+        with self._lock:
+            return {'calls': self.calls, 'coalesced': self.coalesced}
+
+# Coalesces concurrent calls to shorten or expand the same URL.
+inflight = SingleFlight()
+
+#------------------------------------------------------------------------------
+
+def shorturl(url, service='x90.es', deadline=None):
+    """Shorten a given URL.
+
+    >>> shorturl('http://www.example.com')
+    'http://x90.es/5CA'
+    >>> shorturl('http://x90.es/5CA', 'ito.mx')
+    'http://ito.mx/P-EL'
+    >>> shorturl('http://www.example.com', 'tinyurl.com')
+    'http://tinyurl.com/7567'
+    >>> shorturl('http://www.example.com', None)
+    'http://www.example.com'
+
+    @type  url: str
+    @param url: URL to shorten.
+
+    @type  service: str
+    @param service: Hostname of the URL shortener service.
+
+        See L{shorteners} for a list of supported services.
+
+        Use C{None} or an empty string to disable URL shortening
+        (returns the original URL).
+
+    @type  deadline: L{Deadline} or float
+    @param deadline: Time limit in seconds for the whole operation, or a
+        L{Deadline} object shared with other operations. Use C{None} to only
+        apply the per-call L{timeout}.
+
+    @rtype:  str
+    @return: Shortened URL. May be the same as the original URL.
+
+    @raise NotImplementedError: Unsupported or unknown URL shortener service.
+    @raise RuntimeError: The URL shortener API returned an error message.
+    @raise DeadlineExceeded: The deadline expired.
+    @raise urllib2.HTTPError: A network error occured while accessing the URL
+        shortener service.
+    """
+
+    return default_client.shorturl(url, service, deadline)
+
+def shorturl_many(urls, service = None, deadline = None, workers = 4,
+                  best = False):
+    """Shorten many URLs at the same time.
+
+    Repeated URLs are shortened only once. Each service gets its own pool
+    of threads, and the rate limits set with L{Client.set_rate_limit} are
+    honored. URLs are read from the input only as they can be sent, so it
+    can be an iterator over a very large list.
+
+    Each URL is shortened with a single service. When no service is given
+    the URLs are spread over all the healthy ones, fastest first, and each
+    URL that fails is sent to the next service. With the C{best} flag every
+    URL goes to the service that gives the shortest URLs instead, like
+    L{besturl} but without asking all of them.
+
+    >>> for url, short_url, error in shorturl_many(urls):
+    ...     print url, short_url or error
+
+    @type  urls: iterator of str
+    @param urls: URLs to shorten.
+
+    @type  service: str
+    @param service: Hostname of the URL shortener service to use, or
+        C{None} to use all of them. See L{shorteners}.
+
+    @type  deadline: L{Deadline} or float
+    @param deadline: Time limit in seconds for shortening all the URLs, or a
+        L{Deadline} object shared with other operations. Use C{None} to only
+        apply the per-call L{timeout}.
+
+    @type  workers: int
+    @param workers: Number of URLs sent at the same time to each service.
+
+    @type  best: bool
+    @param best: C{True} to shorten each URL with the service expected to
+        give the shortest result, C{False} to spread the URLs over all the
+        services. Ignored when a service is given.
+
+    @rtype:  iterator of tuple(str, str, Exception)
+    @return: Original URL, short URL and error for each different URL, in
+        the order they're finished. The short URL is C{None} on error, and
+        the error is C{None} on success.
+
+    @raise NotImplementedError: Unsupported or unknown URL shortener service.
+    """
+    return default_client.shorturl_many(urls, service, deadline, workers, best)
+
+#------------------------------------------------------------------------------
+
+class LinkIndex(object):
+    """Read only index of known short to long URL mappings, kept in a file
+    and memory mapped so it opens instantly, uses no memory of its own and
+    its pages are shared by every process that opens it.
+
+    Entries are fixed size records sorted by service and code, followed by
+    the long URLs. Lookups are a binary search on the records. New mappings
+    (for example those found by L{longurl} when the index is in use, see
+    L{links}) are added by L{merge}, which writes a new generation of the
+    index and replaces the old one atomically. Processes that still have the
+    old one open keep working with it.
+
+    It's safe to share the index between threads.
+
+    @type filename: str
+    @ivar filename: Name of the index file.
+
+    @type count: int
+    @ivar count: Number of mappings in the index.
+
+    @type services: list of str
+    @ivar services: Hostnames of the services, the position in the list is
+        the service id used in the records.
+
+    @type learned: dict(str S{->} str)
+    @ivar learned: Mappings found since the index was opened, not in the
+        index yet. See L{learn} and L{merge}.
+    """
+
+    magic   = 'SURLIDX1'
+    header  = struct.Struct('>8sIQQQ')   # magic, code size, count, offsets
+
+    def __init__(self, filename):
+        """
+        @type  filename: str
+        @param filename: Name of an index file created by L{build} or
+            L{merge}.
+
+        @raise ValueError: The file is not a valid index.
+        """
+        self.filename = filename
+        self.learned  = dict()
+        self._lock    = threading.Lock()
+        with open(filename, 'rb') as fd:
+            size = os.fstat(fd.fileno()).st_size
+            if size < self.header.size:
+                raise ValueError, "Invalid index file: %s" % filename
+            self._map = mmap.mmap(fd.fileno(), size, access = mmap.ACCESS_READ)
+        magic, self.code_size, self.count, records, strings = \
+                self.header.unpack_from(self._map, 0)
+        if magic != self.magic:
+            self._map.close()
+            raise ValueError, "Invalid index file: %s" % filename
+        names = self._map[ self.header.size : records ]
+        self.services = names.split('\n') if names else []
+        self._ids     = dict( (name, index)
+                              for index, name in enumerate(self.services) )
+        self._record  = struct.Struct('>H%dsQI' % self.code_size)
+        self._records = records
+        self._strings = strings
+
+    def close(self):
+        """Close the index file."""
+        self._map.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """
+        @rtype:  iterator of tuple(str, str)
+        @return: Short and long URL of each mapping in the index, sorted by
+            service and code.
+        """
+        for position in xrange(self.count):
+            service, code, target = self._entry(position)
+            yield 'http://%s/%s' % (self.services[service], code), target
+
+    def get(self, url):
+        """Look up a short URL, in the index or in the learned mappings.
+
+        @type  url: str
+        @param url: Short URL.
+
+        @rtype:  str
+        @return: Long URL, or C{None} if the short URL is not known.
+        """
+        target = self.learned.get(url)
+        if target is not None:
+            return target
+        key = self.key(url)
+        if key is None:
+            return None
+        low  = 0
+        high = self.count
+        size = self._record.size
+        base = self._records
+        keysize = len(key)
+        while low < high:
+            middle = (low + high) // 2
+            offset = base + middle * size
+            found  = self._map[ offset : offset + keysize ]
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return self._entry(middle)[2]
+        return None
+
+    def learn(self, url, target):
+        """Remember a mapping found while the index was in use, so it can be
+        added later with L{merge}.
+
+        @type  url: str
+        @param url: Short URL.
+
+        @type  target: str
+        @param target: Long URL.
+        """
+        with self._lock:
+            self.learned[url] = target
+
+    def key(self, url):
+        """
+        This is a private method and you shouldn't need to use it.
+
+        @rtype:  str
+        @return: Binary search key for the short URL, or C{None} if it can't
+            be in the index.
+        """
+        service, code = split_short_url(url)
+        service = self._ids.get(service)
+        if service is None or len(code) > self.code_size:
+            return None
+        return struct.pack('>H%ds' % self.code_size, service, code)
+
+    def _entry(self, position):
+        """
+        This is a private method and you shouldn't need to use it.
+
+        @rtype:  tuple(int, str, str)
+        @return: Service id, code and long URL of a record.
+        """
+        service, code, offset, length = self._record.unpack_from(
+                self._map, self._records + position * self._record.size )
+        offset = self._strings + offset
+        return service, code.rstrip('\0'), self._map[ offset : offset + length ]
+
+    def merge(self, mappings = None, filename = None):
+        """Write a new generation of the index with more mappings. New
+        mappings replace old ones for the same short URL.
+
+        @type  mappings: iterable of tuple(str, str)
+        @param mappings: Short and long URL pairs. Defaults to the L{learned}
+            mappings, which are cleared.
+
+        @type  filename: str
+        @param filename: Name of the new index file. Defaults to replacing
+            this one.
+
+        @rtype:  L{LinkIndex}
+        @return: New index.
+        """
+        if mappings is None:
+            with self._lock:
+                mappings, self.learned = self.learned, dict()
+            mappings = mappings.iteritems()
+        return self.build(filename or self.filename,
+                          itertools.chain(self, mappings))
+
+    @classmethod
+    def build(cls, filename, mappings):
+        """Create an index file. If the file exists it's replaced atomically.
+
+        Only the keys are kept in memory while building the index, the long
+        URLs are spooled to a temporary file.
+
+        @type  filename: str
+        @param filename: Name of the index file.
+
+        @type  mappings: iterable of tuple(str, str)
+        @param mappings: Short and long URL pairs. When the same short URL
+            appears more than once the last one wins.
+
+        @rtype:  L{LinkIndex}
+        @return: New index.
+        """
+        import tempfile
+        services = dict()
+        entries  = dict()
+        spool    = tempfile.TemporaryFile()
+        offset   = 0
+        for url, target in mappings:
+            service, code = split_short_url(url)
+            if not service or not code:
+                continue
+            spool.write(target)
+            entries[ (service, code) ] = (offset, len(target))
+            offset = offset + len(target)
+            services[service] = None
+        names = sorted(services)
+        ids   = dict( (name, index) for index, name in enumerate(names) )
+        code_size = max([ len(code) for service, code in entries ] or [1])
+        record    = struct.Struct('>H%dsQI' % code_size)
+        keys      = sorted( (ids[service], code) for service, code in entries )
+
+        # Copy the strings that are still used, in the order of the records.
+        temp = '%s.%d.tmp' % (filename, os.getpid())
+        names_data = '\n'.join(names)
+        records    = cls.header.size + len(names_data)
+        strings    = records + len(keys) * record.size
+        with open(temp, 'wb') as fd:
+            fd.write(cls.header.pack(cls.magic, code_size, len(keys),
+                                     records, strings))
+            fd.write(names_data)
+            position = 0
+            for service, code in keys:
+                spooled, length = entries[ (names[service], code) ]
+                fd.write(record.pack(service, code, position, length))
+                position = position + length
+            for service, code in keys:
+                spooled, length = entries[ (names[service], code) ]
+                spool.seek(spooled)
+                fd.write(spool.read(length))
+        spool.close()
+        os.rename(temp, filename)
+        return cls(filename)
+
+def split_short_url(url):
+    """
+    This is a private function and you shouldn't need to use it.
+
+    @rtype:  tuple(str, str)
+    @return: Service hostname and code of a short URL.
+    """
+    parsed = urlparse.urlsplit(url)
+    code   = url[ url.find(parsed[1]) + len(parsed[1]) : ].lstrip('/')
+    return parsed[1].lower(), code
+
+# Index of known links consulted by longurl(), or None.
+links = None
+
+#------------------------------------------------------------------------------
+
+def longurl(url, deadline = None):
+    """Expand a shortened URL.
+
+    >>> longurl('http://x90.es/5CA')
+    'http://www.example.com/'
+    >>> longurl('http://www.example.com/')
+    'http://www.example.com/'
+
+    @note: This function tries to expand any shortened URL by following it
+        rather than using the API. This means if the service has statistics,
+        each time it's expanded it counts a new click.
+
+    @type  url: str
+    @param url: Shortened URL to expand.
+
+    @type  deadline: L{Deadline} or float
+    @param deadline: Time limit in seconds for the whole operation, or a
+        L{Deadline} object shared with other operations. Use C{None} to only
+        apply the per-call L{timeout}.
+
+    @rtype:  str
+    @return: Expanded URL. May be the same as the original URL.
+
+    @raise NotImplementedError: Unsupported or unknown URL shortener service.
+    @raise DeadlineExceeded: The deadline expired.
+    @raise urllib2.HTTPError: A network error occured while accessing the URL
+        shortener service.
+    """
+
+    return default_client.longurl(url, deadline)
+
+class HTTPRedirectHandler(urllib2.HTTPRedirectHandler):
+    """Modified redirect handler to prevent urllib2 from automatically
+    following all redirection requests.
+
+    We want to stop at the first redirection leading to a non-shortened URL,
+    and so get the target URL. Making a request to the target itself is not
+    only redundant but potentially harmful.
+
+    Note that the original redirect handler provided by C{urllib2} already
+    takes care of avoiding loops and excessively long redirection chains.
+
+    The remaining time of the deadline is applied to each redirection.
+
+    This is a private class and you shouldn't need to use it.
+    """
+    def __init__(self, deadline = None, client = None):
+        self.deadline = as_deadline(deadline)
+        self.client   = client or default_client
+
+    def filter_shorturl_redirections(self, req, fp, code, msg, headers, method):
+        if 'location' in headers:
+            newurl = headers.getheaders('location')[0]
+        elif 'uri' in headers:
+            newurl = headers.getheaders('uri')[0]
+        else:
+            return
+
+        if self.client.verbose:
+            print "Found: %s" % newurl
+
+        # This only checks the hostname belongs to one of the supported services.
+        # If a malicious user finds a dangerous API call in one of them, we
+        # could be tricked into executing it by following a redirection.
+        # I can't think of any such dangerous call, though. :?
+        if not is_short_url(newurl):
+            return
+
+        # The redirection is made with the timeout of the original request,
+        # so update it with whatever time we have left.
+        req.timeout = self.deadline.timeout("following %s" % newurl,
+                                            self.client.timeout)
+        return method(self, req, fp, code, msg, headers)
+
+    def http_error_301(self, req, fp, code, msg, headers):
+        method = urllib2.HTTPRedirectHandler.http_error_301
+        self.filter_shorturl_redirections(req, fp, code, msg, headers, method)
+
+    def http_error_302(self, req, fp, code, msg, headers):
+        method = urllib2.HTTPRedirectHandler.http_error_302
+        self.filter_shorturl_redirections(req, fp, code, msg, headers, method)
+
+    def http_error_303(self, req, fp, code, msg, headers):
+        method = urllib2.HTTPRedirectHandler.http_error_303
+        self.filter_shorturl_redirections(req, fp, code, msg, headers, method)
+
+    def http_error_307(self, req, fp, code, msg, headers):
+        method = urllib2.HTTPRedirectHandler.http_error_307
+        self.filter_shorturl_redirections(req, fp, code, msg, headers, method)
+
+#------------------------------------------------------------------------------
+
+class ChainCache(object):
+    """Cache of the redirections found by L{expand_chain}.
+
+    Each entry maps a short URL to the status code of the redirection and the
+    URL it points to. The least recently used entries are dropped when the
+    cache grows beyond C{max_size} entries.
+
+    It's safe to share the cache between threads.
+
+    @type max_size: int
+    @ivar max_size: Maximum number of entries, or C{None} for no limit.
+
+    @type hits: int
+    @ivar hits: Number of lookups that found an entry.
+
+    @type misses: int
+    @ivar misses: Number of lookups that didn't find an entry.
+    """
+
+    def __init__(self, max_size = 100000):
+        self.max_size = max_size
+        self.hits     = 0
+        self.misses   = 0
+        self._edges   = collections.OrderedDict()
+        self._lock    = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._edges)
+
+    def get(self, url):
+        """
+        @type  url: str
+        @param url: Short URL.
+
+        @rtype:  tuple(int, str)
+        @return: Status code and target of the redirection, or C{None} if
+            the URL isn't in the cache.
+        """
+        with self._lock:
+            try:
+                edge = self._edges.pop(url)
+            except KeyError:
+                self.misses = self.misses + 1
+                edge = None
+            else:
+                self._edges[url] = edge
+                self.hits = self.hits + 1
+        if edge is None:
+            metrics.increment('cache_misses_total', cache = 'chains')
+        else:
+            metrics.increment('cache_hits_total', cache = 'chains')
+        return edge
+
+    def put(self, url, code, target):
+        """
+        @type  url: str
+        @param url: Short URL.
+
+        @type  code: int
+        @param code: Status code of the redirection.
+
+        @type  target: str
+        @param target: Target of the redirection.
+        """
+        with self._lock:
+            self._edges.pop(url, None)
+            self._edges[url] = (code, target)
+            if self.max_size is not None:
+                while len(self._edges) > self.max_size:
+                    self._edges.popitem(last = False)
+
+    def clear(self):
+        """Remove all the entries."""
+        with self._lock:
+            self._edges.clear()
+
+# Redirections found by expand_chain(), shared by all calls.
+chains = ChainCache()
+
+def expand_chain(url, deadline = None, cache = None):
+    """Expand a shortened URL, returning every hop in the redirection chain.
+
+    >>> expand_chain('http://x90.es/5CA')
+    [('http://x90.es/5CA', 301), ('http://www.example.com/', None)]
+
+    Only URLs of known services are requested, like in L{longurl}. Each
+    redirection found is kept in the cache, so expanding chains that share
+    intermediate hops only requests the hops not seen before.
+
+    @type  url: str
+    @param url: Shortened URL to expand.
+
+    @type  deadline: L{Deadline} or float
+    @param deadline: Time limit in seconds for the whole chain, or a
+        L{Deadline} object shared with other operations. Use C{None} to only
+        apply the per-call L{timeout}.
+
+    @type  cache: L{ChainCache}
+    @param cache: Cache of redirections. Defaults to L{chains}.
+
+    @rtype:  list of tuple(str, int)
+    @return: Each URL in the chain and the status code it returned. The last
+        URL is the expanded one. Its status code is C{None} if it wasn't
+        requested, which is always the case unless it's a short URL that
+        doesn't redirect anywhere.
+
+    @raise RuntimeError: A redirection loop was found, or the chain is too
+        long.
+    @raise DeadlineExceeded: The deadline expired.
+    @raise urllib2.HTTPError: A network error occured while accessing the URL
+        shortener service.
+    """
+    return default_client.expand_chain(url, deadline, cache)
+
+def request_redirection(url, deadline = None, stage = 'expanding a URL'):
+    """Request a URL without following the redirection it returns.
+
+    This is a private function and you shouldn't need to use it.
+
+    @see: L{expand_chain}
+
+    @rtype:  tuple(int, str)
+    @return: Status code and redirection target. The target is C{None} if
+        the response wasn't a redirection.
+
+    @raise urllib2.HTTPError: The response was an error.
+    """
+    return default_client.request_redirection(url, deadline, stage)
+
+class HTTPNoRedirectHandler(urllib2.HTTPRedirectHandler):
+    """Redirect handler that doesn't follow any redirection, so the response
+    is raised as an C{urllib2.HTTPError} exception instead.
+
+    This is a private class and you shouldn't need to use it.
+    """
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+#------------------------------------------------------------------------------
+
+def besturl(url, deadline = None):
+    """Shorten the URL with the service that produces the best result.
+
+    >>> besturl('http://www.example.com/')
+    'http://x90.es/5CZ'
+
+    @type  url: str
+    @param url: URL to shorten.
+
+    @type  deadline: L{Deadline} or float
+    @param deadline: Time limit in seconds for trying all the candidate
+        services, or a L{Deadline} object shared with other operations.
+        Use C{None} to only apply the per-call L{timeout}.
+
+    @rtype:  str
+    @return: Shortened URL. May be the same as the original URL.
+
+    @raise DeadlineExceeded: The deadline expired.
+    """
+    return default_client.besturl(url, deadline)
+
+#------------------------------------------------------------------------------
+
+class Hedger(object):
+    """Hedges calls to URL shortener services to cut down tail latency.
+
+    The URL is sent to the first candidate service. If no answer arrives
+    within the usual response time of that service (at the given percentile),
+    the same URL is also sent to the next candidate, and so on up to
+    C{max_hedges} times. The first valid short URL wins and the requests
+    still in flight are abandoned. When a request fails the next candidate
+    is tried right away.
+
+    It's safe to share this object between threads.
+
+    @type percentile: float
+    @ivar percentile: Percentile of the response time of the primary service
+        to wait before sending a hedged request.
+
+    @type min_delay: float
+    @ivar min_delay: Minimum time to wait before sending a hedged request.
+
+    @type max_hedges: int
+    @ivar max_hedges: Maximum number of hedged requests per call.
+
+    @type calls: int
+    @ivar calls: Number of hedged calls made.
+
+    @type hedges: int
+    @ivar hedges: Number of hedged requests sent.
+
+    @type wins: int
+    @ivar wins: Number of calls won by a hedged request rather than the
+        primary one.
+
+    @type client: L{Client}
+    @ivar client: Client used to make the requests and get the response
+        times of the services. C{None} to use L{default_client}.
+    """
+
+    def __init__(self, percentile = 0.95, min_delay = 0.05, max_hedges = 1,
+                 client = None):
+        self.percentile = percentile
+        self.min_delay  = min_delay
+        self.max_hedges = max_hedges
+        self.client     = client
+        self.calls      = 0
+        self.hedges     = 0
+        self.wins       = 0
+        self._lock      = threading.Lock()
+
+    def delay(self, service):
+        """
+        @type  service: str
+        @param service: Hostname of the URL shortener service.
+
+        @rtype:  float
+        @return: Time to wait for the service before hedging.
+        """
+        client = self.client or default_client
+        return max(self.min_delay,
+                   client.health.latency_percentile(service, self.percentile))
+
+    def shorturl(self, url, services, deadline = None, called = None):
+        """Shorten a URL with the first service that answers.
+
+        @type  url: str
+        @param url: URL to shorten.
+
+        @type  services: list of str
+        @param services: Candidate services, in order of preference.
+
+        @type  deadline: L{Deadline} or float
+        @param deadline: Time limit in seconds, or a L{Deadline} object.
+
+        @type  called: list of str
+        @param called: Optional list where the services that were actually
+            called are appended, whether they won or not.
+
+        @rtype:  tuple(str, str)
+        @return: Shortened URL and the service that produced it.
+
+        @raise RuntimeError: No service could shorten the URL.
+        @raise DeadlineExceeded: The deadline expired.
+        @raise urllib2.HTTPError: A network error occured in the last service
+            we tried, and all the previous ones failed too.
+        """
+        deadline = as_deadline(deadline)
+        client   = self.client or default_client
+        if called is None:
+            called = []
+        candidates = list(services)
+        if not candidates:
+            raise RuntimeError, "No URL shortener services to try"
+        results = Queue.Queue()
+
+        def attempt(service):
+            try:
+                results.put( (service, client.shorturl(url, service, deadline),
+                              None) )
+            except Exception, e:
+                results.put( (service, None, e) )
+
+        def launch():
+            service = candidates.pop(0)
+            called.append(service)
+            if client.verbose:
+                print "Service: %s" % service
+            thread = threading.Thread(target = attempt, args = (service,))
+            thread.daemon = True
+            thread.start()
+            return service
+
+        with self._lock:
+            self.calls = self.calls + 1
+        primary     = launch()
+        outstanding = 1
+        hedges      = 0
+        error       = None
+        while outstanding:
+
+            # Wait for the next answer, but not longer than the usual response
+            # time of the primary service if we can still hedge.
+            can_hedge = candidates and hedges < self.max_hedges
+            wait = deadline.remaining()
+            if can_hedge:
+                delay = self.delay(primary)
+                if wait is None or delay < wait:
+                    wait = delay
+            if wait is not None and wait <= 0:
+                raise DeadlineExceeded("shortening with %s" % ', '.join(called))
+            try:
+                service, short_url, e = results.get(True, wait)
+            except Queue.Empty:
+                if can_hedge:
+                    launch()
+                    outstanding = outstanding + 1
+                    hedges = hedges + 1
+                    with self._lock:
+                        self.hedges = self.hedges + 1
+                    metrics.increment('hedges_total', service = called[-1])
+                continue
+            outstanding = outstanding - 1
+
+            # The first valid short URL wins.
+            if e is None and short_url != url:
+                if service != primary:
+                    with self._lock:
+                        self.wins = self.wins + 1
+                    metrics.increment('hedge_wins_total', service = service)
+                return short_url, service
+
+            # On errors go on with the next candidate.
+            if e is None:
+                e = RuntimeError("URL not shortened by %s" % service)
+            if isinstance(e, DeadlineExceeded):
+                raise e
+            error = e
+            if not outstanding and candidates:
+                primary     = launch()
+                outstanding = 1
+        raise error
+
+    def stats(self):
+        """
+        @rtype:  dict( str S{->} int or float )
+        @return: Number of hedged calls, hedged requests sent, calls won by
+            hedged requests, and the hedge rate (hedged requests per call).
+        """
+        with self._lock:
+            rate = 0.0
+            if self.calls:
+                rate = float(self.hedges) / self.calls
+            return {'calls': self.calls, 'hedges': self.hedges,
+                    'wins': self.wins, 'hedge_rate': rate}
+
+# Hedges the hops of hideurl() when requested.
+hedger = Hedger()
+
+#------------------------------------------------------------------------------
+
+def hideurl(url, hops = 2, deadline = None, hedge = False):
+    """Hide an URL behind any given number of shorteners.
+    The shorteners are never repeated. Services known to be down are skipped,
+    and the rest are tried fastest first (services with no statistics yet
+    are chosen randomly).
+
+    This can defeat some URL expander browser plugins, however the L{longurl}
+    function should still be able to retrieve the original URL.
+
+    @type  url: str
+    @param url: URL to shorten.
+
+    @type  hops: int
+    @param hops: How many times should the URL be shortened.
+        Must be greater or equal than C{2}.
+
+    @type  deadline: L{Deadline} or float
+    @param deadline: Time limit in seconds for all the hops, or a L{Deadline}
+        object shared with other operations. Use C{None} to only apply the
+        per-call L{timeout}.
+
+    @type  hedge: bool
+    @param hedge: C{True} to hedge each hop using L{hedger}: if a service is
+        slower than usual to answer, the next one is also tried and the first
+        answer wins. Services are never repeated either way.
+
+    @rtype:  str
+    @return: Shortened URL.
+
+    @raise ValueError: Too few or too many hops specified.
+    @raise DeadlineExceeded: The deadline expired.
+    @raise urllib2.HTTPError: A network error occured while accessing the URL
+        shortener service.
+    """
+    return default_client.hideurl(url, hops, deadline, hedge)
+
+#------------------------------------------------------------------------------
+
+class RateLimiter(object):
+    """Token bucket limiting how often requests are sent to a service.
+
+    Each request takes a token. Tokens come back at C{rate} per second, and
+    up to C{burst} of them can be saved while the service is idle. Requests
+    made when there are no tokens left wait for the next one.
+
+    It's safe to share this object between threads.
+
+    @type rate: float
+    @ivar rate: Requests allowed per second.
+
+    @type burst: int
+    @ivar burst: Maximum number of requests sent back to back.
+
+    @type waits: int
+    @ivar waits: Number of requests that had to wait for a token.
+    """
+
+    def __init__(self, rate, burst = 1):
+        self.rate    = float(rate)
+        self.burst   = burst
+        self.waits   = 0
+        self._tokens = float(burst)
+        self._last   = time.time()
+        self._lock   = threading.Lock()
+
+    def acquire(self, deadline = None, stage = 'waiting for the rate limit'):
+        """Take a token, waiting for it if needed.
+
+        @type  deadline: L{Deadline} or float
+        @param deadline: Time limit for the wait, or C{None}.
+
+        @type  stage: str
+        @param stage: Description of what we're waiting for.
+
+        @raise DeadlineExceeded: The deadline would expire before getting a
+            token.
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last   = now
+            self._tokens = self._tokens - 1.0
+            if self._tokens >= 0:
+                return
+            self.waits = self.waits + 1
+
+            # The token is already taken, later callers wait after us.
+            delay = -self._tokens / self.rate
+        try:
+            as_deadline(deadline).sleep(delay, stage)
+        except DeadlineExceeded:
+            with self._lock:
+                self._tokens = self._tokens + 1.0
+            raise
+
+#------------------------------------------------------------------------------
+
+class Client(object):
+    """Shortens and expands URLs with its own configuration and state.
+
+    Each client has its own connection pool, service health statistics,
+    retry policy, caches and rate limits, so workloads tuned differently can
+    run at the same time in one process without interfering with each other.
+    The functions of this module are shortcuts to the methods of
+    L{default_client}, which is configured by the global variables of this
+    module instead.
+
+    It's safe to share a client between threads. Only the L{metrics} are
+    shared by all clients.
+
+    @type timeout: float
+    @ivar timeout: Timeout in seconds for each network call.
+
+    @type keepalive: bool
+    @ivar keepalive: C{True} to send the HTTP requests over persistent
+        connections kept in L{connections}.
+
+    @type verbose: bool
+    @ivar verbose: C{True} to print debug messages.
+
+    @type links: L{LinkIndex}
+    @ivar links: Index of known links consulted by L{longurl}, or C{None}.
+
+    @type health: L{HealthRegistry}
+    @ivar health: Health statistics for each service.
+
+    @type retries: L{RetryPolicy}
+    @ivar retries: Retry policy for every network call.
+
+    @type inflight: L{SingleFlight}
+    @ivar inflight: Coalesces concurrent calls for the same URL.
+
+    @type chains: L{ChainCache}
+    @ivar chains: Redirections found by L{expand_chain}.
+
+    @type hedger: L{Hedger}
+    @ivar hedger: Sends the hedged requests of L{hideurl}.
+
+    @type connections: L{ConnectionPool}
+    @ivar connections: Persistent connections, used when L{keepalive} is
+        enabled.
+
+    @type rate_limits: dict( str S{->} L{RateLimiter} )
+    @ivar rate_limits: Rate limit of each service. Services not found here
+        aren't limited.
+    """
+
+    def __init__(self, timeout = 10.0, keepalive = False, verbose = False,
+                 links = None, health = None, retries = None, inflight = None,
+                 chains = None, hedger = None, connections = None,
+                 rate_limits = None):
+        """
+        The state objects not given are created for this client alone.
+
+        @type  rate_limits: dict( str S{->} float )
+        @param rate_limits: Maximum requests per second to send to each
+            service, or C{None} for no limits. See L{set_rate_limit}.
+        """
+        self.timeout     = timeout
+        self.keepalive   = keepalive
+        self.verbose     = verbose
+        self.links       = links
+        if health is None:
+            health = HealthRegistry()
+        if retries is None:
+            retries = RetryPolicy()
+        if inflight is None:
+            inflight = SingleFlight()
+        if chains is None:
+            chains = ChainCache()
+        if hedger is None:
+            hedger = Hedger(client = self)
+        if connections is None:
+            connections = ConnectionPool()
+        self.health      = health
+        self.retries     = retries
+        self.inflight    = inflight
+        self.chains      = chains
+        self.hedger      = hedger
+        self.connections = connections
+        self.rate_limits = dict()
+        if rate_limits:
+            for service, rate in rate_limits.iteritems():
+                self.set_rate_limit(service, rate)
+
+    def set_rate_limit(self, service, rate, burst = 1):
+        """Limit how often requests are sent to a service.
+
+        @type  service: str
+        @param service: Hostname of the service.
+
+        @type  rate: float
+        @param rate: Maximum requests per second, or C{None} for no limit.
+
+        @type  burst: int
+        @param burst: Maximum number of requests sent back to back.
+        """
+        service = service.lower()
+        if rate is None:
+            self.rate_limits.pop(service, None)
+        else:
+            self.rate_limits[service] = RateLimiter(rate, burst)
+
+    def throttle(self, service, deadline = None, stage = 'sending a request'):
+        """Wait until the rate limit of the service allows another request.
+
+        This is a private method and you shouldn't need to use it.
+        """
+        limiter = self.rate_limits.get(service)
+        if limiter is not None:
+            limiter.acquire(deadline, "%s (rate limited)" % stage)
+
+    def build_opener(self, *handlers):
+        """Build a URL opener with the given handlers, sending the requests
+        over the pooled connections of this client when L{keepalive} is
+        enabled.
+
+        This is a private method and you shouldn't need to use it.
+
+        @rtype:  urllib2.OpenerDirector
+        @return: URL opener.
+        """
+        if self.keepalive:
+            handlers = handlers + ( HTTPKeepAliveHandler(self.connections), )
+        return urllib2.build_opener(*handlers)
+
+    def open_url(self, url, data = None, deadline = None,
+                 stage = 'sending a request', opener = None, limit = None):
+        """Send an HTTP request with the settings of this client. The
+        per-call timeout defaults to the L{timeout} of this client.
+
+        This is a private method and you shouldn't need to use it.
+
+        @see: L{open_url}
+        """
+        if opener is None:
+            opener = self.build_opener()
+        if limit is None:
+            limit = self.timeout
+        return open_url(url, data, deadline, stage, opener, limit)
+
+    def shorturl(self, url, service = 'x90.es', deadline = None):
+        """
+        @see: L{shorturl}
+        """
+
+        # Null service, return the original URL.
+        if not service:
+            return url
+
+        # Check the requested service is supported.
+        service = service.lower()
+        if service not in shorteners:
+            raise NotImplementedError, "Unknown URL shortener service: %s" % service
+
+        # Call the URL shortener API, unless another thread is already doing it.
+        return self.inflight.do( ('shorten', service, url), deadline,
+                                 self.call_shortener_api, url, service, deadline )
+
+    def shorturl_many(self, urls, service = None, deadline = None,
+                      workers = 4, best = False):
+        """
+        @see: L{shorturl_many}
+        """
+        deadline = as_deadline(deadline)
+        if service:
+            service = service.lower()
+            if service not in shorteners:
+                raise NotImplementedError, "Unknown URL shortener service: %s" % service
+
+        # Each service gets its own queue and pool of threads, started the
+        # first time a URL is sent to it.
+        results = Queue.Queue()
+        queues  = dict()
+        busy    = dict()
+        threads = list()
+        def work(name, tasks):
+            while 1:
+                task = tasks.get()
+                if task is None:
+                    return
+                url, tried = task
+                try:
+                    results.put( (name, url, tried,
+                                  self.shorturl(url, name, deadline), None) )
+                except Exception, e:
+                    results.put( (name, url, tried, None, e) )
+        def dispatch(name, url, tried):
+            if name not in queues:
+                queues[name] = Queue.Queue()
+                busy[name]   = 0
+                for number in xrange(workers):
+                    thread = threading.Thread(target = work,
+                                              args = (name, queues[name]))
+                    thread.daemon = True
+                    thread.start()
+                    threads.append( (thread, queues[name]) )
+            busy[name] = busy[name] + 1
+            queues[name].put( (url, tried) )
+
+        # Pick the service for a URL. Without a best choice, it's the
+        # fastest one with a free thread, so the load is spread over all of
+        # them. Otherwise it's the one with the shortest hostname, like
+        # besturl() would find out after trying them all. Failed URLs are
+        # sent to the next candidate.
+        def pick(tried):
+            if service:
+                candidates = [service]
+            else:
+                candidates = self.health.rank(shorteners) or sorted(shorteners)
+                if best:
+                    candidates = sorted(candidates, key = len)
+            candidates = [ name for name in candidates if name not in tried ]
+            if not candidates:
+                return None
+            if best or service:
+                return candidates[0]
+            for name in candidates:
+                if busy.get(name, 0) < workers:
+                    return name
+            return min(candidates, key = lambda name: busy.get(name, 0))
+
+        # Keep a bounded number of URLs in flight, so the input can be an
+        # iterator over a huge list.
+        if service:
+            limit = workers * 2
+        else:
+            limit = workers * len(shorteners) * 2
+        seen      = set()
+        items     = iter(urls)
+        pending   = 0
+        exhausted = False
+        try:
+            while 1:
+                while not exhausted and pending < limit:
+                    try:
+                        url = items.next()
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if url in seen:
+                        continue
+                    seen.add(url)
+                    dispatch(pick(()), url, ())
+                    pending = pending + 1
+                if not pending:
+                    break
+                name, url, tried, short_url, error = results.get()
+                busy[name] = busy[name] - 1
+                if error is not None and not isinstance(error, DeadlineExceeded):
+                    if self.verbose:
+                        print "Error shortening %s with %s: %s" % (url, name, error)
+                    tried = tried + (name,)
+                    name  = pick(tried)
+                    if name is not None:
+                        dispatch(name, url, tried)
+                        continue
+                pending = pending - 1
+                yield url, short_url, error
+
+            # All the threads are idle by now, wait for them to go away.
+            for thread, tasks in threads:
+                tasks.put(None)
+            for thread, tasks in threads:
+                thread.join()
+            threads = list()
+        finally:
+            for thread, tasks in threads:
+                tasks.put(None)
+
+    def call_shortener_api(self, url, service, deadline = None):
+        """Call the API of a URL shortener service, retrying on transient
+        errors and keeping track of the service health.
+
+        This is a private method and you shouldn't need to use it.
+
+        @see: L{shorturl}
+        """
+        deadline = as_deadline(deadline)
+        stage    = "shortening with %s" % service
+
+        # Running out of time isn't the service's fault, so that's not recorded.
+        def attempt():
+            self.throttle(service, deadline, stage)
+            start = time.time()
+            try:
+                short_url = self.request_short_url(url, service, deadline)
+            except DeadlineExceeded, e:
+                metrics.request(service, 'shorten', time.time() - start, e)
+                raise
+            except Exception, e:
+                elapsed = time.time() - start
+                self.health.record_failure(service, e, elapsed)
+                metrics.request(service, 'shorten', elapsed, e)
+                raise
+            elapsed = time.time() - start
+            self.health.record_success(service, elapsed)
+            metrics.request(service, 'shorten', elapsed)
+            return short_url
+
+        return self.retries.call(attempt, deadline, stage, service, 'shorten',
+                                 self.verbose)
+
+    def request_short_url(self, url, service, deadline = None):
+        """Call the API of a URL shortener service.
+
+        This is a private method and you shouldn't need to use it.
+
+        @see: L{shorturl}
+        """
+
+        # Call the URL shortener API.
+        deadline = as_deadline(deadline)
+        stage    = "shortening with %s" % service
+        response = self.open_url(api[service] % urllib2.quote(url),
+                                 deadline = deadline, stage = stage)
+        headers  = response.info()
+        data     = read_response(response, deadline, stage, self.timeout)
+
+        # Fail if no data is returned.
+        if not data:
+            raise RuntimeError, "No data returned by URL shortener API"
+
+        # Decode the data if needed.
+        if headers['Content-Type'] == 'application/x-www-form-urlencoded':
+            data = urllib2.unquote(data)
+        data = data.strip() # some services add newlines and crap
+
+        # The service may have decided the URL couldn't be shortened further.
+        # I don't like this behavior but I can't help it.
+        if data != url:
+
+            # If it's neither a short URL nor the original URL, must be an error.
+            if not is_short_url(data):
+                raise RuntimeError, data
+
+            # It may be tempting to check here if the resulting URL isn't
+            # actually longer, but it's best to let the user decide that.
+            url = data
+
+        # Return the short URL, or the original URL if it couldn't be shortened.
+        return url
 
-__all__ = ['shorturl', 'longurl', 'hideurl', 'besturl', 'is_short_url', 'shorteners']
+    def longurl(self, url, deadline = None):
+        """
+        @see: L{longurl}
+        """
 
-import random
-import urllib2
-import urlparse
-import optparse
+        # Don't try to expand URLs for services we don't know.
+        # An HTTP GET to an arbitrary location could have unwanted side effects.
+        if is_short_url(url):
 
-#------------------------------------------------------------------------------
+            # Look it up in the index of known links first.
+            index = self.links
+            if index is not None:
+                target = index.get(url)
+                if target is not None:
+                    return target
 
-# Global verbose flag.
-verbose = False
+            # Follow the redirections, unless another thread is already doing it.
+            target = self.inflight.do( ('expand', url), deadline,
+                                       self.follow_short_url, url, deadline )
+            if index is not None and target != url:
+                index.learn(url, target)
+            url = target
 
-# Currently supported URL shortener services.
-# All of them issue an HTTP GET request and expect a simple text response.
-api = {
-    'is.gd'         :   'http://is.gd/api.php?longurl=%s',
-    'ito.mx'        :   'http://ito.mx/?module=ShortURL&file=Add&mode=API&url=%s',
-    'migre.me'      :   'http://migre.me/api.txt?url=%s',
-    'ta.gd'         :   'http://tinyarro.ws/api-create.php?host=ta.gd&suggest=_nounicode&utfpure=1&url=%s',
-    'tinyurl.com'   :   'http://tinyurl.com/api-create.php?url=%s',
-    'x90.es'        :   'http://x90.es/api.php?action=shorturl&format=simple&url=%s',
-    'xrl.us'        :   'http://metamark.net/api/rest/simple?long_url=%s',
-
-#------------------------------------#
-# Unsupported URL shortener services #
-#------------------------------------#
-
-# These used to work when this library was first published, but have since
-# either changed or deprecated their public APIs or made them authenticated.
-#'    bit.ly'        :   'http://bit.ly/api?url=%s',
-#    'cli.gs'        :   'http://cli.gs/api/v1/cligs/create?appid=urlshorten.py&url=%s',
-#    'cru.ms'        :   'http://cru.ms/?module=ShortURL&file=Add&mode=API&url=%s',
-
-# These used to work when this library was first published, but no longer exist.
-#    'easyuri.com'   :   'http://easyuri.com/api.php?link=%s',
-#    'kl.am'         :   'http://kl.am/api/shorten/?url=%s&format=text',
-#    'onodot.com'    :   'http://onodot.com/api.php?url=%s',
-#    'shrten.com'    :   'http://shrten.com/api?url=%s',
-#    'www.thisurl.com':  'http://www.thisurl.com/?module=ShortURL&file=Add&mode=API&url=%s',
-#    'www.piurl.com' :   'http://www.piurl.com/api.php?url=%s',
-#    'pra.im'        :   'http://pra.im/api.php?url=%s',
-#    'snick.me'      :   'http://snick.me/api/create.text?url=%s',
-#    'thurly.net'    :   'http://thurly.net/api.php?id=%s',
-#    'tr.im'         :   'http://api.tr.im/v1/trim_simple?url=%s',
-#    'u.nu'          :   'http://u.nu/unu-api-simple?url=%s',
-#    'urlz.at'       :   'http://urlz.at/yourls-api.php?action=shorturl&format=simple&url=%s',
-#    'zi.ma'         :   'http://zi.ma/?module=ShortURL&file=Add&mode=API&url=%s',
-
-}
-
-# Exported the service names only and keep the API strings private.
-shorteners = set( api.keys() )
+        # Return the URL as far as we could expand it.
+        return url
 
-#------------------------------------------------------------------------------
+    def follow_short_url(self, url, deadline = None):
+        """Follow the redirections of a short URL, retrying on transient
+        errors.
 
-def is_short_url(url):
-    """Determine if the given URL was shortened using one of the supported URL
-    shortener services.
+        This is a private method and you shouldn't need to use it.
 
-    >>> is_short_url('http://x90.es/5CA')
-    True
-    >>> is_short_url('http://www.example.com/')
-    False
+        @see: L{longurl}
+        """
+        service = url_host(url)
+        return self.retries.call(lambda: self.follow_redirections(url, deadline),
+                                 deadline, "expanding %s" % url, service,
+                                 'expand', self.verbose)
 
-    @type  url: str
-    @param url: URL to query.
+    def follow_redirections(self, url, deadline = None):
+        """Follow the redirections of a short URL.
 
-    @rtype:  bool
-    @return: C{True} if the URL was shortened, C{False} otherwise.
-    """
+        This is a private method and you shouldn't need to use it.
 
-    # This only checks the hostname belongs to one of the supported services.
-    # It could be improved by checking the URL against a regular expression.
-    return urlparse.urlparse(url)[1].lower() in shorteners
+        @see: L{longurl}
+        """
 
-#------------------------------------------------------------------------------
+        # Build an opener with our customized redirect handler, then use it to
+        # follow all redirections leading to known URL shortening services.
+        deadline = as_deadline(deadline)
+        opener   = self.build_opener( HTTPRedirectHandler(deadline, self) )
+        service  = url_host(url)
+        stage    = "expanding %s" % url
+        self.throttle(service, deadline, stage)
+        start    = time.time()
+        try:
+            try:
+                self.open_url(url, deadline = deadline, opener = opener,
+                              stage = stage)
+            except urllib2.HTTPError, e:
 
-def shorturl(url, service='x90.es'):
-    """Shorten a given URL.
+                # Keep the relocation target.
+                if e.headers.has_key('Location'):
+                    url = e.headers['Location']
+                elif e.headers.has_key('URI'):
+                    url = e.headers['URI']
 
-    >>> shorturl('http://www.example.com')
-    'http://x90.es/5CA'
-    >>> shorturl('http://x90.es/5CA', 'ito.mx')
-    'http://ito.mx/P-EL'
-    >>> shorturl('http://www.example.com', 'tinyurl.com')
-    'http://tinyurl.com/7567'
-    >>> shorturl('http://www.example.com', None)
-    'http://www.example.com'
+                # If no relocation target was given, it's a real error.
+                else:
+                    raise
+        except Exception, e:
+            metrics.request(service, 'expand', time.time() - start, e)
+            raise
+        metrics.request(service, 'expand', time.time() - start)
 
-    @type  url: str
-    @param url: URL to shorten.
+        # Return the URL as far as we could expand it.
+        return url
 
-    @type  service: str
-    @param service: Hostname of the URL shortener service.
+    def expand_chain(self, url, deadline = None, cache = None):
+        """
+        @see: L{expand_chain}
+        """
+        if cache is None:
+            cache = self.chains
+        deadline = as_deadline(deadline)
+        limit    = HTTPRedirectHandler.max_redirections
+        chain    = []
+        visited  = set()
+        while is_short_url(url):
+            if url in visited:
+                raise RuntimeError, "Redirection loop found at %s" % url
+            if len(chain) > limit:
+                raise RuntimeError, "Too many redirections: %s" % chain[0][0]
+            visited.add(url)
 
-        See L{shorteners} for a list of supported services.
+            # Use the cached redirection if we have one, or make the request.
+            edge = cache.get(url)
+            if edge is None:
+                stage   = "expanding hop %d (%s)" % (len(chain) + 1, url)
+                service = url_host(url)
+                request = lambda: self.request_redirection(url, deadline, stage)
+                code, target = self.inflight.do( ('hop', url), deadline,
+                                                 self.retries.call, request,
+                                                 deadline, stage, service,
+                                                 'expand', self.verbose )
+                if target is not None:
+                    cache.put(url, code, target)
+            else:
+                code, target = edge
+            chain.append( (url, code) )
 
-        Use C{None} or an empty string to disable URL shortening
-        (returns the original URL).
+            # The chain ends at short URLs that don't redirect anywhere.
+            if target is None:
+                return chain
+            if self.verbose:
+                print "Found: %s" % target
+            url = target
 
-    @rtype:  str
-    @return: Shortened URL. May be the same as the original URL.
+        # The last URL isn't requested, like in longurl().
+        chain.append( (url, None) )
+        return chain
 
-    @raise NotImplementedError: Unsupported or unknown URL shortener service.
-    @raise RuntimeError: The URL shortener API returned an error message.
-    @raise urllib2.HTTPError: A network error occured while accessing the URL
-        shortener service.
-    """
+    def request_redirection(self, url, deadline = None,
+                            stage = 'expanding a URL'):
+        """Request a URL without following the redirection it returns.
+
+        This is a private method and you shouldn't need to use it.
+
+        @see: L{request_redirection}
+        """
+        opener  = self.build_opener( HTTPNoRedirectHandler() )
+        service = url_host(url)
+        self.throttle(service, deadline, stage)
+        start   = time.time()
+        try:
+            try:
+                response = self.open_url(url, deadline = deadline,
+                                         opener = opener, stage = stage)
+            except urllib2.HTTPError, e:
+                if e.headers is not None:
+                    if e.headers.has_key('Location'):
+                        target = e.headers['Location']
+                    elif e.headers.has_key('URI'):
+                        target = e.headers['URI']
+                    else:
+                        raise
+                    metrics.request(service, 'expand', time.time() - start)
+                    return e.code, urlparse.urljoin(url, target)
+                raise
+        except Exception, e:
+            metrics.request(service, 'expand', time.time() - start, e)
+            raise
+        metrics.request(service, 'expand', time.time() - start)
+        response.close()
+        return response.getcode(), None
+
+    def besturl(self, url, deadline = None):
+        """
+        @see: L{besturl}
+        """
+        deadline = as_deadline(deadline)
+
+        # Try the fastest services first, skipping the ones known to be down.
+        # If all services seem to be down, try them all anyway.
+        # Services whose hostname is too long to beat the best result so far
+        # are known to be bad choices beforehand, so we don't try them either.
+        shorteners_list = self.health.rank(shorteners)
+        if not shorteners_list:
+            shorteners_list = list( shorteners )
+        best = url
+        for service in shorteners_list:
+            if len(best) < len(service) + 8:    # +8 because it's "http://service/"
+                continue
+            if self.verbose:
+                print "Service: %s" % service
+            try:
+                current = self.shorturl(url, service, deadline)
+            except DeadlineExceeded:
+                raise
+            except Exception:
+                continue
+            if len(best) > len(current):
+                best = current
+        return best
+
+    def hideurl(self, url, hops = 2, deadline = None, hedge = False):
+        """
+        @see: L{hideurl}
+        """
+
+        # Since less than 2 hops don't hide, I flag this as an error.
+        # That way I can make sure the returned URL is always hidden.
+        if hops < 2:
+            raise ValueError, "Too few hops: %i (min is 2)" % hops
+        deadline = as_deadline(deadline)
+
+        # Make a list of the available shorteners, fastest first.
+        # If there aren't enough of them for all the hops, the services that
+        # seem to be down go last, in random order, rather than calling the
+        # same service twice in a row.
+        shorteners_list = self.health.rank(shorteners)
+        if len(shorteners_list) < hops:
+            fallback = [ service for service in shorteners
+                         if service not in shorteners_list ]
+            random.shuffle(fallback)
+            shorteners_list.extend(fallback)
+
+        # Iterate the list. Since it had no repetitions there's no way we can
+        # accidentally call the API of the same service twice.
+        index = 0
+        total = len(shorteners_list)
+        error = 0
+        count = hops
+        while hops > 0:
+
+            # Try to call a shortener for this hop.
+            # When hedging, the next services in the list may be called too.
+            # Skip all the services that were called, whether they won or not.
+            try:
+                if hedge:
+                    called = []
+                    try:
+                        new_url, service = self.hedger.shorturl(url,
+                                    shorteners_list[index:], deadline, called)
+                    finally:
+                        index = index + len(called)
+                        if index >= total:
+                            index = 0
+                else:
+                    service = shorteners_list[index]
+                    index = index + 1
+                    if index >= total:
+                        index = 0
+                    if self.verbose:
+                        print "Service: %s" % service
+                    new_url = self.shorturl(url, service, deadline)
 
-    # Null service, return the original URL.
-    if not service:
+            # Stop on HTTP errors to avoid looping forever.
+            except urllib2.HTTPError:
+                raise
+
+            # Say which hop ran out of time.
+            except DeadlineExceeded, e:
+                raise DeadlineExceeded("%s (hop %d of %d)" % (
+                                            e.stage, count - hops + 1, count))
+
+            # Ignore other errors, we can simply try another service.
+            # This includes services that are down or don't resolve.
+            # If we went through the whole list failing every time,
+            # then stop to avoid looping forever.
+            except (NotImplementedError, RuntimeError, urllib2.URLError,
+                    socket.error):
+                error = error + 1
+                if error > total:
+                    raise ValueError, "Too many hops: %i" % hops
+                continue
+
+            # If the returned URL is the same as the one we had, try again.
+            if url == new_url:
+                error = error + 1
+                if error > total:
+                    raise ValueError, "Too many hops: %i" % hops
+                continue
+
+            # Keep the returned URL and go to the next hop.
+            url  = new_url
+            hops = hops - 1
+
+        # Return the last obtained URL.
         return url
 
-    # Check the requested service is supported.
-    service = service.lower()
-    if service not in shorteners:
-        raise NotImplementedError, "Unknown URL shortener service: %s" % service
+    def expand_text(self, infile, outfile, deadline = None, workers = 8):
+        """
+        @see: L{expand_text}
+        """
+        deadline = as_deadline(deadline)
+        pattern  = short_url_pattern()
+        opened   = None
+        if isinstance(infile, basestring):
+            infile = opened = open(infile, 'rb')
+        else:
+            try:
+                os.fstat(infile.fileno())
+                infile.seek(0, 1)
+            except (AttributeError, IOError, OSError):
+                import tempfile
+                spool = tempfile.TemporaryFile()
+                while 1:
+                    data = infile.read(1024 * 1024)
+                    if not data:
+                        break
+                    spool.write(data)
+                spool.flush()
+                spool.seek(0)
+                infile = opened = spool
+        try:
+            offset = infile.tell()
+            size   = os.fstat(infile.fileno()).st_size - offset
+            if size <= 0:
+                return dict()
+            start  = offset - offset % mmap.ALLOCATIONGRANULARITY
+            mapped = mmap.mmap(infile.fileno(), size + offset - start,
+                               access = mmap.ACCESS_READ, offset = start)
+            try:
+                begin = offset - start
+
+                # First pass: find the unique short URLs and expand them.
+                urls = set( match.group() for match
+                            in pattern.finditer(mapped, begin) )
+                expanded = self.expand_urls(urls, deadline, workers)
+
+                # Second pass: copy the text replacing the URLs.
+                pos = begin
+                for match in pattern.finditer(mapped, begin):
+                    outfile.write( mapped[ pos : match.start() ] )
+                    outfile.write( expanded[ match.group() ] )
+                    pos = match.end()
+                outfile.write( mapped[ pos : ] )
+            finally:
+                mapped.close()
+        finally:
+            if opened is not None:
+                opened.close()
+        return expanded
+
+    def expand_urls(self, urls, deadline = None, workers = 8):
+        """Expand many short URLs at the same time.
+
+        This is a private method and you shouldn't need to use it.
+
+        @type  urls: set of str
+        @param urls: Short URLs to expand.
+
+        @rtype:  dict(str S{->} str)
+        @return: Long URL for each short URL, or the same URL if it couldn't
+            be expanded.
+        """
+        expanded = dict( (url, url) for url in urls )
+        pending  = Queue.Queue()
+        for url in urls:
+            pending.put(url)
+        def work():
+            while 1:
+                try:
+                    url = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    expanded[url] = self.longurl(url, deadline)
+                    if self.verbose:
+                        print >> sys.stderr, "Expanded: %s -> %s" % (url, expanded[url])
+                except DeadlineExceeded:
+                    return
+                except Exception, e:
+                    if self.verbose:
+                        print >> sys.stderr, "Error expanding %s: %s" % (url, e)
+        threads = []
+        for number in xrange(min(workers, len(urls))):
+            thread = threading.Thread(target = work)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return expanded
 
-    # Call the URL shortener API.
-    response = urllib2.urlopen(api[service] % urllib2.quote(url))
-    headers  = response.info()
-    data     = response.read()
+    def probe(self, urls = None, services = None, timeout = 10.0,
+              workers = 16):
+        """
+        @see: L{probe}
+        """
+        if not urls:
+            urls = ['http://www.google.com/']
+        if not services:
+            services = sorted(shorteners)
+        results = list()
+        pending = Queue.Queue()
+        for service in services:
+            for url in urls:
+                pending.put( (service.lower(), url) )
+        def work():
+            while 1:
+                try:
+                    service, url = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                results.append( self.probe_service(service, url, timeout) )
+        threads = []
+        for number in xrange(min(workers, pending.qsize())):
+            thread = threading.Thread(target = work)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        results.sort(key = lambda result: (
+                            not result['ok'],
+                            (result['shorten'] or 0.0) +
+                            (result['expand'] or 0.0),
+                            result['service'], result['url']))
+        return results
 
-    # Fail if no data is returned.
-    if not data:
-        raise RuntimeError, "No data returned by URL shortener API"
+    def probe_service(self, service, url, timeout = 10.0):
+        """Shorten a URL with a service and expand it back, once and
+        without going through any of the caches, and record the outcome in
+        the L{health} registry.
 
-    # Decode the data if needed.
-    if headers['Content-Type'] == 'application/x-www-form-urlencoded':
-        data = urllib2.unquote(data)
-    data = data.strip() # some services add newlines and crap
+        This is a private method and you shouldn't need to use it.
 
-    # The service may have decided the URL couldn't be shortened further.
-    # I don't like this behavior but I can't help it.
-    if data != url:
+        @see: L{probe}
+        """
+        deadline = Deadline(timeout)
+        result   = {
+            'service':   service,
+            'url':       url,
+            'ok':        False,
+            'short_url': None,
+            'long_url':  None,
+            'shorten':   None,
+            'expand':    None,
+            'error':     None,
+        }
+        stage = "shortening with %s" % service
+        start = time.time()
+        try:
+            self.throttle(service, deadline, stage)
+            short_url = self.request_short_url(url, service, deadline)
+        except Exception, e:
+            elapsed = time.time() - start
+            self.health.record_failure(service, e, elapsed)
+            metrics.request(service, 'shorten', elapsed, e)
+            result['error'] = str(e) or e.__class__.__name__
+            return result
+        elapsed = time.time() - start
+        metrics.request(service, 'shorten', elapsed)
+        result['short_url'] = short_url
+        result['shorten']   = elapsed
+
+        # A service that shortens but can't expand is no good either, so the
+        # health registry only gets the outcome of the whole round trip.
+        # Recording the shortening on its own would reset the count of
+        # consecutive failures, and the circuit would never open.
+        if short_url == url:
+            result['error'] = "The URL wasn't shortened"
+            self.health.record_failure(service, RuntimeError(result['error']),
+                                       elapsed)
+            return result
+        start = time.time()
+        try:
+            status, long_url = self.request_redirection(short_url, deadline,
+                                                        "expanding %s" % short_url)
+        except Exception, e:
+            self.health.record_failure(service, e, time.time() - start)
+            result['error'] = str(e) or e.__class__.__name__
+            return result
+        result['expand']   = time.time() - start
+        result['long_url'] = long_url
+        if long_url != url:
+            result['error'] = "Expanded to the wrong URL"
+            self.health.record_failure(service, RuntimeError(result['error']),
+                                       result['expand'])
+            return result
+        self.health.record_success(service, result['shorten'])
+        result['ok'] = True
+        return result
+
+def module_setting(name):
+    """Make a property of L{DefaultClient} that reads and writes a global
+    variable of this module.
+
+    This is a private function and you shouldn't need to use it.
+    """
+    def getter(self):
+        return globals()[name]
+    def setter(self, value):
+        globals()[name] = value
+    return property(getter, setter)
+
+class DefaultClient(Client):
+    """Client configured by the global variables of this module, so setting
+    for example L{timeout} or L{health} also changes this client.
 
-        # If it's neither a short URL nor the original URL, must be an error.
-        if not is_short_url(data):
-            raise RuntimeError, data
+    This is a private class and you shouldn't need to use it.
+    """
 
-        # It may be tempting to check here if the resulting URL isn't
-        # actually longer, but it's best to let the user decide that.
-        url = data
+    timeout     = module_setting('timeout')
+    keepalive   = module_setting('keepalive')
+    verbose     = module_setting('verbose')
+    links       = module_setting('links')
+    health      = module_setting('health')
+    retries     = module_setting('retries')
+    inflight    = module_setting('inflight')
+    chains      = module_setting('chains')
+    hedger      = module_setting('hedger')
+    connections = module_setting('connections')
 
-    # Return the short URL, or the original URL if it couldn't be shortened.
-    return url
+    def __init__(self):
+        self.rate_limits = dict()
+
+# Client used by the functions of this module.
+default_client = DefaultClient()
 
 #------------------------------------------------------------------------------
 
-def longurl(url):
-    """Expand a shortened URL.
+def expand_text(infile, outfile, deadline = None, workers = 8):
+    """Expand every short URL found in a text, like a mail archive or a
+    proxy log, and write the text with the long URLs in their place.
 
-    >>> longurl('http://x90.es/5CA')
-    'http://www.example.com/'
-    >>> longurl('http://www.example.com/')
-    'http://www.example.com/'
+    The input is scanned through a memory map, so it can be much larger than
+    the available memory. Each different short URL is expanded only once,
+    by a pool of threads, and URLs that can't be expanded are left as they
+    are. Input that can't be mapped, like a pipe, is copied to a temporary
+    file first.
 
-    @note: This function tries to expand any shortened URL by following it
-        rather than using the API. This means if the service has statistics,
-        each time it's expanded it counts a new click.
+    @type  infile: str or file
+    @param infile: Input file name, or file object.
 
-    @type  url: str
-    @param url: Shortened URL to expand.
+    @type  outfile: file
+    @param outfile: Output file object.
 
-    @rtype:  str
-    @return: Expanded URL. May be the same as the original URL.
+    @type  deadline: L{Deadline} or float
+    @param deadline: Time limit in seconds for expanding all the URLs, or a
+        L{Deadline} object shared with other operations. Use C{None} to only
+        apply the per-call L{timeout}.
 
-    @raise NotImplementedError: Unsupported or unknown URL shortener service.
-    @raise urllib2.HTTPError: A network error occured while accessing the URL
-        shortener service.
+    @type  workers: int
+    @param workers: Number of URLs to expand at the same time.
+
+    @rtype:  dict(str S{->} str)
+    @return: Long URL for each different short URL found. URLs that couldn't
+        be expanded map to themselves.
     """
+    return default_client.expand_text(infile, outfile, deadline, workers)
 
-    # Don't try to expand URLs for services we don't know.
-    # An HTTP GET to an arbitrary location could have unwanted side effects.
-    if is_short_url(url):
+def short_url_pattern():
+    """Get a compiled regular expression that matches the URLs of all the
+    supported URL shortener services in a text.
 
-        # Build an opener with our customized redirect handler, then use it to
-        # follow all redirections leading to known URL shortening services.
-        opener = urllib2.build_opener( HTTPRedirectHandler() )
-        try:
-            opener.open(url)
-        except urllib2.HTTPError, e:
+    This is a private function and you shouldn't need to use it.
+
+    @rtype:  re.RegexObject
+    @return: Compiled regular expression.
+    """
+    global short_url_regex
+    hosts = tuple(sorted(shorteners, key = len, reverse = True))
+    if short_url_regex is None or short_url_regex[0] != hosts:
+        regex = r'https?://(?:%s)/[^\s<>"\'()\[\]{}]*[^\s<>"\'()\[\]{}.,;:!?]' % \
+                '|'.join( re.escape(host) for host in hosts )
+        short_url_regex = (hosts, re.compile(regex, re.IGNORECASE))
+    return short_url_regex[1]
 
-            # Keep the relocation target.
-            if e.headers.has_key('Location'):
-                url = e.headers['Location']
-            elif e.headers.has_key('URI'):
-                url = e.headers['URI']
+# Compiled regular expression for short_url_pattern(), with the list of hosts.
+short_url_regex = None
 
-            # If no relocation target was given, it's a real error.
-            else:
-                raise
+#------------------------------------------------------------------------------
 
-    # Return the URL as far as we could expand it.
-    return url
+class ResultCache(object):
+    """Thread-safe LRU cache of the results returned by the daemon.
 
-class HTTPRedirectHandler(urllib2.HTTPRedirectHandler):
-    """Modified redirect handler to prevent urllib2 from automatically
-    following all redirection requests.
+    This is a private class and you shouldn't need to use it.
+    """
 
-    We want to stop at the first redirection leading to a non-shortened URL,
-    and so get the target URL. Making a request to the target itself is not
-    only redundant but potentially harmful.
+    def __init__(self, max_size = 10000):
+        self.max_size = max_size
+        self.hits     = 0
+        self.misses   = 0
+        self._items   = collections.OrderedDict()
+        self._lock    = threading.Lock()
 
-    Note that the original redirect handler provided by C{urllib2} already
-    takes care of avoiding loops and excessively long redirection chains.
+    def get(self, key):
+        with self._lock:
+            value = self._items.pop(key, None)
+            if value is None:
+                self.misses = self.misses + 1
+                return None
+            self._items[key] = value
+            self.hits = self.hits + 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last = False)
+
+def parse_address(address = None):
+    """Parse the address where the daemon listens.
+
+    This is a private function and you shouldn't need to use it.
+
+    @type  address: str
+    @param address: Either the pathname of a Unix socket, or a port number
+        optionally preceded by a host name (C{host:port}) for a TCP socket.
+        Defaults to L{daemon_socket}.
+
+    @rtype:  tuple(int, str or tuple(str, int))
+    @return: Socket family and address.
+    """
+    if not address:
+        address = daemon_socket
+    host, sep, port = address.rpartition(':')
+    if port.isdigit():
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    return socket.AF_UNIX, os.path.expanduser(address)
+
+class DaemonHandler(SocketServer.StreamRequestHandler):
+    """Serves the requests of a L{DaemonClient}.
+
+    The protocol is line based. Each request is a command followed by its
+    arguments, separated by tabs, with C{-} standing for a missing argument:
+
+        - C{SHORTEN url service deadline}
+        - C{EXPAND url deadline}
+        - C{BEST url deadline}
+        - C{HIDE url hops deadline hedge}
+        - C{STATS}
+        - C{PING}
+
+    Each response is either C{OK} followed by the result, or C{ERR} followed
+    by the exception class name and message.
 
     This is a private class and you shouldn't need to use it.
     """
-    def filter_shorturl_redirections(self, req, fp, code, msg, headers, method):
-        if 'location' in headers:
-            newurl = headers.getheaders('location')[0]
-        elif 'uri' in headers:
-            newurl = headers.getheaders('uri')[0]
-        else:
-            return
 
-        global verbose
-        if verbose:
-            print "Found: %s" % newurl
+    def handle(self):
+        while 1:
+            line = self.rfile.readline()
+            if not line:
+                break
+            fields = [ (field != '-' and field or None)
+                       for field in line.rstrip('\r\n').split('\t') ]
+            try:
+                result = self.execute(fields[0], fields[1:])
+                response = 'OK\t%s' % result
+            except DeadlineExceeded, e:
+                response = 'ERR\tDeadlineExceeded\t%s' % e.stage
+            except Exception, e:
+                response = 'ERR\t%s\t%s' % (e.__class__.__name__,
+                                            str(e).replace('\n', ' '))
+            self.wfile.write(response + '\n')
+            self.wfile.flush()
 
-        # This only checks the hostname belongs to one of the supported services.
-        # If a malicious user finds a dangerous API call in one of them, we
-        # could be tricked into executing it by following a redirection.
-        # I can't think of any such dangerous call, though. :?
-        if not is_short_url(newurl):
-            return
+    def execute(self, command, args):
+        cache = self.server.cache
+        if command == 'SHORTEN':
+            url, service, deadline = args
+            deadline = deadline and float(deadline)
+            result = cache.get(('shorten', service, url))
+            if result is None:
+                result = shorturl(url, service, deadline)
+                cache.put(('shorten', service, url), result)
+            return result
+        if command == 'EXPAND':
+            url, deadline = args
+            deadline = deadline and float(deadline)
+            result = cache.get(('expand', url))
+            if result is None:
+                result = longurl(url, deadline)
+                cache.put(('expand', url), result)
+            return result
+        if command == 'BEST':
+            url, deadline = args
+            return besturl(url, deadline and float(deadline))
+        if command == 'HIDE':
+            url, hops, deadline, hedge = args
+            return hideurl(url, int(hops), deadline and float(deadline),
+                           hedge == '1')
+        if command == 'STATS':
+            import json
+            return json.dumps({
+                'cache'       : {'hits': cache.hits, 'misses': cache.misses},
+                'connections' : {'created': connections.created,
+                                 'reused': connections.reused},
+                'metrics'     : metrics.snapshot(),
+            })
+        if command == 'PING':
+            return 'PONG'
+        raise ValueError, "Unknown command: %s" % command
 
-        return method(self, req, fp, code, msg, headers)
+class UnixDaemonServer(SocketServer.ThreadingMixIn,
+                       SocketServer.UnixStreamServer):
+    """Daemon listening on a Unix socket.
 
-    def http_error_301(self, req, fp, code, msg, headers):
-        method = urllib2.HTTPRedirectHandler.http_error_301
-        self.filter_shorturl_redirections(req, fp, code, msg, headers, method)
+    This is a private class and you shouldn't need to use it.
+    """
+    daemon_threads = True
 
-    def http_error_302(self, req, fp, code, msg, headers):
-        method = urllib2.HTTPRedirectHandler.http_error_302
-        self.filter_shorturl_redirections(req, fp, code, msg, headers, method)
+class TCPDaemonServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Daemon listening on a TCP socket.
 
-    def http_error_303(self, req, fp, code, msg, headers):
-        method = urllib2.HTTPRedirectHandler.http_error_303
-        self.filter_shorturl_redirections(req, fp, code, msg, headers, method)
+    This is a private class and you shouldn't need to use it.
+    """
+    daemon_threads      = True
+    allow_reuse_address = True
 
-    def http_error_307(self, req, fp, code, msg, headers):
-        method = urllib2.HTTPRedirectHandler.http_error_307
-        self.filter_shorturl_redirections(req, fp, code, msg, headers, method)
+def serve(address = None, cache_size = 10000):
+    """Run the daemon until interrupted.
 
-#------------------------------------------------------------------------------
+    The daemon keeps persistent HTTP connections (see L{keepalive}), the
+    service health statistics, the redirection cache and a cache of results
+    warm between invocations of the command line tool, which talks to it
+    through a L{DaemonClient}.
 
-def besturl(url):
-    """Shorten the URL with the service that produces the best result.
+    @type  address: str
+    @param address: Address to listen on. See L{parse_address}.
 
-    >>> besturl('http://www.example.com/')
-    'http://x90.es/5CZ'
+    @type  cache_size: int
+    @param cache_size: Maximum number of results to cache.
+    """
+    global keepalive
+    keepalive = True
+    family, address = parse_address(address)
+    if family == socket.AF_INET:
+        server = TCPDaemonServer(address, DaemonHandler)
+    else:
+        if os.path.exists(address):
+            try:
+                DaemonClient(address).close()
+            except socket.error:
+                os.unlink(address)      # stale socket
+            else:
+                raise RuntimeError, "Daemon already running at %s" % address
+        server = UnixDaemonServer(address, DaemonHandler)
+    server.cache = ResultCache(cache_size)
+    if verbose:
+        print "Daemon listening at %s" % (address,)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        connections.clear()
+        if family != socket.AF_INET:
+            try:
+                os.unlink(address)
+            except OSError:
+                pass
 
-    @type  url: str
-    @param url: URL to shorten.
+class DaemonClient(object):
+    """Thin client that runs the URL shortener functions in a daemon started
+    with L{serve}. The methods have the same signatures and raise the same
+    exceptions as the module level functions.
 
-    @rtype:  str
-    @return: Shortened URL. May be the same as the original URL.
+    It's safe to share the client between threads, but the requests are sent
+    one at a time.
     """
-    global verbose
-
-    # Sort the list of shorteners by hostname length, to avoid trying services
-    # which we know to be bad choices beforehand.
-    best = url
-    shorteners_list = [ (len(service), service) for service in shorteners ]
-    shorteners_list.sort()
-    for minlen, service in shorteners_list:
-        if verbose:
-            print "Service: %s" % service
-        if len(best) < minlen + 8:      # +8 because it's "http://service/"
-            break                   # it's sorted so no point in continuing
+
+    # Exceptions that can be raised again in the client.
+    errors = {
+        'NotImplementedError'   : NotImplementedError,
+        'RuntimeError'          : RuntimeError,
+        'ValueError'            : ValueError,
+        'KeyError'              : KeyError,
+        'URLError'              : urllib2.URLError,
+        'HTTPError'             : urllib2.URLError,
+        'timeout'               : socket.timeout,
+    }
+
+    def __init__(self, address = None, timeout = 1.0, request_timeout = 60.0):
+        """
+        @type  address: str
+        @param address: Address of the daemon. See L{parse_address}.
+
+        @type  timeout: float
+        @param timeout: Timeout in seconds to connect to the daemon. It's
+            also added to the deadline of each request, to allow for the
+            round trip to the daemon.
+
+        @type  request_timeout: float
+        @param request_timeout: Timeout in seconds for the requests sent
+            without a deadline.
+
+        @raise socket.error: The daemon isn't running.
+        """
+        family, address = parse_address(address)
+        self.timeout         = timeout
+        self.request_timeout = request_timeout
+        self._lock = threading.Lock()
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
         try:
-            current = shorturl(url, service)
-        except Exception:
-            continue
-        if len(best) > len(current):
-            best = current
-    return best
+            self._sock.connect(address)
+        except:
+            self._sock.close()
+            raise
+        self._file = self._sock.makefile('rb', 0)
+
+    def close(self):
+        """Close the connection to the daemon."""
+        self._file.close()
+        self._sock.close()
+
+    def call(self, command, *args):
+        """Send a request to the daemon and wait for the response.
+
+        This is a private method and you shouldn't need to use it.
+        """
+        deadline = None
+        line = [command]
+        for arg in args:
+            if isinstance(arg, Deadline):
+                deadline = arg
+                arg = arg.remaining()
+                if arg is not None and arg <= 0:
+                    raise DeadlineExceeded("waiting for the daemon")
+            if arg is None:
+                arg = '-'
+            line.append(str(arg))
+        limit = self.request_timeout
+        if deadline is not None and deadline.expires is not None:
+            limit = deadline.remaining() + self.timeout
+        with self._lock:
+            self._sock.settimeout(limit)
+            try:
+                self._sock.sendall('\t'.join(line) + '\n')
+                response = self._file.readline()
+            except socket.error:
+                # A late response would be read by the next request.
+                self.close()
+                raise
+        if not response:
+            raise socket.error, "Connection closed by the daemon"
+        fields = response.rstrip('\r\n').split('\t', 2)
+        if fields[0] == 'OK':
+            return fields[1]
+        if fields[1] == 'DeadlineExceeded':
+            raise DeadlineExceeded(fields[2])
+        error = self.errors.get(fields[1])
+        if error is None:
+            raise RuntimeError, "%s: %s" % (fields[1], fields[2])
+        raise error(fields[2])
+
+    def ping(self):
+        """
+        @rtype:  bool
+        @return: C{True} if the daemon answered.
+        """
+        return self.call('PING') == 'PONG'
+
+    def stats(self):
+        """
+        @rtype:  dict
+        @return: Cache, connection pool and metrics statistics of the daemon.
+        """
+        import json
+        return json.loads(self.call('STATS'))
+
+    def shorturl(self, url, service = 'x90.es', deadline = None):
+        """See L{shorturl}."""
+        return self.call('SHORTEN', url, service, as_deadline(deadline))
+
+    def longurl(self, url, deadline = None):
+        """See L{longurl}."""
+        return self.call('EXPAND', url, as_deadline(deadline))
+
+    def besturl(self, url, deadline = None):
+        """See L{besturl}."""
+        return self.call('BEST', url, as_deadline(deadline))
+
+    def hideurl(self, url, hops = 2, deadline = None, hedge = False):
+        """See L{hideurl}."""
+        return self.call('HIDE', url, hops, as_deadline(deadline),
+                         hedge and 1 or 0)
+
+def connect_daemon(address = None):
+    """Connect to the daemon if it's running.
+
+    @type  address: str
+    @param address: Address of the daemon. See L{parse_address}.
+
+    @rtype:  L{DaemonClient}
+    @return: Client connected to the daemon, or C{None} if it isn't running.
+    """
+    try:
+        client = DaemonClient(address)
+    except socket.error:
+        return None
+    try:
+        if client.ping():
+            return client
+    except socket.error:
+        pass
+    client.close()
+    return None
 
 #------------------------------------------------------------------------------
 
-def hideurl(url, hops = 2):
-    """Hide an URL behind any given number of shorteners.
-    The shorteners are chosen randomly and never repeated.
+def probe(urls = None, services = None, timeout = 10.0, workers = 16):
+    """Check the health of URL shortener services, shortening each URL
+    with each service and expanding it back.
 
-    This can defeat some URL expander browser plugins, however the L{longurl}
-    function should still be able to retrieve the original URL.
+    All the round trips run at the same time, each one with its own time
+    limit, so a dead service costs no more than the timeout. Every request
+    goes to the network, without retries and skipping the caches, and the
+    outcome is recorded in the L{health} registry, so probing periodically
+    keeps the service selection of L{besturl} and L{hideurl} up to date.
 
-    @type  url: str
-    @param url: URL to shorten.
+    @type  urls: list of str
+    @param urls: URLs to shorten. Defaults to a well known URL.
 
-    @type  hops: int
-    @param hops: How many times should the URL be shortened.
-        Must be greater or equal than C{2}.
+    @type  services: list of str
+    @param services: URL shortener services to check. Defaults to all the
+        supported L{shorteners}.
 
-    @rtype:  str
-    @return: Shortened URL.
+    @type  timeout: float
+    @param timeout: Time limit in seconds for each round trip.
 
-    @raise ValueError: Too few or too many hops specified.
-    @raise urllib2.HTTPError: A network error occured while accessing the URL
-        shortener service.
+    @type  workers: int
+    @param workers: Number of round trips to run at the same time.
+
+    @rtype:  list of dict( str S{->} object )
+    @return: Result of each round trip, working ones first and then from
+        fastest to slowest. Each result has the C{service}, the C{url}, the
+        C{short_url} and C{long_url} returned by the service, the seconds
+        spent to C{shorten} and C{expand} the URL, C{ok} set to C{True} if
+        the URL came back intact, and the C{error} message otherwise.
+        Values that couldn't be obtained are C{None}.
     """
-    global verbose
-
-    # Since less than 2 hops don't hide, I flag this as an error.
-    # That way I can make sure the returned URL is always hidden.
-    if hops < 2:
-        raise ValueError, "Too few hops: %i (min is 2)" % hops
-
-    # Make a list of shorteners and shuffle it at random.
-    shorteners_list = list( shorteners )
-    random.shuffle(shorteners_list)
-
-    # Iterate the list. Since it was shuffled iteration will be random.
-    # Since it had no repetitions there's no way we can accidentally call
-    # the API of the same service twice.
-    index = 0
-    total = len(shorteners_list)
-    error = 0
-    while hops > 0:
-        service = shorteners_list[index]
-        index = index + 1
-        if index >= total:
-            index = 0
-
-        # Try to call a shortener for this hop.
-        try:
-            if verbose:
-                print "Service: %s" % service
-            new_url = shorturl(url, service)
+    return default_client.probe(urls, services, timeout, workers)
 
-        # Stop on network errors to avoid looping forever.
-        except urllib2.HTTPError:
-            raise
+def format_probe(results):
+    """Format the results of L{probe} as a table.
 
-        # Ignore other errors, we can simply try another service.
-        # If we went through the whole list failing every time,
-        # then stop to avoid looping forever.
-        except (NotImplementedError, RuntimeError):
-            error = error + 1
-            if error > total:
-                raise ValueError, "Too many hops: %i" % hops
-            continue
-
-        # If the returned URL is the same as the one we had, try again.
-        if url == new_url:
-            error = error + 1
-            if error > total:
-                raise ValueError, "Too many hops: %i" % hops
-            continue
-
-        # Keep the returned URL and go to the next hop.
-        url  = new_url
-        hops = hops - 1
-
-    # Return the last obtained URL.
-    return url
+    This is a private function and you shouldn't need to use it.
 
-#------------------------------------------------------------------------------
+    @rtype:  str
+    @return: Table with one row for each result.
+    """
+    def seconds(value):
+        if value is None:
+            return '-'
+        return '%.3f' % value
+    rows = [ ('SERVICE', 'OK', 'SHORTEN', 'EXPAND', 'RESULT') ]
+    for result in results:
+        rows.append( (result['service'],
+                      result['ok'] and 'yes' or 'no',
+                      seconds(result['shorten']),
+                      seconds(result['expand']),
+                      result['error'] or result['short_url']) )
+    widths = [ max( len(row[column]) for row in rows ) for column in xrange(4) ]
+    lines  = []
+    for row in rows:
+        lines.append( '  '.join( [ row[0].ljust(widths[0]),
+                                   row[1].ljust(widths[1]),
+                                   row[2].rjust(widths[2]),
+                                   row[3].rjust(widths[3]),
+                                   row[4] ] ) )
+    return '\n'.join(lines)
 
-def test(url_list = None, shorteners_list = None):
+def test(url_list = None, shorteners_list = None, timeout = 10.0,
+         output = 'table'):
     """Test this module.
 
     This is a private function and you shouldn't need to use it.
 
     >>> test()
-    Testing is.gd:
-            Short [1]: http://is.gd/9INTbT
-            Long  [0]: http://www.google.com/
-    Testing ito.mx:
-            Short [1]: http://ito.mx/P-EO
-            Long  [0]: http://www.google.com/
-    Testing migre.me:
-            Short [1]: http://migre.me/cwzUO
-            Long  [0]: http://www.google.com/
-    Testing ta.gd:
-            Short [1]: http://ta.gd/google
-            Long  [0]: http://www.google.com/
-    Testing tinyurl.com:
-            Short [1]: http://tinyurl.com/161
-            Long  [0]: http://www.google.com/
-    Testing x90.es:
-            Short [1]: http://x90.es/m
-            Long  [0]: http://www.google.com/
-    Testing xrl.us:
-            Short [1]: http://xrl.us/bnj
-            Long  [0]: http://www.google.com/
-    """
-
-    # Import the traceback module here rather than in the module itself.
-    # This way we avoid an extra dependency that we'll only be needing
-    # when testing and not during normal usage.
-    import traceback
-
-    # Process the parameters.
-    if not url_list:
-        url_list = ['http://www.google.com/']
-    if not shorteners_list:
-        shorteners_list = list(shorteners)
-        shorteners_list.sort()
-
-    # Test each service.
-    # Use prints instead of returning text, to get instant feedback.
-    for service in shorteners_list:
-        print "Testing %s:" % service
-        for url in url_list:
-            try:
-                short_url = shorturl(url, service)
-                print "\tShort [%r]: %s" % (int(is_short_url(short_url)), short_url)
-                long_url = longurl(short_url)
-                print "\tLong  [%r]: %s" % (int(is_short_url(long_url)), long_url)
-            except Exception:
-                traceback.print_exc()
+    SERVICE      OK   SHORTEN  EXPAND  RESULT
+    is.gd        yes    0.412   0.118  http://is.gd/9INTbT
+    x90.es       yes    0.530   0.201  http://x90.es/m
+    tinyurl.com  yes    0.611   0.187  http://tinyurl.com/161
+    ta.gd        yes    0.702   0.254  http://ta.gd/google
+    ito.mx       yes    0.851   0.310  http://ito.mx/P-EO
+    migre.me     yes    1.135   0.402  http://migre.me/cwzUO
+    xrl.us       no         -       -  Deadline exceeded while shortening with xrl.us
+
+    @type  timeout: float
+    @param timeout: Time limit in seconds for each round trip.
+
+    @type  output: str
+    @param output: C{'table'} for a table, or C{'json'} for JSON.
+    """
+    results = probe(url_list, shorteners_list, timeout)
+    if output == 'json':
+        import json
+        print json.dumps(results, indent = 1, sort_keys = True)
+    else:
+        print format_probe(results)
 
 #------------------------------------------------------------------------------
 
@@ -469,6 +3793,10 @@ def main(argv):
     This is a private function and you shouldn't need to use it.
     """
 
+    # Import the optparse module here rather than in the module itself.
+    # Programs using this module as a library never need it.
+    import optparse
+
     # Help message and version string
     usage= "%prog [options] <URL> [more URLs...]"
     parser = optparse.OptionParser(usage=usage)
@@ -481,6 +3809,19 @@ def main(argv):
                         help="get a long URL")
     commands.add_option("-t", "--test", action="store_const", dest="shorten",
                         const=None, help="test supported URL shorteners")
+    commands.add_option("-x", "--expand-text", action="store_const",
+                        dest="shorten", const="text",
+                        help="expand all short URLs in text files"
+                             " [default input: stdin]")
+    commands.add_option("--import-links", action="store_const",
+                        dest="shorten", const="import",
+                        help="add 'short long' URL pairs from text files"
+                             " to the --index file [default input: stdin]")
+    commands.add_option("--export-links", action="store_const",
+                        dest="shorten", const="export",
+                        help="print the URL pairs in the --index file")
+    commands.add_option("-d", "--daemon", action="store_true",
+                        help="run in the background serving other instances")
     parser.add_option_group(commands)
 
     # Options
@@ -489,6 +3830,25 @@ def main(argv):
                        help="how many redirections to make [default: 1]")
     options.add_option("-u", "--use", action="store", metavar="NAME",
                        help="use this URL shortener [default: auto]")
+    options.add_option("--hedge", action="store_true",
+                       help="hedge slow services when hiding URLs")
+    options.add_option("--timeout", action="store", type="float",
+                       metavar="SECONDS",
+                       help="time limit for each URL [default: none]")
+    options.add_option("--metrics", action="store", metavar="FILE",
+                       help="save metrics to this file, in Prometheus format"
+                            " if it ends with .prom or JSON otherwise")
+    options.add_option("--health", action="store", metavar="FILE",
+                       help="load and save the service health statistics"
+                            " using this file [default: don't save them]")
+    options.add_option("--index", action="store", metavar="FILE",
+                       help="look up short URLs in this index of known links"
+                            " first, and add the new ones to it")
+    options.add_option("--socket", action="store", metavar="ADDRESS",
+                       help="daemon address, a Unix socket or host:port"
+                            " [default: %s]" % daemon_socket)
+    options.add_option("--no-daemon", action="store_true",
+                       help="don't use the daemon even if it's running")
     parser.add_option_group(options)
 
     # Output
@@ -497,6 +3857,8 @@ def main(argv):
                       help="only print the URL [default]")
     output.add_option("-v", "--verbose", action="store_true",
                       help="print log messages")
+    output.add_option("--json", action="store_true",
+                      help="print the --test results as JSON")
     parser.add_option_group(output)
 
     # Defaults
@@ -547,22 +3909,119 @@ def main(argv):
         global verbose
         verbose = True
 
+    # Process the --metrics switch
+    if options.metrics:
+        metrics.enabled = True
+
+    # Process the --index switch
+    if options.shorten in ('import', 'export') and not options.index:
+        parser.error("the --index switch is required to import or export links")
+    if options.index and os.path.exists(options.index):
+        global links
+        links = LinkIndex(options.index)
+
+    # Process the --health switch
+    if options.health:
+        health.load(options.health)
+    try:
+        if options.daemon:
+            serve(options.socket)
+        else:
+            run(options, arguments)
+    finally:
+        if links is not None and links.learned:
+            links.merge()
+        if options.health:
+            health.save(options.health)
+        if options.metrics:
+            metrics.save(options.metrics)
+
+def run(options, arguments):
+    """Execute the command requested from the command line.
+
+    This is a private function and you shouldn't need to use it.
+
+    @type  options: optparse.Values
+    @param options: Parsed command line options.
+
+    @type  arguments: list of str
+    @param arguments: URLs given in the command line.
+    """
+
+    # Use the daemon if it's running, or do the work here otherwise.
+    # The daemon has its own link index, health statistics and metrics,
+    # so the switches that refer to ours mean the work must be done here.
+    client = None
+    local = options.index or options.health or options.metrics or \
+            options.verbose
+    if not options.no_daemon and not local and \
+                                    options.shorten in (True, False):
+        client = connect_daemon(options.socket)
+    try:
+        run_commands(options, arguments, client)
+    finally:
+        if client is not None:
+            client.close()
+
+def run_commands(options, arguments, client = None):
+    """Execute the command requested from the command line, either locally
+    or in the daemon.
+
+    This is a private function and you shouldn't need to use it.
+    """
+    if client is None:
+        backend = sys.modules[__name__]
+    else:
+        backend = client
+
     # Process and execute the command switches
-    service = options.use
-    count   = options.count
-    if options.shorten is None:
+    service  = options.use
+    count    = options.count
+    deadline = options.timeout
+    if options.shorten == 'import':
+
+        # Read the URL pairs and merge them into the index
+        sources = [ filename == '-' and sys.stdin or open(filename, 'r')
+                    for filename in arguments or ['-'] ]
+        pairs   = ( fields for fields in ( line.split() for line
+                                           in itertools.chain(*sources) )
+                    if len(fields) == 2 )
+        if links is None:
+            LinkIndex.build(options.index, pairs)
+        else:
+            links.merge(pairs)
+
+    elif options.shorten == 'export':
+
+        # Print the URL pairs in the index
+        if links is not None:
+            for pair in links:
+                print "%s %s" % pair
+
+    elif options.shorten == 'text':
+
+        # Expand the URLs in each file
+        for filename in arguments or ['-']:
+            if filename == '-':
+                expand_text(sys.stdin, sys.stdout, deadline)
+            else:
+                expand_text(filename, sys.stdout, deadline)
+        sys.stdout.flush()
+
+    elif options.shorten is None:
 
         # Test the services
+        output = options.json and 'json' or 'table'
         if service is None:
-            test(arguments)
+            test(arguments, None, deadline or 10.0, output)
         else:
-            test(arguments, [service])
+            test(arguments, [service], deadline or 10.0, output)
 
     elif not options.shorten:
 
         # Expand each URL
         for url in arguments:
-            print longurl(url)
+            print backend.longurl(url, deadline)
 
     else:
         if count == 0:
@@ -576,22 +4035,23 @@ def main(argv):
             # Shorten each URL once
             if service is None:
                 for url in arguments:
-                    print besturl(url)
+                    print backend.besturl(url, deadline)
             else:
                 for url in arguments:
-                    print shorturl(url, service)
+                    print backend.shorturl(url, service, deadline)
 
         else:
 
             # Hide each URL using the given hop count
             if service is None:
                 for url in arguments:
-                    print hideurl(url, count)
+                    print backend.hideurl(url, count, deadline, options.hedge)
             else:
                 for url in arguments:
                     result = url
+                    budget = Deadline(deadline)
                     for hop in xrange(count):
-                        result = shorturl(result, service)
+                        result = backend.shorturl(result, service, budget)
                     print result
 
 # Run the main() function when loaded as a command line script.
@@ -613,7 +4073,6 @@ if __name__ == '__main__':
 # Improvements:
 #   * Cache the results.
 #   * Use regular expressions in is_short_url() for more accuracy.
-#   * Reuse the HTTP connection (maybe one per thread?) to reduce overhead.
 #   * Use HEAD instead of GET to retrieve the long URLs (when possible).
 #   * Use the longurl.com service to expand URLs when possible.
 #   * Maybe multiple -u could be used instead of -c so it's not random.
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+# Tests for the TinyURL file uploading and downloading.
+# Copyright (c) 2009, Mario Vilas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice,this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Tests for L{tinyurlfs}.
+
+Run them from the directory of the sources with::
+    python -m unittest discover -p 'test_*.py'
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import tinyurlfs
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename  = os.path.join(self.directory, 'manifest.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def round_trip(self, manifest):
+        manifest.save(self.filename)
+        return tinyurlfs.Manifest.load(self.filename)
+
+    def test_file(self):
+        manifest = tinyurlfs.Manifest(8)
+        manifest.add('yhbj6q6', 'abcdefgh')
+        manifest.add('oy3k', 'ijk', True, 'is.gd')
+        manifest.add_parity('yhbj6q7', 'lmnopqrs', False, 'x90.es')
+        manifest.stripe = (2, 1)
+        manifest.digest = '0' * 40
+        loaded = self.round_trip(manifest)
+        self.assertEqual(loaded.version, 2)
+        self.assertEqual(loaded.size, 11)
+        self.assertEqual(loaded.block_size, 8)
+        self.assertEqual(loaded.digest, manifest.digest)
+        self.assertEqual(loaded.codes, manifest.codes)
+        self.assertEqual(loaded.lengths, manifest.lengths)
+        self.assertEqual(loaded.checksums, manifest.checksums)
+        self.assertEqual(loaded.redirects, manifest.redirects)
+        self.assertEqual(loaded.services, manifest.services)
+        self.assertEqual(loaded.stripe, manifest.stripe)
+        self.assertEqual(loaded.parity, manifest.parity)
+        self.assertFalse(loaded.tree)
+        self.assertEqual(loaded.files, [])
+
+    def test_tree(self):
+        manifest = tinyurlfs.Manifest(8)
+        manifest.tree = True
+        manifest.add_file('a dir/file%.txt', 0, 3, 'f' * 40)
+        manifest.add('yhbj6q6', 'abc')
+        loaded = self.round_trip(manifest)
+        self.assertTrue(loaded.tree)
+        self.assertEqual(loaded.files, manifest.files)
+
+    def test_empty_tree(self):
+        manifest = tinyurlfs.Manifest(8)
+        manifest.tree = True
+        loaded = self.round_trip(manifest)
+        self.assertTrue(loaded.tree)
+        self.assertEqual(loaded.codes, [])
+
+    def test_version_1(self):
+        loaded = tinyurlfs.Manifest.parse(['yhbj6q6', 'yhbj6q7'])
+        self.assertEqual(loaded.version, 1)
+        self.assertEqual(loaded.codes, ['yhbj6q6', 'yhbj6q7'])
+        self.assertTrue(loaded.verify(0, 'anything'))
+
+    def test_invalid_stripe(self):
+        lines = ['# tinyurlfs manifest v2', '# size=0 block_size=8 stripe=0+1']
+        try:
+            tinyurlfs.Manifest.parse(lines)
+        except RuntimeError, e:
+            self.assertIn('0+1', str(e))
+        else:
+            self.fail("Invalid stripe size accepted")
+
+class ParityTest(unittest.TestCase):
+
+    blocks = ['abcdefgh', '01234567', 'ABCDEFGH', 'xyz']
+
+    def rebuild(self, lost):
+        parity   = tinyurlfs.make_parity(self.blocks, 2)
+        received = dict( (position, block) for position, block
+                         in enumerate(self.blocks + parity)
+                         if position not in lost )
+        return tinyurlfs.rebuild_stripe(received, len(self.blocks),
+                                        [ len(block) for block in self.blocks ])
+
+    def test_no_blocks_lost(self):
+        self.assertEqual(self.rebuild([]), self.blocks)
+
+    def test_one_block_lost(self):
+        for position in xrange(len(self.blocks)):
+            self.assertEqual(self.rebuild([position]), self.blocks)
+
+    def test_as_many_blocks_lost_as_parity_blocks(self):
+        self.assertEqual(self.rebuild([0, 3]), self.blocks)
+        self.assertEqual(self.rebuild([1, 5]), self.blocks)
+
+class DownloadTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.encoded   = os.path.join(self.directory, 'tree.txt')
+        self.output    = os.path.join(self.directory, 'out', 'tree')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def download(self, path):
+        manifest = tinyurlfs.Manifest(8)
+        manifest.tree = True
+        manifest.add_file(path, 0, 0, 'da39a3ee5e6b4b0d3255bfef95601890afd80709')
+        manifest.save(self.encoded)
+        tinyurlfs.download_tree(self.encoded, self.output)
+
+    def test_path_traversal_is_rejected(self):
+        for path in ('../escaped', 'sub/../../escaped', '/escaped',
+                     'sub//escaped'):
+            self.assertRaises(RuntimeError, self.download, path)
+        self.assertFalse(os.path.exists(
+                            os.path.join(self.directory, 'out', 'escaped')))
+
+    def test_empty_file(self):
+        self.download('sub/empty')
+        self.assertEqual(os.path.getsize(
+                            os.path.join(self.output, 'sub', 'empty')), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -41,10 +41,33 @@ TinyURL file uploading and downloading.
     chunk size is too large it may fail. I found a size of 32 Kb to be good
     enough but feel free to tweak it to better suit your needs.
 
+@type redirect_size: int
+@var  redirect_size: Blocks up to this size in bytes are stored in the short
+    URL target itself, created with a GET request and read back from the
+    C{Location} header of the redirection, instead of scraping the preview
+    page. Use C{0} to disable this. The encoded data must fit in a URL, so
+    values much larger than the default may fail.
+
+@type workers: int
+@var  workers: Number of blocks transferred in parallel, per service.
+
+@type carriers: list of str
+@var  carriers: URL shortener services used by default when striping the
+    blocks over several services (see L{upload}). Only TinyURL has preview
+    pages, so the blocks of a striped file are stored in the redirection
+    targets and can't be larger than L{redirect_size}.
+
+@type timeout: float
+@var  timeout: Timeout in seconds for each HTTP request. The C{deadline}
+    argument of L{upload} and L{download} limits the time spent by the whole
+    transfer instead.
+
 @type verbose: bool
 @var  verbose: Global verbose flag. Set to C{True} to print debug messages, or
     C{False} for the default behavior (don't print anything).
     This is a private variable and you shouldn't need to use it.
+
+The global variables above are only the defaults, see L{Settings}.
 """
 
 # Example file (Plaza_Congreso__2_by_QvasiModo.jpg, 217,730 bytes)
@@ -95,21 +118,689 @@ TinyURL file uploading and downloading.
 #    $ cmp -l BigBillBroonzy-BabyPleaseDontGo1.mp3 BigBillBroonzy-BabyPleaseDontGo1\ \(1\).mp3
 #    $
 
-__all__ = ['upload', 'download']
+__all__ = ['upload', 'download', 'upload_tree', 'download_tree',
+           'TinyURLFile', 'Manifest', 'Settings', 'TinyURLBackend',
+           'RedirectBackend']
 
 import re
+import os
+import sys
+import zlib
 import time
-import urllib2
+import binascii
+import bisect
+import urllib
+import hashlib
+import threading
+import collections
+from shorturl import as_deadline, read_response, metrics, Progress
+import shorturl
+import transfer
+
+verbose       = False
+workers       = 8               # parallel requests
+timeout       = 10              # 10 seconds timeout for HTTP requests
+block_size    = (1024 * 256)    # 256 Kb blocks seemed to work well for me
+redirect_size = 512             # small blocks go in the redirection itself
+
+# Services whose short URLs redirect to any target we give them, so they can
+# carry a block in it.
+carriers = ['is.gd', 'migre.me', 'ta.gd', 'tinyurl.com', 'x90.es', 'xrl.us']
+
+class Settings(object):
+    """Settings of the file store for a transfer.
+
+    The settings not given are copied from the global variables of this
+    module when the object is created. Every transfer takes its own
+    settings, so transfers with different settings or using different
+    L{shorturl.Client} objects can run at the same time.
+
+    @type block_size: int
+    @ivar block_size: Size in bytes of each block, see L{block_size}.
+
+    @type redirect_size: int
+    @ivar redirect_size: Blocks up to this size in bytes are stored in the
+        redirection target, see L{redirect_size}.
+
+    @type workers: int
+    @ivar workers: Number of blocks transferred in parallel, per service.
+
+    @type timeout: float
+    @ivar timeout: Timeout in seconds for each HTTP request.
+
+    @type verbose: bool
+    @ivar verbose: C{True} to print debug messages.
+
+    @type client: L{shorturl.Client}
+    @ivar client: Client used for the requests.
+    """
+
+    def __init__(self, block_size = None, redirect_size = None,
+                 workers = None, timeout = None, verbose = None,
+                 client = None):
+        """
+        @type  client: L{shorturl.Client}
+        @param client: Client used for the requests. Defaults to
+            L{shorturl.default_client}.
+
+        @see: The global variables of this module for the other settings.
+        """
+        defaults = globals()
+        if block_size is None:
+            block_size = defaults['block_size']
+        if redirect_size is None:
+            redirect_size = defaults['redirect_size']
+        if workers is None:
+            workers = defaults['workers']
+        if timeout is None:
+            timeout = defaults['timeout']
+        if verbose is None:
+            verbose = defaults['verbose']
+        if client is None:
+            client = shorturl.default_client
+        self.block_size    = block_size
+        self.redirect_size = redirect_size
+        self.workers       = workers
+        self.timeout       = timeout
+        self.verbose       = verbose
+        self.client        = client
+
+class Manifest(object):
+    """Contents of the encoded file written by L{upload}.
+
+    Version 2 manifests start with a header that records the file size, the
+    block size and a SHA-1 hash of the whole file, followed by one line per
+    block with its TinyURL code, length and CRC-32. Small blocks stored in
+    the redirection target (see L{redirect_size}) are flagged as such::
+        # tinyurlfs manifest v2
+        # size=262400 block_size=262144 sha1=...
+        yhbj6q6 262144 1a2b3c4d
+        yhbj6q7 256 5e6f7a8b redirect
+
+    Files uploaded with parity blocks have a C{stripe=K+M} field in the
+    header, and C{parity} lines for the M parity blocks of each stripe of K
+    data blocks.
+
+    Blocks stored in services other than TinyURL have the hostname of the
+    service at the end of the line::
+        oy3k 512 9c0d1e2f redirect service=is.gd
+
+    Directory trees uploaded with L{upload_tree} have a C{tree=1} field in
+    the header, and C{file} lines with the offset, size, SHA-1 hash and path
+    of each file in the uploaded data.
+
+    Version 1 manifests, written by older versions, have just the codes and
+    can't be verified.
+
+    @type version: int
+    @ivar version: Manifest format version.
+
+    @type codes: list of str
+    @ivar codes: Short URL code of each block.
+
+    @type lengths: list of int
+    @ivar lengths: Length of each block, or C{None} for version 1 manifests.
+
+    @type checksums: list of int
+    @ivar checksums: CRC-32 of each block, or C{None} for version 1
+        manifests.
+
+    @type stripe: tuple(int, int)
+    @ivar stripe: Number of data and parity blocks in each stripe, or C{None}
+        if there are no parity blocks.
+
+    @type parity: list of tuple(str, int, int, bool, str)
+    @ivar parity: Short URL code, length, CRC-32, redirect flag and service
+        of each parity block, in stripe order.
+
+    @type tree: bool
+    @ivar tree: C{True} for directory trees uploaded with L{upload_tree},
+        C{False} for single files.
+
+    @type files: list of tuple(str, int, int, str)
+    @ivar files: Path, offset, size and SHA-1 hash of each file, for
+        directory trees. Empty for single files.
+
+    @type redirects: list of bool
+    @ivar redirects: C{True} for each block stored in the redirection target,
+        C{False} for blocks stored in the preview page.
+
+    @type services: list of str
+    @ivar services: URL shortener service where each block is stored.
+
+    @type size: int
+    @ivar size: Size of the file, or C{None} if unknown.
+
+    @type block_size: int
+    @ivar block_size: Block size used in the upload, or C{None} if unknown.
+
+    @type digest: str
+    @ivar digest: SHA-1 hash of the whole file in hexadecimal, or C{None} if
+        unknown.
+    """
+
+    def __init__(self, block_size = None):
+        self.version    = 2
+        self.codes      = []
+        self.lengths    = []
+        self.checksums  = []
+        self.redirects  = []
+        self.services   = []
+        self.tree       = False
+        self.files      = []
+        self.stripe     = None
+        self.parity     = []
+        self.size       = 0
+        self.block_size = block_size
+        self.digest     = None
+
+    def add(self, code, data, redirect = False, service = 'tinyurl.com'):
+        """Add a block to the manifest.
+
+        @type  code: str
+        @param code: Short URL code of the block.
+
+        @type  data: str or buffer
+        @param data: Block data.
+
+        @type  redirect: bool
+        @param redirect: C{True} if the block is stored in the redirection
+            target, C{False} if it's in the preview page.
+
+        @type  service: str
+        @param service: URL shortener service where the block is stored.
+        """
+        self.append(code, len(data), block_checksum(data), redirect, service)
+
+    def append(self, code, length, checksum, redirect = False,
+               service = 'tinyurl.com'):
+        """Add a block to the manifest when the data is no longer available.
+
+        @see: L{add}
+        """
+        self.codes.append(code)
+        self.lengths.append(length)
+        self.checksums.append(checksum)
+        self.redirects.append(redirect)
+        self.services.append(service)
+        self.size = self.size + length
+
+    def add_parity(self, code, data, redirect = False,
+                   service = 'tinyurl.com'):
+        """Add a parity block to the manifest.
+
+        @type  code: str
+        @param code: Short URL code of the block.
+
+        @type  data: str
+        @param data: Block data.
+
+        @type  redirect: bool
+        @param redirect: C{True} if the block is stored in the redirection
+            target, C{False} if it's in the preview page.
+
+        @type  service: str
+        @param service: URL shortener service where the block is stored.
+        """
+        self.parity.append( (code, len(data), block_checksum(data), redirect,
+                             service) )
+
+    def reference(self, index):
+        """
+        @type  index: int
+        @param index: Index of the block.
+
+        @rtype:  tuple(str, tuple(str, bool))
+        @return: Reference of the block for the backend returned by
+            L{open_backend}.
+        """
+        return (self.services[index], (self.codes[index],
+                                       self.redirects[index]))
+
+    def all_services(self):
+        """
+        @rtype:  list of str
+        @return: URL shortener services where the blocks are stored.
+        """
+        services = set(self.services)
+        services.update( service for (code, length, checksum, redirect,
+                                      service) in self.parity )
+        return sorted(services) or ['tinyurl.com']
+
+    def add_file(self, path, offset, size, digest):
+        """Add a file of a directory tree to the manifest.
+
+        @type  path: str
+        @param path: Path relative to the directory, using forward slashes.
+
+        @type  offset: int
+        @param offset: Position of the file in the uploaded data.
+
+        @type  size: int
+        @param size: Size of the file.
+
+        @type  digest: str
+        @param digest: SHA-1 hash of the file in hexadecimal.
+        """
+        self.files.append( (path, offset, size, digest) )
+
+    def verify(self, index, data):
+        """Check a downloaded block against the manifest.
+
+        @type  index: int
+        @param index: Index of the block.
+
+        @type  data: str
+        @param data: Block data.
+
+        @rtype:  bool
+        @return: C{True} if the block is correct or can't be verified,
+            C{False} if it's corrupt or truncated.
+        """
+        if self.lengths is None:
+            return True
+        return len(data) == self.lengths[index] and \
+               block_checksum(data) == self.checksums[index]
+
+    def save(self, filename):
+        """Write the manifest to a file.
+
+        @type  filename: str
+        @param filename: Output file name.
+        """
+        with open(filename, 'w') as outfile:
+            print >> outfile, "# tinyurlfs manifest v%d" % self.version
+            header = "# size=%d block_size=%d sha1=%s" % \
+                     (self.size, self.block_size, self.digest)
+            if self.stripe is not None:
+                header = header + " stripe=%d+%d" % self.stripe
+            if self.tree:
+                header = header + " tree=1"
+            print >> outfile, header
+            for path, offset, size, digest in self.files:
+                print >> outfile, "file %d %d %s %s" % \
+                                  (offset, size, digest, urllib.quote(path))
+            for index, code in enumerate(self.codes):
+                line = "%s %d %08x" % (code, self.lengths[index],
+                                       self.checksums[index])
+                print >> outfile, line + block_flags(self.redirects[index],
+                                                     self.services[index])
+            for code, length, checksum, redirect, service in self.parity:
+                line = "parity %s %d %08x" % (code, length, checksum)
+                print >> outfile, line + block_flags(redirect, service)
+
+    @classmethod
+    def load(cls, filename):
+        """Read a manifest from a file, in any of the supported versions.
+
+        @type  filename: str
+        @param filename: Encoded file written by L{upload}.
+
+        @rtype:  L{Manifest}
+        @return: Manifest.
+
+        @raise RuntimeError: The manifest is malformed.
+        """
+        with open(filename, 'r') as infile:
+            lines = [ line.strip() for line in infile ]
+        return cls.parse(lines)
+
+    @classmethod
+    def parse(cls, lines):
+        """Parse the lines of a manifest.
+
+        This is a private method and you shouldn't need to use it.
+        """
+        self  = cls()
+        lines = [ line for line in lines if line ]
+        if not lines or not lines[0].startswith('#'):
+            self.version    = 1
+            self.codes      = lines
+            self.redirects  = [False] * len(lines)
+            self.services   = ['tinyurl.com'] * len(lines)
+            self.lengths    = None
+            self.checksums  = None
+            self.size       = None
+            return self
+        try:
+            self.version = int(lines[0].rsplit('v', 1)[1])
+            if self.version != 2:
+                raise RuntimeError, "Unsupported manifest version: %d" % self.version
+            header = dict( field.split('=', 1) for field in lines[1][1:].split() )
+            self.size       = int(header['size'])
+            self.block_size = int(header['block_size'])
+            self.digest     = header.get('sha1')
+            if 'stripe' in header:
+                data, parity = header['stripe'].split('+')
+                data, parity = int(data), int(parity)
+                if data < 1 or parity < 0 or data + parity > 256:
+                    raise RuntimeError, "Invalid stripe size in the manifest: %d+%d" % (data, parity)
+                self.stripe  = (data, parity)
+            self.tree = header.get('tree') == '1'
+            for line in lines[2:]:
+                fields = line.split()
+                if fields[0] == 'file':
+                    offset, size, digest, path = fields[1:]
+                    self.add_file(urllib.unquote(path), int(offset),
+                                  int(size), digest)
+                    continue
+                if fields[0] == 'parity':
+                    redirect, service = parse_flags(fields[4:])
+                    self.parity.append( (fields[1], int(fields[2]),
+                                         int(fields[3], 16), redirect,
+                                         service) )
+                    continue
+                code, length, checksum = fields[:3]
+                redirect, service = parse_flags(fields[3:])
+                self.codes.append(code)
+                self.lengths.append(int(length))
+                self.checksums.append(int(checksum, 16))
+                self.redirects.append(redirect)
+                self.services.append(service)
+        except (IndexError, KeyError, ValueError):
+            raise RuntimeError, "Malformed manifest"
+        if sum(self.lengths) != self.size:
+            raise RuntimeError, "Malformed manifest"
+
+        # Older versions didn't mark the directory trees in the header.
+        if self.files:
+            self.tree = True
+        if self.stripe is not None:
+            data, parity = self.stripe
+            stripes = (len(self.codes) + data - 1) // data
+            if len(self.parity) != stripes * parity:
+                raise RuntimeError, "Malformed manifest"
+        return self
+
+def block_flags(redirect, service):
+    """
+    This is a private function and you shouldn't need to use it.
+
+    @rtype:  str
+    @return: Optional fields at the end of a block line of the manifest.
+    """
+    flags = ''
+    if redirect:
+        flags = flags + " redirect"
+    if service != 'tinyurl.com':
+        flags = flags + " service=%s" % service
+    return flags
+
+def parse_flags(fields):
+    """
+    This is a private function and you shouldn't need to use it.
+
+    @type  fields: list of str
+    @param fields: Optional fields at the end of a block line of the
+        manifest.
+
+    @rtype:  tuple(bool, str)
+    @return: Redirect flag and service of the block.
+
+    @raise ValueError: The fields are malformed.
+    """
+    redirect = False
+    service  = 'tinyurl.com'
+    if fields and fields[0] == 'redirect':
+        redirect = True
+        fields   = fields[1:]
+    if fields and fields[0].startswith('service='):
+        service = fields[0][8:].lower()
+        fields  = fields[1:]
+        if not service:
+            raise ValueError
+    if fields:
+        raise ValueError
+    return redirect, service
+
+def block_checksum(data):
+    """
+    This is a private function and you shouldn't need to use it.
+
+    @type  data: str
+    @param data: Block data.
+
+    @rtype:  int
+    @return: CRC-32 of the block, as an unsigned integer.
+    """
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+#------------------------------------------------------------------------------
+
+class RedirectBackend(transfer.Backend):
+    """Stores blocks in any URL shortener service, as the target of a new
+    short URL, and reads them back from the C{Location} header of the
+    redirection. The blocks must be small enough to fit in a URL.
+
+    The reference of each block is a tuple with the short URL code and
+    C{True}, since the block is always stored in the redirection.
+
+    The settings not given are taken from the L{Settings}.
+
+    @type prefix: str
+    @ivar prefix: The encoded data is appended to this URL to make the
+        target of the short URL, since most services refuse to shorten
+        anything else.
+    """
+
+    prefix = 'http://www.example.com/'
+
+    def __init__(self, service, block_size = None, workers = None,
+                 verbose = None, client = None, settings = None):
+        if settings is None:
+            settings = Settings()
+        if block_size is None:
+            block_size = settings.redirect_size
+        if workers is None:
+            workers = settings.workers
+        if verbose is None:
+            verbose = settings.verbose
+        if client is None:
+            client = settings.client
+        transfer.Backend.__init__(self, client)
+        self.name       = service.lower()
+        self.block_size = block_size
+        self.workers    = workers
+        self.verbose    = verbose
+
+    def put_block(self, text, deadline, stage, link = None):
+        self.client.throttle(self.name, deadline, stage)
+        target = self.prefix + text
+        url    = self.client.request_short_url(target, self.name, deadline)
+        if url == target:
+            raise RuntimeError, "Error %s, the URL wasn't shortened" % stage
+        if self.verbose:
+            print "Created: %s" % url
+        return url.rstrip('/').rsplit('/', 1)[-1], True
+
+    def get_block(self, reference, deadline, stage):
+        code, redirect = reference
+        url = 'http://%s/%s' % (self.name, code)
+        if self.verbose:
+            print "Reading: %s" % url
+        status, target = self.client.request_redirection(url, deadline, stage)
+        if target is None:
+            raise RuntimeError, "Failed to extract data from URL %s" % url
+
+        # Only the hex data matters, whatever the service did to the URL.
+        return target.rstrip('/').rsplit('/', 1)[-1]
+
+class TinyURLBackend(RedirectBackend):
+    """Stores blocks in TinyURL, as the target of a new short URL.
+
+    Blocks are read back from the preview page of the short URL, except
+    those up to L{redirect_size} bytes, which are read from the redirection
+    itself. The reference of each block is a tuple with the TinyURL code and
+    C{True} if it's stored in the redirection.
+
+    The settings not given are taken from the L{Settings}.
+
+    @type redirect_size: int
+    @ivar redirect_size: Blocks up to this size in bytes are stored in the
+        redirection target.
+
+    @type timeout: float
+    @ivar timeout: Timeout in seconds for each HTTP request.
+    """
+
+    def __init__(self, block_size = None, redirect_size = None,
+                 workers = None, timeout = None, verbose = None,
+                 client = None, settings = None):
+        if settings is None:
+            settings = Settings()
+        if block_size is None:
+            block_size = settings.block_size
+        if redirect_size is None:
+            redirect_size = settings.redirect_size
+        if timeout is None:
+            timeout = settings.timeout
+        RedirectBackend.__init__(self, 'tinyurl.com', block_size, workers,
+                                 verbose, client, settings)
+        self.redirect_size = redirect_size
+        self.timeout       = timeout
+
+    def put_block(self, text, deadline, stage, link = None):
+        self.client.throttle(self.name, deadline, stage)
+        redirect = len(text) // 2 <= self.redirect_size
+        if redirect:
+            response = self.client.open_url(
+                            'http://tinyurl.com/api-create.php?url=%s' % text,
+                            None, deadline, stage, limit = self.timeout)
+        else:
+            response = self.client.open_url(
+                            'http://tinyurl.com/api-create.php',
+                            'url=%s' % text, deadline, stage,
+                            limit = self.timeout)
+        url = read_response(response, deadline, stage, self.timeout)
+        url = url.strip()
+        if not url.startswith('http://tinyurl.com/'):
+            raise RuntimeError, "Error %s, reason: %r" % (stage, url)
+        if self.verbose:
+            print "Created: %s" % url
+        return url[-7:], redirect
+
+    def get_block(self, reference, deadline, stage):
+        code, redirect = reference
+        if redirect:
+            return RedirectBackend.get_block(self, reference, deadline, stage)
+        url = 'http://preview.tinyurl.com/%s' % code
+        if self.verbose:
+            print "Reading: %s" % url
+        with transfer.tracer.span('http'):
+            page = read_response(self.client.open_url(url, None, deadline,
+                                                      stage, limit = self.timeout),
+                                 deadline, stage, self.timeout)
+        with transfer.tracer.span('scrape'):
+            return scrape_block(page, url)
+
+def open_backend(services = None, settings = None):
+    """Create the backend to transfer the blocks of a file.
+
+    This is a private function and you shouldn't need to use it.
+
+    @type  services: list of str
+    @param services: URL shortener services to store the blocks in, or
+        C{None} for TinyURL alone.
+
+    @type  settings: L{Settings}
+    @param settings: Settings of the transfer, or C{None} for the defaults.
+
+    @rtype:  L{transfer.StripedBackend}
+    @return: Backend spreading the blocks over the services. Its references
+        are the ones returned by L{Manifest.reference}.
+    """
+    if settings is None:
+        settings = Settings()
+    backends = []
+    for service in services or ['tinyurl.com']:
+        if service.lower() == 'tinyurl.com':
+            backends.append( TinyURLBackend(settings = settings) )
+        else:
+            backends.append( RedirectBackend(service, settings = settings) )
+    backend = transfer.StripedBackend(backends, client = settings.client)
+    if backend.block_size < 1:
+        raise ValueError, "Blocks can't be striped with a redirect_size of 0"
+    return backend
+
+# Regular expressions to extract the data from the preview pages.
+block_start   = re.compile('<blockquote>')
+block_end     = re.compile('</blockquote>')
+block_garbage = re.compile('</?[^>]*>')
+
+# Buffer each thread scrapes the blocks into.
+scraped = threading.local()
+
+# Size of the pieces of the preview pages stripped at a time.
+scrape_size = 32768
+
+def scrape_block(page, url):
+    """Extract the encoded data of a block from its TinyURL preview page.
+
+    This is a private function and you shouldn't need to use it.
+
+    @rtype:  buffer
+    @return: Encoded block data. It's only valid until the next call from
+        the same thread, so decode it right away.
+
+    @raise RuntimeError: The data could not be extracted from the page.
+    """
+    start_m = block_start.search(page)
+    if start_m is None:
+        raise RuntimeError, "Failed to extract data from URL %s" % url
+    end_m = block_end.search(page, start_m.end())
+    if end_m is None:
+        raise RuntimeError, "Failed to extract data from URL %s" % url
+
+    # Go over the data once, stripping the tags and whitespace of a small
+    # piece at a time into a buffer reused from one block to the next.
+    # Stripping the whole page at once makes a copy of it for each step,
+    # and going over it a tag at a time is much slower.
+    start = start_m.end()
+    end   = end_m.start()
+    data  = getattr(scraped, 'data', None)
+    if data is None or len(data) < end - start:
+        data = scraped.data = bytearray(end - start)
+    size = 0
+    while start < end:
+
+        # Never cut a tag in half.
+        stop = min(start + scrape_size, end)
+        if stop < end:
+            tag = page.rfind('<', start, stop)
+            if tag > page.rfind('>', start, stop):
+                if tag > start:
+                    stop = tag
+                else:
+                    stop = page.find('>', tag, end) + 1 or end
+
+        text = block_garbage.sub('', page[ start : stop ])
+        text = text.translate(None, ' \t\r\n')
+        data[ size : size + len(text) ] = text
+        size  = size + len(text)
+        start = stop
+    return buffer(data, 0, size)
 
-verbose     = False
-timeout     = 10            # 10 seconds timeout for HTTP requests
-block_size  = (1024 * 256)  # 256 Kb blocks seemed to work well for me
+#------------------------------------------------------------------------------
 
-def upload(original, encoded):
+def upload(original, encoded, deadline = None, progress = None,
+           parity = None, services = None, settings = None):
     """Upload a file and write the encoded version.
 
     The file can be downloaded passing the encoded file to the L{download}
-    function.
+    function. Blocks are uploaded in parallel by a pool of L{workers}
+    threads.
+
+    The blocks can be striped over several URL shortener services, so the
+    rate limit and latency of each one don't cap the throughput. Each block
+    goes to a service picked at random, weighted by the throughput observed
+    so far in the upload, and the manifest records where it went. Blocks
+    stored outside TinyURL must fit in the redirection, so they can't be
+    larger than L{redirect_size}.
+
+    With parity blocks, each stripe of K data blocks gets M extra blocks,
+    and any K of them are enough to rebuild the data. The download doesn't
+    have to wait for the slowest blocks, and survives up to M lost links in
+    each stripe.
 
     @type  original: str
     @param original: Name of the local file to upload.
@@ -118,53 +809,107 @@ def upload(original, encoded):
     @param encoded: Name of the output file that will contain the information
         needed to download the original file later.
 
+    @type  deadline: L{shorturl.Deadline} or float
+    @param deadline: Time limit in seconds for the whole upload, or C{None}
+        to only apply the per-request L{timeout}.
+
+    @type  progress: L{shorturl.Progress}
+    @param progress: Progress reporter, or C{None}.
+
+    @type  parity: tuple(int, int)
+    @param parity: Number of data blocks K and parity blocks M in each
+        stripe, or C{None} to upload no parity blocks. K + M can't be
+        larger than 256.
+
+    @type  services: list of str
+    @param services: URL shortener services to stripe the blocks over (see
+        L{carriers}), or C{None} to use TinyURL alone.
+
+    @type  settings: L{Settings}
+    @param settings: Settings of the transfer, or C{None} for the defaults
+        taken from the global variables of this module.
+
     @raise RuntimeError: An error occured while trying to upload the file.
+    @raise shorturl.DeadlineExceeded: The deadline expired.
     @raise urllib2.HTTPError: A network error occured while accessing the URL
         shortener service.
     """
-    global verbose
-    global block_size
+    if parity is not None:
+        if parity[0] < 1 or parity[1] < 0 or sum(parity) > 256:
+            raise ValueError, "Invalid stripe size: %d+%d" % tuple(parity)
+        parity = tuple(parity)
+    deadline = as_deadline(deadline)
+    backend  = open_backend(services, settings)
+    total    = os.path.getsize(original)
+    if progress is not None:
+        if progress.total is None:
+            progress.total = total
+        if progress.total_blocks is None:
+            progress.total_blocks = (total + backend.block_size - 1) // \
+                                    backend.block_size
+        progress.start()
+    manifest = Manifest(backend.block_size)
+    manifest.stripe = parity
+    digest   = hashlib.sha1()
+
+    # The parity blocks of each stripe go right after its data blocks.
+    # Whether each block is a parity block is kept as they're read, so
+    # it's known by the time the block has been uploaded.
+    is_parity = collections.deque()
+    def read_blocks(infile):
+
+        # Without parity no block outlives the upload pipeline, so they're
+        # read into a ring of reusable buffers. The stripes for the parity
+        # blocks have to be kept, so those are read as strings.
+        if parity is None:
+            source = transfer.read_buffers(infile, backend.block_size,
+                                           transfer.in_flight(backend))
+        else:
+            source = iter(lambda: infile.read(backend.block_size), '')
+        stripe = []
+        while 1:
+            with transfer.tracer.span('read'):
+                block = next(source, '')
+            if parity is not None and stripe and \
+                    (not block or len(stripe) == parity[0]):
+                with transfer.tracer.span('parity'):
+                    blocks = make_parity(stripe, parity[1])
+                for data in blocks:
+                    is_parity.append(True)
+                    yield data
+                stripe = []
+            if not block:
+                break
+            is_parity.append(False)
+            yield block
+            if parity is not None:
+                stripe.append(block)
+
     with open(original, 'rb') as infile:
-        with open(encoded, 'w') as outfile:
-            pos = 0
-#            do_pause = False
-            while 1:
-#                if do_pause:
-#                    if verbose:
-#                        print "Waiting 10 seconds before making another request..."
-#                    time.sleep(10)
-#                else:
-#                    do_pause = True
-                data = infile.read(block_size)
-                if not data:
-                    break
-                data = data.encode('hex')
-                request = ('http://tinyurl.com/api-create.php', 'url=%s' % data, timeout)
-                tries = 3
-                while 1:
-                    try:
-                        url = urllib2.urlopen(*request).read()
-                        break
-                    except IOError, e:
-                        tries = tries - 1
-                        if tries <= 0:
-                            raise
-                        if verbose:
-                            print "Error: %s" % str(e)
-                            print "Waiting 10 seconds before making another request..."
-                        time.sleep(10)
-                url = url.strip()
-                if not url.startswith('http://tinyurl.com/'):
-                    raise RuntimeError, "Error creating link for position %d, reason: %r" % (pos, url)
-                if verbose:
-                    print "Created: %s" % url
-                code = url[-7:]
-                print >> outfile, code
-                pos = pos + block_size
-
-def download(encoded, original):
+        for data, (service, (code, redirect)), elapsed in \
+                transfer.put_blocks(backend, read_blocks(infile), deadline):
+            if is_parity.popleft():
+                manifest.add_parity(code, data, redirect, service)
+                continue
+            manifest.add(code, data, redirect, service)
+            with transfer.tracer.span('hash'):
+                digest.update(data)
+            if progress is not None:
+                progress.update(len(data), elapsed)
+    manifest.digest = digest.hexdigest()
+    with transfer.tracer.span('manifest'):
+        manifest.save(encoded)
+    if progress is not None:
+        progress.finish()
+
+def download(encoded, original, deadline = None, progress = None,
+             settings = None):
     """Download a file uploaded with L{upload}.
 
+    Blocks are downloaded in parallel by a pool of L{workers} threads for
+    each service they're stored in, and verified against the manifest as
+    they arrive. Only the corrupt ones are downloaded again.
+
     @type  encoded: str
     @param encoded: File that contains the information needed to download the
         file. It was generated by the L{upload} function.
@@ -172,44 +917,963 @@ def download(encoded, original):
     @type  original: str
     @param original: Output file that will contain the downloaded data.
 
-    @raise RuntimeError: An error occured while trying to download the file.
+    @type  deadline: L{shorturl.Deadline} or float
+    @param deadline: Time limit in seconds for the whole download, or C{None}
+        to only apply the per-request L{timeout}.
+
+    @type  progress: L{shorturl.Progress}
+    @param progress: Progress reporter, or C{None}. The size is only known in
+        advance for version 2 manifests.
+
+    @type  settings: L{Settings}
+    @param settings: Settings of the transfer, or C{None} for the defaults
+        taken from the global variables of this module.
+
+    @raise RuntimeError: An error occured while trying to download the file,
+        or it was corrupt and downloading it again didn't help.
+    @raise shorturl.DeadlineExceeded: The deadline expired.
     @raise urllib2.HTTPError: A network error occured while accessing the URL
         shortener service.
     """
-    global verbose
-    start   = re.compile('<blockquote>')
-    end     = re.compile('</blockquote>')
-    garbage = re.compile('</?[^>]*>')
-    with open(encoded, 'r') as infile:
+    deadline = as_deadline(deadline)
+    manifest = Manifest.load(encoded)
+    backend  = open_backend(manifest.all_services(), settings)
+    codes    = manifest.codes
+    if progress is not None:
+        if progress.total is None:
+            progress.total = manifest.size
+        if progress.total_blocks is None:
+            progress.total_blocks = len(codes)
+        progress.start()
+
+    if manifest.stripe is not None:
+        blocks = fetch_stripes(manifest, deadline, backend)
+    else:
+        blocks = transfer.get_blocks(backend,
+                                     ( manifest.reference(index)
+                                       for index in xrange(len(codes)) ),
+                                     deadline, manifest.verify)
+    digest = hashlib.sha1()
+    try:
         with open(original, 'w+b') as outfile:
-            for code in infile:
-                code = code.strip()
-                if not code:
-                    continue
-                url = 'http://preview.tinyurl.com/%s' % code
-                if verbose:
-                    print "Reading: %s" % url
-                page = urllib2.urlopen(url).read()
-                start_m = start.search(page)
-                if start_m is None:
-                    raise RuntimeError, "Failed to extract data from URL %s" % url
-                end_m = end.search(page, start_m.end())
-                if end_m is None:
-                    raise RuntimeError, "Failed to extract data from URL %s" % url
-                page = page[ start_m.end() : end_m.start() ]
-                pos  = 0
-                while 1:
-                    garbage_m = garbage.search(page, pos)
-                    if garbage_m is None:
+            for data, elapsed in blocks:
+                with transfer.tracer.span('write'):
+                    outfile.write(data)
+                with transfer.tracer.span('hash'):
+                    digest.update(data)
+                if progress is not None:
+                    progress.update(len(data), elapsed)
+    finally:
+        blocks.close()
+    if manifest.digest is not None and digest.hexdigest() != manifest.digest:
+        raise RuntimeError, "The downloaded file doesn't match its SHA-1 hash"
+    if progress is not None:
+        progress.finish()
+
+def fetch_stripes(manifest, deadline, backend):
+    """Download the blocks of the stripes from a pool of threads, and
+    rebuild the data of each stripe as soon as enough of its blocks have
+    arrived. Corrupt blocks are treated like missing ones.
+
+    The data blocks of each stripe are queued before its parity blocks, and
+    the blocks of a stripe that can be rebuilt already are skipped, so
+    parity blocks are mostly downloaded when a data block is slow or lost.
+    Only a couple of stripes are downloaded ahead of the one being returned.
+
+    This is a private function and you shouldn't need to use it.
+
+    @rtype:  iterator of tuple(str, float)
+    @return: Data of each block and time spent on it.
+    """
+    per_stripe, per_parity = manifest.stripe
+    total   = len(manifest.codes)
+    stripes = (total + per_stripe - 1) // per_stripe
+    ahead   = 2     # stripes downloaded ahead of the one being returned
+    window  = threading.Condition()
+    state   = {'next': 0, 'closed': False}
+    done    = set()
+
+    def tasks():
+        for stripe in xrange(stripes):
+            count = min(per_stripe, total - stripe * per_stripe)
+            for position in xrange(count + per_parity):
+                yield stripe, position
+
+    def fetch((stripe, position)):
+
+        # Wait for the stripes before this one to be returned, and don't
+        # bother with the stripes that don't need any more blocks.
+        with window:
+            while stripe >= state['next'] + ahead and not state['closed']:
+                window.wait()
+        if stripe in done or state['closed']:
+            return None
+        began = time.time()
+        first = stripe * per_stripe
+        count = min(per_stripe, total - first)
+        if position < count:
+            index = first + position
+            stage = "downloading block %d" % (index + 1)
+            data  = transfer.get_block(backend, manifest.reference(index),
+                                       deadline, stage)
+            valid = manifest.verify(index, data)
+        else:
+            code, length, checksum, redirect, service = \
+                manifest.parity[ stripe * per_parity + position - count ]
+            stage = "downloading parity block %s" % code
+            data  = transfer.get_block(backend, (service, (code, redirect)),
+                                       deadline, stage)
+            valid = len(data) == length and block_checksum(data) == checksum
+        if not valid:
+            metrics.increment('corrupt_blocks_total', service = backend.name)
+            data = None
+        return data, time.time() - began
+
+    received = dict()   # stripe -> position -> data
+    returned = dict()   # stripe -> number of blocks tried so far
+    errors   = dict()   # stripe -> first exception info
+    elapsed  = dict()   # stripe -> time spent on the blocks received
+    results  = transfer.run_workers(fetch, tasks(), backend.workers)
+    try:
+        for (stripe, position), result, error in results:
+            if stripe in done:
+                continue
+            returned[stripe] = returned.get(stripe, 0) + 1
+            count = min(per_stripe, total - stripe * per_stripe)
+            if error is not None:
+                errors.setdefault(stripe, error)
+            elif result is not None and result[0] is not None:
+                blocks = received.setdefault(stripe, dict())
+                blocks[position] = result[0]
+                elapsed[stripe]  = elapsed.get(stripe, 0.0) + result[1]
+                if len(blocks) == count:
+                    done.add(stripe)
+
+            # Return the stripes that are ready, in order. A stripe that
+            # isn't ready after trying all of its blocks is lost.
+            while state['next'] < stripes:
+                stripe = state['next']
+                first  = stripe * per_stripe
+                count  = min(per_stripe, total - first)
+                if stripe not in done:
+                    if returned.get(stripe, 0) < count + per_parity:
                         break
-                    pos  = garbage_m.start()
-                    page = page[ : pos ] + page[ garbage_m.end() : ]
-                page = page.replace(' ',  '')
-                page = page.replace('\t', '')
-                page = page.replace('\r', '')
-                page = page.replace('\n', '')
-                page = page.decode('hex')
-                outfile.write(page)
+                    if stripe in errors:
+                        error = errors[stripe]
+                        raise error[0], error[1], error[2]
+                    raise RuntimeError, "Stripe starting at block %d is corrupt" % (first + 1)
+                with transfer.tracer.span('rebuild', block = first):
+                    blocks = rebuild_stripe(received.pop(stripe), count,
+                                    manifest.lengths[ first : first + count ])
+                average = elapsed.pop(stripe) / count
+                errors.pop(stripe, None)
+                with window:
+                    state['next'] = stripe + 1
+                    window.notify_all()
+                for data in blocks:
+                    yield data, average
+
+            # Don't wait for the extra blocks still being downloaded.
+            if state['next'] == stripes:
+                break
+    finally:
+        with window:
+            state['closed'] = True
+            window.notify_all()
+        results.close()
+
+def fetch_verified_block(manifest, index, deadline = None, data = None,
+                         settings = None, backend = None):
+    """Download a block and verify it against the manifest, downloading it
+    again if it's corrupt.
+
+    This is a private function and you shouldn't need to use it.
+
+    @type  manifest: L{Manifest}
+    @param manifest: Manifest of the file.
+
+    @type  index: int
+    @param index: Index of the block.
+
+    @type  deadline: L{shorturl.Deadline}
+    @param deadline: Time limit for the download.
+
+    @type  data: str
+    @param data: Block data if it was already downloaded, or C{None}.
+
+    @type  settings: L{Settings}
+    @param settings: Settings of the transfer, or C{None} for the defaults.
+
+    @type  backend: L{transfer.StripedBackend}
+    @param backend: Backend returned by L{open_backend} for the services of
+        the manifest, or C{None} to open a new one. Transfers of many blocks
+        should open it once and pass it to every call.
+
+    @rtype:  str
+    @return: Block data.
+
+    @raise RuntimeError: The block is still corrupt after the retry policy's
+        C{max_tries} attempts.
+    """
+    if data is not None:
+        if manifest.verify(index, data):
+            return data
+        metrics.increment('corrupt_blocks_total',
+                          service = manifest.services[index])
+    code  = manifest.codes[index]
+    stage = "downloading block %d (%s)" % (index + 1, code)
+    if backend is None:
+        backend = open_backend( [manifest.services[index]], settings )
+    return transfer.get_block(backend, manifest.reference(index), deadline,
+                              stage, lambda data: manifest.verify(index, data))
+
+def fetch_block(code, deadline = None, index = None, redirect = False,
+                service = 'tinyurl.com', settings = None, backend = None):
+    """Download and decode a single block.
+
+    @type  code: str
+    @param code: Short URL code of the block, as found in the encoded file.
+
+    @type  deadline: L{shorturl.Deadline} or float
+    @param deadline: Time limit in seconds, or C{None} to only apply the
+        per-request L{timeout}.
+
+    @type  index: int
+    @param index: Index of the block in the encoded file, used only for the
+        messages. C{None} if unknown.
+
+    @type  redirect: bool
+    @param redirect: C{True} if the block is stored in the redirection
+        target, C{False} if it's in the preview page.
+
+    @type  service: str
+    @param service: URL shortener service where the block is stored.
+
+    @type  settings: L{Settings}
+    @param settings: Settings of the transfer, or C{None} for the defaults
+        taken from the global variables of this module.
+
+    @type  backend: L{transfer.StripedBackend}
+    @param backend: Backend returned by L{open_backend} for a list of
+        services that includes this one, or C{None} to open a new one.
+
+    @rtype:  str
+    @return: Block data.
+
+    @raise RuntimeError: The data could not be extracted from the page.
+    @raise shorturl.DeadlineExceeded: The deadline expired.
+    @raise urllib2.HTTPError: A network error occured while accessing the URL
+        shortener service.
+    """
+    if index is None:
+        stage = "downloading block %s" % code
+    else:
+        stage = "downloading block %d (%s)" % (index + 1, code)
+    if backend is None:
+        backend = open_backend([service], settings)
+    return transfer.get_block(backend, (service, (code, redirect)),
+                              deadline, stage)
+
+#------------------------------------------------------------------------------
+
+class TinyURLFile(object):
+    """Read only file-like object to access a file uploaded with L{upload}
+    without downloading all of it.
+
+    Only the blocks needed to satisfy each read are downloaded. They're kept
+    in a small LRU cache, and when the file is read sequentially the next
+    blocks are downloaded in the background before they're needed.
+
+    Blocks are verified against the manifest, and downloaded again if
+    they're corrupt. Version 1 manifests only have the list of blocks, so
+    the size of the file isn't known in advance. Seeking relative to the end
+    of the file or calling L{get_size} downloads the last block to find it
+    out.
+
+    Example::
+        with TinyURLFile('archive.txt') as fd:
+            fd.seek(-22, 2)
+            trailer = fd.read(22)
+
+    @type manifest: L{Manifest}
+    @ivar manifest: Manifest of the file.
+
+    @type codes: list of str
+    @ivar codes: TinyURL codes of each block.
+
+    @type block_size: int
+    @ivar block_size: Size of each block, as used in the upload.
+
+    @type size: int
+    @ivar size: Size of the file, or C{None} if it's not known yet.
+
+    @type cache_size: int
+    @ivar cache_size: Maximum number of blocks to keep in memory.
+
+    @type readahead: int
+    @ivar readahead: Number of blocks to download in advance on sequential
+        reads. Use C{0} to disable the read ahead.
+
+    @type deadline: L{shorturl.Deadline}
+    @ivar deadline: Time limit for every network request made by this object.
+
+    @type settings: L{Settings}
+    @ivar settings: Settings of the downloads.
+
+    @type hits: int
+    @ivar hits: Number of blocks found in the cache.
+
+    @type misses: int
+    @ivar misses: Number of blocks that had to be downloaded when read.
+    """
+
+    def __init__(self, manifest, block_size = None, cache_size = 16,
+                 readahead = 2, deadline = None, settings = None):
+        """
+        @type  manifest: str or L{Manifest}
+        @param manifest: Name of the encoded file written by L{upload}, or
+            its parsed contents.
+
+        @type  block_size: int
+        @param block_size: Block size used in the upload. Only needed for
+            version 1 manifests, where it defaults to the one in the
+            C{settings}.
+
+        @type  cache_size: int
+        @param cache_size: Maximum number of blocks to keep in memory.
+
+        @type  readahead: int
+        @param readahead: Number of blocks to download in advance on
+            sequential reads.
+
+        @type  deadline: L{shorturl.Deadline} or float
+        @param deadline: Time limit in seconds for every network request made
+            by this object, or C{None} to only apply the per-request
+            L{timeout}.
+
+        @type  settings: L{Settings}
+        @param settings: Settings of the downloads, or C{None} for the defaults
+            taken from the global variables of this module.
+        """
+        if settings is None:
+            settings = Settings()
+        if isinstance(manifest, basestring):
+            manifest = Manifest.load(manifest)
+        self.manifest   = manifest
+        self.codes      = manifest.codes
+        self.settings   = settings
+        self.block_size = manifest.block_size or block_size or \
+                          settings.block_size
+        self.cache_size = max(cache_size, readahead + 1)
+        self.readahead  = readahead
+        self.deadline   = as_deadline(deadline)
+        self.size       = manifest.size
+        self.hits       = 0
+        self.misses     = 0
+        self.closed     = False
+        self._position  = 0
+        self._last      = None
+        self._cache     = collections.OrderedDict()
+        self._lock      = threading.Lock()
+        self._backend   = open_backend(manifest.all_services(), settings)
+        if not self.codes:
+            self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the file and free the cached blocks."""
+        self.closed = True
+        with self._lock:
+            self._cache.clear()
+
+    def get_size(self):
+        """
+        @rtype:  int
+        @return: Size of the file. May require downloading the last block.
+        """
+        if self.size is None:
+            self._get_block(len(self.codes) - 1)
+        return self.size
+
+    def tell(self):
+        """
+        @rtype:  int
+        @return: Current position in the file.
+        """
+        return self._position
+
+    def seek(self, offset, whence = 0):
+        """Move to a new position in the file. Nothing is downloaded until
+        the next read, unless seeking relative to the end of the file.
+
+        @type  offset: int
+        @param offset: Offset in bytes.
+
+        @type  whence: int
+        @param whence: C{0} for an absolute position, C{1} to move relative
+            to the current position, or C{2} to move relative to the end of
+            the file.
+        """
+        if self.closed:
+            raise ValueError, "I/O operation on closed file"
+        if whence == 1:
+            offset = offset + self._position
+        elif whence == 2:
+            offset = offset + self.get_size()
+        elif whence != 0:
+            raise ValueError, "Invalid whence: %r" % whence
+        if offset < 0:
+            raise IOError, "Invalid argument"
+        self._position = offset
+
+    def read(self, size = -1):
+        """Read data from the current position.
+
+        @type  size: int
+        @param size: Maximum number of bytes to read, or a negative number
+            to read until the end of the file.
+
+        @rtype:  str
+        @return: Data read. Shorter than requested only at the end of file.
+        """
+        if self.closed:
+            raise ValueError, "I/O operation on closed file"
+        chunks = []
+        while size != 0:
+            index, offset = divmod(self._position, self.block_size)
+            if index >= len(self.codes):
+                break
+            data = self._get_block(index)
+            if size < 0:
+                chunk = data[offset:]
+            else:
+                chunk = data[ offset : offset + size ]
+                size  = size - len(chunk)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            self._position = self._position + len(chunk)
+        return ''.join(chunks)
+
+    def readinto(self, buffer):
+        """Read data from the current position into a writable buffer.
+
+        @type  buffer: bytearray
+        @param buffer: Buffer to fill.
+
+        @rtype:  int
+        @return: Number of bytes read. Shorter than the buffer only at the
+            end of file.
+        """
+        if self.closed:
+            raise ValueError, "I/O operation on closed file"
+
+        # Copy straight from the cached blocks, without the slices and the
+        # join of read().
+        view   = memoryview(buffer)
+        filled = 0
+        while filled < len(view):
+            index, offset = divmod(self._position, self.block_size)
+            if index >= len(self.codes):
+                break
+            data  = self._get_block(index)
+            count = min(len(data) - offset, len(view) - filled)
+            if count <= 0:
+                break
+            view[ filled : filled + count ] = \
+                memoryview(data)[ offset : offset + count ]
+            filled         = filled + count
+            self._position = self._position + count
+        return filled
+
+    def _get_block(self, index):
+        """Get a block from the cache, or download it if it's not there.
+
+        This is a private method and you shouldn't need to use it.
+        """
+        with self._lock:
+            data = self._cache.pop(index, None)
+            if data is not None:
+                self._cache[index] = data
+                self.hits = self.hits + 1
+            else:
+                self.misses = self.misses + 1
+            sequential = self._last is not None and index == self._last + 1
+            self._last = index
+        if data is None:
+            data = self._load_block(index)
+        if sequential:
+            for ahead in xrange(index + 1, min(index + 1 + self.readahead,
+                                               len(self.codes))):
+                with self._lock:
+                    if ahead in self._cache:
+                        continue
+                thread = threading.Thread(target = self._prefetch,
+                                          args = (ahead,))
+                thread.daemon = True
+                thread.start()
+        return data
+
+    def _load_block(self, index):
+        """Download a block and put it in the cache. Concurrent downloads of
+        the same block, like those of the read ahead, are coalesced.
+
+        This is a private method and you shouldn't need to use it.
+        """
+        code     = self.codes[index]
+        redirect = self.manifest.redirects[index]
+        service  = self.manifest.services[index]
+        data     = self.settings.client.inflight.do(
+                            ('tinyurlfs', service, code), self.deadline,
+                            fetch_block, code, self.deadline, index,
+                            redirect, service, self.settings, self._backend)
+        data     = fetch_verified_block(self.manifest, index, self.deadline,
+                                        data, self.settings, self._backend)
+        if index == len(self.codes) - 1:
+            self.size = index * self.block_size + len(data)
+        elif len(data) != self.block_size:
+            raise RuntimeError, "Block %d has %d bytes, expected %d" % \
+                                (index + 1, len(data), self.block_size)
+        with self._lock:
+            self._cache.pop(index, None)
+            self._cache[index] = data
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last = False)
+        return data
+
+    def _prefetch(self, index):
+        """Download a block in the background. Errors are ignored, the block
+        will be downloaded again when it's actually read.
+
+        This is a private method and you shouldn't need to use it.
+        """
+        try:
+            self._load_block(index)
+        except Exception:
+            pass
+
+#------------------------------------------------------------------------------
+
+def upload_tree(directory, encoded, deadline = None, progress = None,
+                services = None, settings = None):
+    """Upload all the files in a directory tree and write a single encoded
+    file (an index manifest) to restore them later with L{download_tree}.
+
+    The files are concatenated and split in blocks like a single file, so
+    small files are packed together in shared blocks. The blocks are
+    uploaded in parallel by a pool of L{workers} threads, and can be striped
+    over several services like in L{upload}.
+
+    @type  directory: str
+    @param directory: Directory to upload.
+
+    @type  encoded: str
+    @param encoded: Name of the output file that will contain the information
+        needed to download the files later.
+
+    @type  deadline: L{shorturl.Deadline} or float
+    @param deadline: Time limit in seconds for the whole upload, or C{None}
+        to only apply the per-request L{timeout}.
+
+    @type  progress: L{shorturl.Progress}
+    @param progress: Progress reporter, or C{None}.
+
+    @type  services: list of str
+    @param services: URL shortener services to stripe the blocks over (see
+        L{carriers}), or C{None} to use TinyURL alone.
+
+    @type  settings: L{Settings}
+    @param settings: Settings of the transfer, or C{None} for the defaults
+        taken from the global variables of this module.
+
+    @raise RuntimeError: An error occured while trying to upload the files.
+    @raise shorturl.DeadlineExceeded: The deadline expired.
+    @raise urllib2.HTTPError: A network error occured while accessing the URL
+        shortener service.
+    """
+    deadline = as_deadline(deadline)
+    backend  = open_backend(services, settings)
+    files    = list_tree(directory)
+    total    = sum( size for path, filename, size in files )
+    if progress is not None:
+        if progress.total is None:
+            progress.total = total
+        if progress.total_blocks is None:
+            progress.total_blocks = (total + backend.block_size - 1) // \
+                                    backend.block_size
+        progress.start()
+    manifest = Manifest(backend.block_size)
+    manifest.tree = True
+    blocks   = archive_blocks(files, manifest, backend.block_size,
+                              transfer.in_flight(backend))
+    for data, (service, (code, redirect)), elapsed in \
+            transfer.put_blocks(backend, blocks, deadline):
+        manifest.add(code, data, redirect, service)
+        if progress is not None:
+            progress.update(len(data), elapsed)
+    with transfer.tracer.span('manifest'):
+        manifest.save(encoded)
+    if progress is not None:
+        progress.finish()
+
+def list_tree(directory):
+    """List the files in a directory tree, sorted by path.
+
+    This is a private function and you shouldn't need to use it.
+
+    @rtype:  list of tuple(str, str, int)
+    @return: Path relative to the directory, using forward slashes, full
+        pathname and size of each file.
+    """
+    files = []
+    for root, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for name in sorted(filenames):
+            filename = os.path.join(root, name)
+            if not os.path.isfile(filename):
+                continue
+            path = os.path.relpath(filename, directory)
+            path = path.replace(os.path.sep, '/')
+            files.append( (path, filename, os.path.getsize(filename)) )
+    return files
+
+def archive_blocks(files, manifest, block_size, count):
+    """Read the files one after the other and split the data in blocks. Each
+    file is added to the manifest once it's been read.
+
+    The files are read straight into a L{transfer.BufferRing}, so the
+    blocks shared by several files don't have to be joined.
+
+    This is a private function and you shouldn't need to use it.
+
+    @type  count: int
+    @param count: Number of buffers in the ring, see L{transfer.in_flight}.
+
+    @rtype:  iterator of buffer
+    @return: Data of each block, valid only until C{count} more blocks are
+        read.
+    """
+    digest   = hashlib.sha1()
+    ring     = transfer.BufferRing(block_size, count)
+    block    = ring.next()
+    buffered = 0
+    pos      = 0
+    for path, filename, size in files:
+        hasher = hashlib.sha1()
+        size   = 0
+        with open(filename, 'rb') as infile:
+            while 1:
+                with transfer.tracer.span('read'):
+                    length = transfer.read_into(infile, block, buffered)
+                if not length:
+                    break
+                size = size + length
+                with transfer.tracer.span('hash'):
+                    data = buffer(block, buffered, length)
+                    hasher.update(data)
+                    digest.update(data)
+                buffered = buffered + length
+                if buffered == block_size:
+                    yield buffer(block, 0, buffered)
+                    pos      = pos + buffered
+                    block    = ring.next()
+                    buffered = 0
+        manifest.add_file(path, pos + buffered - size, size,
+                          hasher.hexdigest())
+    if buffered:
+        yield buffer(block, 0, buffered)
+    manifest.digest = digest.hexdigest()
+
+def download_tree(encoded, directory, deadline = None, progress = None,
+                  settings = None):
+    """Download all the files uploaded with L{upload_tree}.
+
+    The blocks are downloaded in parallel by a pool of L{workers} threads for
+    each service they're stored in, verified against the manifest, and
+    written to the files they belong to.
+
+    @type  encoded: str
+    @param encoded: File that contains the information needed to download the
+        files. It was generated by the L{upload_tree} function.
+
+    @type  directory: str
+    @param directory: Directory where the files will be written. It's created
+        if it doesn't exist.
+
+    @type  deadline: L{shorturl.Deadline} or float
+    @param deadline: Time limit in seconds for the whole download, or C{None}
+        to only apply the per-request L{timeout}.
+
+    @type  progress: L{shorturl.Progress}
+    @param progress: Progress reporter, or C{None}.
+
+    @type  settings: L{Settings}
+    @param settings: Settings of the transfer, or C{None} for the defaults
+        taken from the global variables of this module.
+
+    @raise RuntimeError: An error occured while trying to download the files,
+        or they were corrupt and downloading them again didn't help.
+    @raise shorturl.DeadlineExceeded: The deadline expired.
+    @raise urllib2.HTTPError: A network error occured while accessing the URL
+        shortener service.
+    """
+    if settings is None:
+        settings = Settings()
+    deadline = as_deadline(deadline)
+    manifest = Manifest.load(encoded)
+    if not manifest.tree:
+        raise RuntimeError, "The encoded file doesn't contain a directory tree"
+    if progress is not None:
+        if progress.total is None:
+            progress.total = manifest.size
+        if progress.total_blocks is None:
+            progress.total_blocks = len(manifest.codes)
+        progress.start()
+
+    # Create all the files first, since blocks arrive in any order.
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    offsets   = []
+    filenames = []
+    for path, offset, size, digest in manifest.files:
+        parts = path.split('/')
+        if path.startswith('/') or '..' in parts or '' in parts:
+            raise RuntimeError, "Invalid path in the encoded file: %r" % path
+        filename = os.path.join(directory, *parts)
+        parent   = os.path.dirname(filename)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        with open(filename, 'wb') as outfile:
+            outfile.truncate(size)
+        offsets.append(offset)
+        filenames.append(filename)
+
+    # Write each block to the files it overlaps.
+    backend = open_backend(manifest.all_services(), settings)
+    def fetch(index):
+        began = time.time()
+        with transfer.tracer.span('block', block = index):
+            data = fetch_verified_block(manifest, index, deadline,
+                                        settings = settings,
+                                        backend = backend)
+        return data, time.time() - began
+    count = settings.workers * len(manifest.all_services())
+    for index, result, error in transfer.run_workers(fetch,
+                                    xrange(len(manifest.codes)), count):
+        if error is not None:
+            raise error[0], error[1], error[2]
+        data, elapsed = result
+        start = index * manifest.block_size
+        end   = start + len(data)
+        first = max(bisect.bisect_right(offsets, start) - 1, 0)
+        for number in xrange(first, len(offsets)):
+            path, offset, size, digest = manifest.files[number]
+            if offset >= end:
+                break
+            low  = max(start, offset)
+            high = min(end, offset + size)
+            if low >= high:
+                continue
+            with transfer.tracer.span('write'):
+                with open(filenames[number], 'r+b') as outfile:
+                    outfile.seek(low - offset)
+                    outfile.write(buffer(data, low - start, high - low))
+        if progress is not None:
+            progress.update(len(data), elapsed)
+
+    # Check the hash of every file.
+    for number, (path, offset, size, digest) in enumerate(manifest.files):
+        hasher = hashlib.sha1()
+        with transfer.tracer.span('hash'):
+            with open(filenames[number], 'rb') as infile:
+                for data in transfer.read_buffers(infile,
+                                                  settings.block_size, 1):
+                    hasher.update(data)
+        if hasher.hexdigest() != digest:
+            raise RuntimeError, "The downloaded file doesn't match its SHA-1 hash: %s" % path
+    if progress is not None:
+        progress.finish()
+
+#------------------------------------------------------------------------------
+
+# Erasure coding over GF(256), used for the parity blocks. Each stripe of k
+# data blocks gets m parity blocks computed with a Cauchy matrix, so any k of
+# the k + m blocks are enough to rebuild the data. Multiplying a whole block
+# by a constant is a str.translate() call, and adding blocks is a XOR of
+# long integers, so the heavy lifting is done in C.
+
+gf_exp = [0] * 512
+gf_log = [0] * 256
+value  = 1
+for power in xrange(255):
+    gf_exp[power] = value
+    gf_log[value] = power
+    value = value << 1
+    if value & 0x100:
+        value = value ^ 0x11D
+for power in xrange(255, 512):
+    gf_exp[power] = gf_exp[power - 255]
+del value, power
+
+def gf_mul(a, b):
+    """
+    This is a private function and you shouldn't need to use it.
+
+    @rtype:  int
+    @return: Product of two elements of GF(256).
+    """
+    if a == 0 or b == 0:
+        return 0
+    return gf_exp[ gf_log[a] + gf_log[b] ]
+
+def gf_inv(a):
+    """
+    This is a private function and you shouldn't need to use it.
+
+    @rtype:  int
+    @return: Multiplicative inverse of an element of GF(256).
+    """
+    return gf_exp[ 255 - gf_log[a] ]
+
+# Translation tables to multiply a block by each constant, built on demand.
+gf_tables = dict()
+
+def gf_scale(coefficient, block):
+    """
+    This is a private function and you shouldn't need to use it.
+
+    @rtype:  str
+    @return: Block with every byte multiplied by the coefficient.
+    """
+    table = gf_tables.get(coefficient)
+    if table is None:
+        table = ''.join( chr(gf_mul(coefficient, byte)) for byte in xrange(256) )
+        gf_tables[coefficient] = table
+    return block.translate(table)
+
+def gf_combine(coefficients, blocks, length):
+    """Compute a linear combination of blocks of the same length.
+
+    This is a private function and you shouldn't need to use it.
+
+    @rtype:  str
+    @return: Sum of each block multiplied by its coefficient.
+    """
+    total = 0
+    for coefficient, block in zip(coefficients, blocks):
+        if coefficient == 0:
+            continue
+        if coefficient != 1:
+            block = gf_scale(coefficient, block)
+        total = total ^ int(binascii.hexlify(block) or '0', 16)
+    if length == 0:
+        return ''
+    return binascii.unhexlify('%0*x' % (length * 2, total))
+
+def parity_coefficients(row, count):
+    """
+    This is a private function and you shouldn't need to use it.
+
+    @type  row: int
+    @param row: Index of the parity block in the stripe.
+
+    @type  count: int
+    @param count: Number of data blocks in the stripe.
+
+    @rtype:  list of int
+    @return: Coefficients of the parity block.
+    """
+    return [ gf_inv( (count + row) ^ column ) for column in xrange(count) ]
+
+def gf_invert(matrix):
+    """Invert a square matrix over GF(256) by Gauss-Jordan elimination.
+
+    This is a private function and you shouldn't need to use it.
+
+    @raise ValueError: The matrix is singular.
+    """
+    size   = len(matrix)
+    matrix = [ list(row) + [ int(column == index) for column in xrange(size) ]
+               for index, row in enumerate(matrix) ]
+    for column in xrange(size):
+        pivot = column
+        while pivot < size and matrix[pivot][column] == 0:
+            pivot = pivot + 1
+        if pivot == size:
+            raise ValueError, "Singular matrix"
+        matrix[column], matrix[pivot] = matrix[pivot], matrix[column]
+        factor = gf_inv( matrix[column][column] )
+        matrix[column] = [ gf_mul(factor, value) for value in matrix[column] ]
+        for row in xrange(size):
+            factor = matrix[row][column]
+            if row != column and factor:
+                matrix[row] = [ value ^ gf_mul(factor, pivot_value)
+                                for value, pivot_value
+                                in zip(matrix[row], matrix[column]) ]
+    return [ row[size:] for row in matrix ]
+
+def make_parity(blocks, count):
+    """Compute the parity blocks of a stripe.
+
+    This is a private function and you shouldn't need to use it.
+
+    @type  blocks: list of str
+    @param blocks: Data blocks of the stripe.
+
+    @type  count: int
+    @param count: Number of parity blocks to compute.
+
+    @rtype:  list of str
+    @return: Parity blocks, as long as the longest data block.
+    """
+    length = max( len(block) for block in blocks )
+    padded = [ block.ljust(length, '\0') for block in blocks ]
+    return [ gf_combine(parity_coefficients(row, len(blocks)), padded, length)
+             for row in xrange(count) ]
+
+def rebuild_stripe(received, count, lengths):
+    """Rebuild the data blocks of a stripe from any of its blocks.
+
+    This is a private function and you shouldn't need to use it.
+
+    @type  received: dict(int S{->} str)
+    @param received: At least C{count} blocks of the stripe, by position.
+        Data blocks come first, followed by the parity blocks.
+
+    @type  count: int
+    @param count: Number of data blocks in the stripe.
+
+    @type  lengths: list of int
+    @param lengths: Length of each data block.
+
+    @rtype:  list of str
+    @return: Data blocks.
+    """
+    length = max(lengths)
+    chosen = sorted(received)[:count]
+    blocks = [ received[position].ljust(length, '\0') for position in chosen ]
+    if chosen == range(count):
+        return [ received[position] for position in chosen ]
+    matrix = []
+    for position in chosen:
+        if position < count:
+            matrix.append([ int(column == position) for column in xrange(count) ])
+        else:
+            matrix.append(parity_coefficients(position - count, count))
+    inverse = gf_invert(matrix)
+    data    = []
+    for index in xrange(count):
+        if index in received:
+            data.append(received[index])
+        else:
+            block = gf_combine(inverse[index], blocks, length)
+            data.append(block[ : lengths[index] ])
+    return data
 
 def main(argv):
     """Main function. Uploads and downloads files from the commandline.
@@ -220,18 +1884,95 @@ def main(argv):
     @param argv: Command line arguments.
     """
     global verbose
-    verbose = True
+    verbose  = True
+    progress = None
+    for option in ('--progress', '--progress=line', '--progress=json'):
+        if option in argv:
+            argv = [ arg for arg in argv if arg != option ]
+            progress = Progress(output = option[11:] or 'line')
+            verbose  = False
+    parity   = None
+    services = None
+    profile  = None
+    for option in argv:
+        if option.startswith('--parity='):
+            argv   = [ arg for arg in argv if arg != option ]
+            parity = parse_parity(option[9:])
+            if parity is None:
+                print >> sys.stderr, "%s: error: invalid --parity value: %s" \
+                                     % (argv[0], option[9:])
+                sys.exit(2)
+        elif option == '--stripe':
+            argv     = [ arg for arg in argv if arg != option ]
+            services = carriers
+        elif option.startswith('--stripe='):
+            argv     = [ arg for arg in argv if arg != option ]
+            services = option[9:].split(',')
+        elif option == '--profile' or option.startswith('--profile='):
+            argv     = [ arg for arg in argv if arg != option ]
+            profile  = option[10:]
     if '--help' in argv or '-h' in argv or len(argv) != 4 or argv[1].lower() not in ('upload', 'download'):
         print "TinyURL file uploading and downloading."
         print "by Mario Vilas (mvilas at gmail dot com)"
         print
-        print "%s upload <local file (input)> <encoded file (output)>" % argv[0]
-        print "%s download <encoded file (input)> <downloaded file (output)>" % argv[0]
+        print "%s [--progress[=json]] [--profile[=trace.json]] [--parity=K+M] [--stripe[=service,...]] upload <local file or directory (input)> <encoded file (output)>" % argv[0]
+        print "%s [--progress[=json]] [--profile[=trace.json]] download <encoded file (input)> <downloaded file or directory (output)>" % argv[0]
         return
+
+    # Directory trees have no parity blocks, so don't let the user believe
+    # otherwise. The blocks can still be striped over several services.
+    if parity is not None and argv[1].lower() == 'upload' and \
+                                                    os.path.isdir(argv[2]):
+        print >> sys.stderr, "%s: error: --parity can't be used to upload" \
+                             " a directory" % argv[0]
+        sys.exit(2)
+    if profile is not None:
+        transfer.tracer = transfer.Tracer()
+    try:
+        run(argv, progress, parity, services)
+    finally:
+        if profile is not None:
+            print >> sys.stderr, transfer.tracer.format_summary()
+            if profile:
+                transfer.tracer.save(profile)
+
+def parse_parity(value):
+    """Parse the value of the C{--parity} command line option.
+
+    This is a private function and you shouldn't need to use it.
+
+    @type  value: str
+    @param value: Number of data and parity blocks of each stripe, as C{K+M}.
+
+    @rtype:  tuple(int, int)
+    @return: Number of data and parity blocks, or C{None} if the value is
+        not valid.
+    """
+    try:
+        data, parity = [ int(x) for x in value.split('+') ]
+    except ValueError:
+        return None
+    if data < 1 or parity < 1 or data + parity > 256:
+        return None
+    return data, parity
+
+def run(argv, progress, parity, services):
+    """Run the command given in the command line.
+
+    This is a private function and you shouldn't need to use it.
+    """
     if argv[1].lower() == 'upload':
-        upload(argv[2], argv[3])
+        if os.path.isdir(argv[2]):
+            upload_tree(argv[2], argv[3], progress = progress,
+                        services = services)
+        else:
+            upload(argv[2], argv[3], progress = progress, parity = parity,
+                   services = services)
     else:
-        download(argv[2], argv[3])
+        if Manifest.load(argv[2]).tree:
+            download_tree(argv[2], argv[3], progress = progress)
+        else:
+            download(argv[2], argv[3], progress = progress)
 
 # Run the main() function when invoked from the command line.
 if __name__ == "__main__":
@@ -245,8 +1986,6 @@ if __name__ == "__main__":
 #
 # * A more efficient encoding could be used. Maybe base64?
 #
-# * HTTP requests could be made in parallel to speed things up a bit.
-#
 # * Since the same data will always produce the same short URL we could cache
 #   the results of our queries to avoid sending repeated blocks of data. The
 #   question is how to do it efficiently. This could also be thought of as a
@@ -258,9 +1997,5 @@ if __name__ == "__main__":
 #   * Configurable block size, timeout and verbosity.
 #   * Resume an upload or a download.
 #   * Default value for the output filename.
-#
-# * Measure the speed of the trasfers.
-#
-# * Use the GET method and the Location: header for really small block sizes.
-#
-# * Give a better feedback than just printing URLs, something like a percentage.
+
+
@@ -0,0 +1,1073 @@
+#!/usr/bin/env python
+
+# Block transfer engine for the file stores.
+# Copyright (c) 2009-2012, Mario Vilas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice,this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Block transfer engine for the file stores.
+
+Files are split in blocks, and each block is encoded and stored by a
+L{Backend}, which returns a reference to read it back later. The engine
+takes care of everything else: encoding, sending the blocks in parallel,
+retrying on transient errors, recording the L{shorturl.metrics}, verifying
+the blocks read back and handing them over in the original order. The
+backends only have to know how to put and get a single block.
+
+Some services can't store blocks independently, but only as a chain where
+each block links to the next one (see L{Backend.chained}). Those are
+transferred one block at a time with L{put_chain} and L{get_chain}.
+
+Blocks can also be spread over several services at once with a
+L{StripedBackend}, so the rate limit and latency of a single service don't
+cap the throughput of the whole transfer.
+
+@type tracer: L{Tracer}
+@var  tracer: Records how long each phase of the transfers takes, for every
+    block. Tracing is off by default, set it to a new L{Tracer} to turn it
+    on and export the results when the transfer is done.
+"""
+
+__all__ = ['Backend', 'MemoryBackend', 'StripedBackend', 'put_block',
+           'get_block', 'put_blocks', 'get_blocks', 'put_chain', 'get_chain',
+           'read_buffers', 'in_flight', 'call', 'Tracer', 'tracer']
+
+import os
+import sys
+import time
+import Queue
+import random
+import binascii
+import threading
+
+import shorturl
+from shorturl import as_deadline, metrics, DeadlineExceeded
+
+#------------------------------------------------------------------------------
+
+class Backend(object):
+    """Base class of the storage backends.
+
+    Subclasses implement L{put_block} and L{get_block}, and may override
+    L{encode} and L{decode} if the service can carry something better than
+    hexadecimal text.
+
+    @type name: str
+    @ivar name: Hostname of the service, used in the metrics and messages.
+
+    @type block_size: int
+    @ivar block_size: Size in bytes of each block, before encoding.
+
+    @type workers: int
+    @ivar workers: Maximum number of blocks transferred at the same time.
+
+    @type chained: bool
+    @ivar chained: C{True} if each block links to the next one, so the
+        blocks must be stored from last to first and read from first to
+        last, one at a time. C{False} if the blocks are independent.
+
+    @type verbose: bool
+    @ivar verbose: C{True} to print debug messages.
+
+    @type client: L{shorturl.Client}
+    @ivar client: Client that makes the HTTP requests and whose retry policy
+        is applied to the blocks.
+    """
+
+    name       = None
+    block_size = 65536
+    workers    = 8
+    chained    = False
+    verbose    = False
+
+    def __init__(self, client = None):
+        """
+        @type  client: L{shorturl.Client}
+        @param client: Client used for the requests. Defaults to
+            L{shorturl.default_client}.
+        """
+        if client is None:
+            client = shorturl.default_client
+        self.client = client
+
+    def encode(self, data):
+        """
+        @type  data: str or buffer
+        @param data: Block data.
+
+        @rtype:  str
+        @return: Block data in a form the service can store.
+        """
+        return binascii.hexlify(data)
+
+    def decode(self, text):
+        """
+        @type  text: str or buffer
+        @param text: Block data as returned by L{encode}.
+
+        @rtype:  str
+        @return: Block data.
+        """
+        return binascii.unhexlify(text)
+
+    def put_block(self, text, deadline, stage, link = None):
+        """Store a single block.
+
+        @type  text: str
+        @param text: Encoded block data.
+
+        @type  deadline: L{shorturl.Deadline}
+        @param deadline: Time limit for the request.
+
+        @type  stage: str
+        @param stage: Description of the step of the transfer, for timeout
+            errors.
+
+        @param link: Only for chained backends, reference of the next
+            block, or C{None} for the last one.
+
+        @return: Reference to read the block back. Any value will do, as
+            long as L{get_block} understands it.
+        """
+        raise NotImplementedError
+
+    def get_block(self, reference, deadline, stage):
+        """Read a single block.
+
+        @param reference: Reference returned by L{put_block}.
+
+        @type  deadline: L{shorturl.Deadline}
+        @param deadline: Time limit for the request.
+
+        @type  stage: str
+        @param stage: Description of the step of the transfer, for timeout
+            errors.
+
+        @rtype:  str or tuple(str, object)
+        @return: Encoded block data. Chained backends also return the
+            reference of the next block, or C{None} after the last one.
+        """
+        raise NotImplementedError
+
+class MemoryBackend(Backend):
+    """Backend that keeps the blocks in memory.
+
+    It's meant for testing and for measuring how much time the engine
+    itself spends on each block, without any network time in the way.
+
+    It's safe to share this object between threads.
+
+    @type latency: float
+    @ivar latency: Delay in seconds added to each request, to emulate a
+        network service.
+
+    @type blocks: dict( str S{->} str )
+    @ivar blocks: Encoded data of each block, by reference.
+    """
+
+    name = 'memory'
+
+    def __init__(self, block_size = 65536, workers = 8, latency = 0.0,
+                 client = None):
+        Backend.__init__(self, client)
+        self.block_size = block_size
+        self.workers    = workers
+        self.latency    = latency
+        self.blocks     = dict()
+        self._lock      = threading.Lock()
+
+    def put_block(self, text, deadline, stage, link = None):
+        if self.latency:
+            deadline.sleep(self.latency, stage)
+        with self._lock:
+            reference = '%x' % len(self.blocks)
+            self.blocks[reference] = text
+        return reference
+
+    def get_block(self, reference, deadline, stage):
+        if self.latency:
+            deadline.sleep(self.latency, stage)
+        with self._lock:
+            try:
+                return self.blocks[reference]
+            except KeyError:
+                raise RuntimeError, "Unknown block: %s" % reference
+
+class StripedBackend(Backend):
+    """Backend that spreads the blocks over several other backends.
+
+    Each block goes to one of the backends, picked at random and weighted by
+    the throughput observed so far, so faster services get more blocks and
+    the ones that fail or are throttled by their rate limit get fewer.
+    Backends that haven't stored anything yet are weighted like the fastest
+    one so they get a chance. Services whose circuit is open in the health
+    registry of the client are skipped.
+
+    The reference of each block is a tuple with the name of the backend and
+    the reference returned by it, so blocks can be read back from any number
+    of services in parallel.
+
+    It's safe to share this object between threads.
+
+    @type backends: list of L{Backend}
+    @ivar backends: Backends to spread the blocks over. They must not be
+        chained, and must use the same encoding.
+
+    @type alpha: float
+    @ivar alpha: Smoothing factor of the throughput averages.
+    """
+
+    def __init__(self, backends, alpha = 0.3, client = None):
+        """
+        @type  backends: list of L{Backend}
+        @param backends: Backends to spread the blocks over.
+
+        @type  alpha: float
+        @param alpha: Smoothing factor of the throughput averages. Higher
+            values react faster to changes.
+
+        @type  client: L{shorturl.Client}
+        @param client: Client whose health registry and retry policy are
+            used. Defaults to L{shorturl.default_client}.
+        """
+        if not backends:
+            raise ValueError, "No backends to stripe the blocks over"
+        Backend.__init__(self, client)
+        self.backends   = list(backends)
+        self.alpha      = alpha
+        self.name       = '+'.join( backend.name for backend in self.backends )
+        self.block_size = min( backend.block_size for backend in self.backends )
+        self.workers    = sum( backend.workers for backend in self.backends )
+        self.verbose    = any( backend.verbose for backend in self.backends )
+        self._by_name   = dict( (backend.name, backend)
+                                for backend in self.backends )
+        self._rates     = dict()
+        self._busy      = dict( (backend.name, 0) for backend in self.backends )
+        self._blocks    = dict( (backend.name, 0) for backend in self.backends )
+        self._lock      = threading.Lock()
+
+    def encode(self, data):
+        return self.backends[0].encode(data)
+
+    def decode(self, text):
+        return self.backends[0].decode(text)
+
+    def choose(self):
+        """Pick the backend for the next block.
+
+        This is a private method and you shouldn't need to use it.
+
+        @rtype:  L{Backend}
+        @return: Backend chosen. It's counted as busy until L{release} is
+            called.
+        """
+        names = self.client.health.rank( [ backend.name
+                                           for backend in self.backends ] )
+        with self._lock:
+            candidates = [ backend for backend in self.backends
+                           if backend.name in names and
+                              self._busy[backend.name] < backend.workers ]
+            if not candidates:
+                candidates = [ backend for backend in self.backends
+                               if self._busy[backend.name] < backend.workers ]
+            if not candidates:
+                candidates = self.backends
+            known   = [ self._rates[backend.name] for backend in candidates
+                        if backend.name in self._rates ]
+            default = max(known or [1.0])
+            weights = [ self._rates.get(backend.name, default)
+                        for backend in candidates ]
+            point   = random.uniform(0.0, sum(weights))
+            for backend, weight in zip(candidates, weights):
+                point = point - weight
+                if point <= 0.0:
+                    break
+            self._busy[backend.name] = self._busy[backend.name] + 1
+        return backend
+
+    def release(self, backend, size = None, elapsed = None):
+        """Update the throughput of a backend after storing a block.
+
+        This is a private method and you shouldn't need to use it.
+
+        @type  backend: L{Backend}
+        @param backend: Backend returned by L{choose}.
+
+        @type  size: int
+        @param size: Size in bytes of the block stored, or C{None} if it
+            failed.
+
+        @type  elapsed: float
+        @param elapsed: Time in seconds spent storing the block.
+        """
+        with self._lock:
+            self._busy[backend.name] = self._busy[backend.name] - 1
+            rate = self._rates.get(backend.name)
+            if size is None:
+                if rate is not None:
+                    self._rates[backend.name] = rate / 2.0
+                return
+            self._blocks[backend.name] = self._blocks[backend.name] + 1
+            sample = size / max(elapsed, 0.001)
+            if rate is None:
+                self._rates[backend.name] = sample
+            else:
+                self._rates[backend.name] = (self.alpha * sample) + \
+                                            ((1.0 - self.alpha) * rate)
+
+    def put_block(self, text, deadline, stage, link = None):
+        backend = self.choose()
+        began   = time.time()
+        try:
+            reference = backend.put_block(text, deadline, stage, link)
+        except DeadlineExceeded:
+            self.release(backend)
+            raise
+        except Exception, e:
+            elapsed = time.time() - began
+            self.release(backend)
+            self.client.health.record_failure(backend.name, e, elapsed)
+            raise
+        elapsed = time.time() - began
+        self.release(backend, len(text), elapsed)
+        self.client.health.record_success(backend.name, elapsed)
+        return backend.name, reference
+
+    def get_block(self, reference, deadline, stage):
+        name, reference = reference
+        try:
+            backend = self._by_name[name]
+        except KeyError:
+            raise RuntimeError, "Unknown service: %s" % name
+        return backend.get_block(reference, deadline, stage)
+
+    def stats(self):
+        """
+        @rtype:  dict( str S{->} dict( str S{->} object ) )
+        @return: Number of blocks stored and throughput in bytes per second
+            observed for each backend, by name. The throughput is C{None}
+            until a block is stored.
+        """
+        with self._lock:
+            return dict( (backend.name, {
+                            'blocks':     self._blocks[backend.name],
+                            'throughput': self._rates.get(backend.name),
+                         }) for backend in self.backends )
+
+#------------------------------------------------------------------------------
+
+class Tracer(object):
+    """Records spans of time spent in each phase of the transfers, like
+    reading the file, encoding, HTTP requests or writing, to find out where
+    the time goes.
+
+    Spans can be nested, and the time of each one not spent in the spans
+    inside it is its self time. The spans can be exported in the Chrome
+    trace event format, to see them in a timeline with C{chrome://tracing},
+    or summarized by phase.
+
+    It's safe to share this object between threads.
+
+    Example::
+        transfer.tracer = transfer.Tracer()
+        tinyurlfs.upload('photo.jpg', 'photo.txt')
+        print transfer.tracer.format_summary()
+        transfer.tracer.save('photo.trace.json')
+
+    @type spans: list of tuple(str, dict, float, float, float, int)
+    @ivar spans: Name, arguments, start time, duration, self time and thread
+        of each span, in the order they finished.
+
+    @type started: float
+    @ivar started: Time the tracer was created.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.spans    = list()
+        self.started  = time.time()
+        self._threads = dict()
+        self._lock    = threading.Lock()
+        self._local   = threading.local()
+
+    def span(self, name, **args):
+        """Measure a block of code.
+
+        Example::
+            with tracer.span('compress', size = len(data)):
+                data = zlib.compress(data)
+
+        @type  name: str
+        @param name: Name of the phase.
+
+        @param args: Details to attach to the span, like the block number.
+
+        @rtype:  context manager
+        @return: Span that starts on entering the C{with} block and ends on
+            leaving it.
+        """
+        return Span(self, name, args)
+
+    def record(self, name, args, start, duration, own):
+        """Add a finished span.
+
+        This is a private method and you shouldn't need to use it.
+        """
+        thread = threading.current_thread()
+        with self._lock:
+            self.spans.append( (name, args, start, duration, own,
+                                thread.ident) )
+            self._threads[thread.ident] = thread.name
+
+    def to_chrome(self):
+        """
+        @rtype:  dict
+        @return: Spans in the Chrome trace event format, ready to be
+            serialized as JSON.
+        """
+        pid    = os.getpid()
+        events = list()
+        with self._lock:
+            for ident, thread in sorted(self._threads.items()):
+                events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                    'tid': ident, 'args': {'name': thread},
+                })
+            for name, args, start, duration, own, ident in self.spans:
+                events.append({
+                    'name': name, 'cat': 'transfer', 'ph': 'X', 'pid': pid,
+                    'tid': ident, 'args': args,
+                    'ts':  int((start - self.started) * 1000000),
+                    'dur': int(duration * 1000000),
+                })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, filename):
+        """Write the spans to a file in the Chrome trace event format.
+
+        @type  filename: str
+        @param filename: Output file name.
+        """
+        import json
+        with open(filename, 'w') as fd:
+            json.dump(self.to_chrome(), fd)
+
+    def summary(self):
+        """
+        @rtype:  dict( str S{->} dict( str S{->} float ) )
+        @return: Number of spans (C{count}), total time (C{total}), self time
+            (C{self}) and longest span (C{max}) of each phase, by name.
+            Times are in seconds, added up over all the threads, so they may
+            be longer than the transfer itself.
+        """
+        phases = dict()
+        with self._lock:
+            for name, args, start, duration, own, ident in self.spans:
+                phase = phases.get(name)
+                if phase is None:
+                    phase = phases[name] = {
+                        'count': 0, 'total': 0.0, 'self': 0.0, 'max': 0.0,
+                    }
+                phase['count'] = phase['count'] + 1
+                phase['total'] = phase['total'] + duration
+                phase['self']  = phase['self']  + own
+                phase['max']   = max(phase['max'], duration)
+        return phases
+
+    def format_summary(self):
+        """
+        @rtype:  str
+        @return: Table with the L{summary} of each phase, sorted by self
+            time, with the share of the self time of all the phases.
+        """
+        phases = self.summary()
+        spent  = sum( phase['self'] for phase in phases.itervalues() ) or 1.0
+        lines  = [ '%-12s %8s %10s %10s %6s %10s' % ('PHASE', 'COUNT', 'TOTAL',
+                                                      'SELF', '%SELF', 'MAX') ]
+        for name, phase in sorted(phases.items(),
+                                  key = lambda (name, phase): -phase['self']):
+            lines.append( '%-12s %8d %10.3f %10.3f %5.1f%% %10.3f' % (
+                          name, phase['count'], phase['total'], phase['self'],
+                          100.0 * phase['self'] / spent, phase['max']) )
+        lines.append( 'Wall time: %.3f seconds' % (time.time() - self.started) )
+        return '\n'.join(lines)
+
+class Span(object):
+    """A span of time measured by a L{Tracer}.
+
+    This is a private class and you shouldn't need to use it.
+    """
+
+    __slots__ = ('tracer', 'name', 'args', 'start', 'inner')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name   = name
+        self.args   = args
+        self.inner  = 0.0
+
+    def __enter__(self):
+        local = self.tracer._local
+        stack = getattr(local, 'stack', None)
+        if stack is None:
+            stack = local.stack = list()
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.time() - self.start
+        stack    = self.tracer._local.stack
+        stack.pop()
+        if stack:
+            stack[-1].inner = stack[-1].inner + duration
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.record(self.name, self.args, self.start, duration,
+                           duration - self.inner)
+        return False
+
+class NullTracer(object):
+    """Tracer that records nothing, used while tracing is off.
+
+    This is a private class and you shouldn't need to use it.
+    """
+
+    enabled = False
+
+    def span(self, name, **args):
+        return null_span
+
+class NullSpan(object):
+    """Span that measures nothing.
+
+    This is a private class and you shouldn't need to use it.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+null_span = NullSpan()
+
+# Tracing is off until a real tracer is set here.
+tracer = NullTracer()
+
+#------------------------------------------------------------------------------
+
+def call(backend, operation, function, deadline = None,
+         stage = 'sending a request', size = None):
+    """Call a function that sends a request to the service of a backend,
+    retrying on transient errors and recording the metrics of each try.
+
+    @type  backend: L{Backend}
+    @param backend: Backend of the service.
+
+    @type  operation: str
+    @param operation: Type of operation, used in the metrics.
+
+    @type  function: callable
+    @param function: Function to call, without arguments.
+
+    @type  deadline: L{shorturl.Deadline} or float
+    @param deadline: Time limit for all the tries, or C{None}.
+
+    @type  stage: str
+    @param stage: Description of the call, used in timeout errors.
+
+    @type  size: int or callable
+    @param size: Payload bytes moved by the call, or a function that takes
+        the return value and tells how many. C{None} if it doesn't matter.
+
+    @return: Value returned by the function.
+    """
+    deadline = as_deadline(deadline)
+    def attempt():
+        began = time.time()
+        try:
+            with tracer.span(operation, service = backend.name):
+                result = function()
+        except Exception, e:
+            metrics.request(backend.name, operation, time.time() - began, e)
+            raise
+        moved = size
+        if callable(moved):
+            moved = moved(result)
+        metrics.request(backend.name, operation, time.time() - began,
+                        size = moved)
+        return result
+    return backend.client.retries.call(attempt, deadline, stage, backend.name,
+                                       operation, backend.verbose)
+
+def put_block(backend, data, deadline = None, stage = 'uploading a block',
+              link = None):
+    """Encode and store a single block.
+
+    @type  backend: L{Backend}
+    @param backend: Where to store the block.
+
+    @type  data: str
+    @param data: Block data.
+
+    @type  deadline: L{shorturl.Deadline} or float
+    @param deadline: Time limit for all the tries, or C{None}.
+
+    @type  stage: str
+    @param stage: Description of the step of the transfer, for timeout errors.
+
+    @param link: Only for chained backends, reference of the next block.
+
+    @return: Reference to read the block back.
+    """
+    deadline = as_deadline(deadline)
+    with tracer.span('encode'):
+        text = backend.encode(data)
+    return call(backend, 'upload',
+                lambda: backend.put_block(text, deadline, stage, link),
+                deadline, stage, len(data))
+
+def get_block(backend, reference, deadline = None,
+              stage = 'downloading a block', verify = None):
+    """Read and decode a single block, reading it again if it's corrupt.
+
+    @type  backend: L{Backend}
+    @param backend: Where the block is stored.
+
+    @param reference: Reference returned by L{put_block}.
+
+    @type  deadline: L{shorturl.Deadline} or float
+    @param deadline: Time limit for all the tries, or C{None}.
+
+    @type  stage: str
+    @param stage: Description of the step of the transfer, for timeout errors.
+
+    @type  verify: callable
+    @param verify: Function that takes the block data and returns C{False}
+        if it's corrupt, or C{None} to skip the check.
+
+    @rtype:  str or tuple(str, object)
+    @return: Block data. Chained backends also return the reference of the
+        next block.
+
+    @raise RuntimeError: The block is still corrupt after the C{max_tries}
+        of the retry policy.
+    """
+    deadline = as_deadline(deadline)
+    def fetch():
+        result = backend.get_block(reference, deadline, stage)
+        with tracer.span('decode'):
+            if backend.chained:
+                return backend.decode(result[0]), result[1]
+            return backend.decode(result), None
+    tries = 0
+    while 1:
+        tries = tries + 1
+        data, link = call(backend, 'download', fetch, deadline, stage,
+                          lambda (data, link): len(data))
+        if verify is None:
+            break
+        with tracer.span('verify'):
+            valid = verify(data)
+        if valid:
+            break
+        metrics.increment('corrupt_blocks_total', service = backend.name)
+        if tries >= backend.client.retries.max_tries:
+            raise RuntimeError, "Corrupt block (%s)" % stage
+        if backend.verbose:
+            print "Corrupt block, reading it again (%s)" % stage
+    if backend.chained:
+        return data, link
+    return data
+
+def put_blocks(backend, blocks, deadline = None):
+    """Store many blocks at the same time.
+
+    Blocks are taken from the iterator only as the workers become free, so
+    large files don't have to fit in memory. No more than L{in_flight}
+    blocks are in use at the same time, so they can be read with
+    L{read_buffers} instead of allocating a string for each one.
+
+    @type  backend: L{Backend}
+    @param backend: Where to store the blocks. Must not be chained.
+
+    @type  blocks: iterator of str or buffer
+    @param blocks: Data of each block.
+
+    @type  deadline: L{shorturl.Deadline} or float
+    @param deadline: Time limit for the whole transfer, or C{None}.
+
+    @rtype:  iterator of tuple(str, object, float)
+    @return: Data, reference and time spent on each block, in the same order
+        as the blocks.
+    """
+    deadline = as_deadline(deadline)
+    def store((index, data)):
+        began = time.time()
+        stage = "uploading block %d to %s" % (index + 1, backend.name)
+        with tracer.span('block', block = index):
+            reference = put_block(backend, data, deadline, stage)
+        return reference, time.time() - began
+    for (index, data), result, error in run_ordered(store, enumerate(blocks),
+                                                    backend.workers):
+        if error is not None:
+            raise error[0], error[1], error[2]
+        yield data, result[0], result[1]
+
+def get_blocks(backend, references, deadline = None, verify = None):
+    """Read many blocks at the same time.
+
+    @type  backend: L{Backend}
+    @param backend: Where the blocks are stored. Must not be chained.
+
+    @type  references: iterator
+    @param references: Reference of each block.
+
+    @type  deadline: L{shorturl.Deadline} or float
+    @param deadline: Time limit for the whole transfer, or C{None}.
+
+    @type  verify: callable
+    @param verify: Function that takes the index and data of a block and
+        returns C{False} if it's corrupt, or C{None} to skip the check.
+        Corrupt blocks are read again.
+
+    @rtype:  iterator of tuple(str, float)
+    @return: Data and time spent on each block, in the same order as the
+        references.
+    """
+    deadline = as_deadline(deadline)
+    def fetch((index, reference)):
+        began = time.time()
+        stage = "downloading block %d from %s" % (index + 1, backend.name)
+        check = None
+        if verify is not None:
+            check = lambda data: verify(index, data)
+        with tracer.span('block', block = index):
+            data = get_block(backend, reference, deadline, stage, check)
+        return data, time.time() - began
+    for item, result, error in run_ordered(fetch, enumerate(references),
+                                           backend.workers):
+        if error is not None:
+            raise error[0], error[1], error[2]
+        yield result
+
+def put_chain(backend, blocks, deadline = None, link = None):
+    """Store the blocks of a chained backend, from last to first.
+
+    @type  backend: L{Backend}
+    @param backend: Where to store the blocks. Must be chained.
+
+    @type  blocks: list of str
+    @param blocks: Data of each block.
+
+    @type  deadline: L{shorturl.Deadline} or float
+    @param deadline: Time limit for the whole transfer, or C{None}.
+
+    @param link: Reference the last block links to, or C{None}.
+
+    @rtype:  iterator of tuple(str, object, float)
+    @return: Data, reference and time spent on each block, from last to
+        first. The reference of the first block is the start of the chain.
+    """
+    deadline = as_deadline(deadline)
+    total    = len(blocks)
+    for index in xrange(total - 1, -1, -1):
+        began = time.time()
+        stage = "uploading block %d of %d to %s" % (total - index, total,
+                                                    backend.name)
+        with tracer.span('block', block = index):
+            link = put_block(backend, blocks[index], deadline, stage, link)
+        yield blocks[index], link, time.time() - began
+
+def get_chain(backend, reference, deadline = None):
+    """Read the blocks of a chained backend, from first to last.
+
+    The chain ends after a block that links nowhere, or when it loops back
+    to a block that was already read.
+
+    @type  backend: L{Backend}
+    @param backend: Where the blocks are stored. Must be chained.
+
+    @param reference: Reference of the first block.
+
+    @type  deadline: L{shorturl.Deadline} or float
+    @param deadline: Time limit for the whole transfer, or C{None}.
+
+    @rtype:  iterator of tuple(object, str, float)
+    @return: Reference, data and time spent on each block.
+    """
+    deadline = as_deadline(deadline)
+    visited  = set()
+    while reference is not None and reference not in visited:
+        visited.add(reference)
+        began = time.time()
+        stage = "downloading block %d from %s" % (len(visited), backend.name)
+        with tracer.span('block', block = len(visited) - 1):
+            data, link = get_block(backend, reference, deadline, stage)
+        yield reference, data, time.time() - began
+        reference = link
+
+def in_flight(backend):
+    """
+    @type  backend: L{Backend}
+    @param backend: Where the blocks are being stored.
+
+    @rtype:  int
+    @return: Maximum number of blocks L{put_blocks} can have in use at the
+        same time, counting the one being handed back to the caller. A
+        L{BufferRing} this size is enough to read the blocks into.
+    """
+    return backend.workers * 2 + 1
+
+class BufferRing(object):
+    """Fixed size buffers to read blocks into, reused in turn.
+
+    Reading a file into a ring of buffers instead of calling C{read()}
+    doesn't allocate a new string for each block. Each buffer is handed out
+    again after C{count} others, so the caller must be done with a block by
+    then (see L{in_flight}). Buffers are only allocated when first needed.
+
+    This is a private class and you shouldn't need to use it.
+    """
+
+    def __init__(self, size, count):
+        """
+        @type  size: int
+        @param size: Size of each buffer in bytes.
+
+        @type  count: int
+        @param count: Number of buffers in the ring.
+        """
+        self.size    = size
+        self.count   = count
+        self.buffers = []
+        self.index   = 0
+
+    def next(self):
+        """
+        @rtype:  bytearray
+        @return: Next buffer in the ring. Its previous contents are
+            overwritten by the caller.
+        """
+        if len(self.buffers) < self.count:
+            self.buffers.append( bytearray(self.size) )
+            return self.buffers[-1]
+        block      = self.buffers[self.index]
+        self.index = (self.index + 1) % self.count
+        return block
+
+def read_into(infile, block, offset = 0):
+    """Fill a buffer from a file, until it's full or the file ends.
+
+    This is a private function and you shouldn't need to use it.
+
+    @type  infile: file
+    @param infile: File to read from. Must support C{readinto}.
+
+    @type  block: bytearray
+    @param block: Buffer to fill.
+
+    @type  offset: int
+    @param offset: Position in the buffer to start writing at.
+
+    @rtype:  int
+    @return: Number of bytes read. Shorter than the rest of the buffer only
+        at the end of file.
+    """
+    view   = memoryview(block)
+    filled = offset
+    while filled < len(block):
+        count = infile.readinto(view[filled:])
+        if not count:
+            break
+        filled = filled + count
+    return filled - offset
+
+def read_buffers(infile, size, count):
+    """Read a file in blocks into a L{BufferRing}.
+
+    @type  infile: file
+    @param infile: File to read from. Must support C{readinto}.
+
+    @type  size: int
+    @param size: Block size in bytes.
+
+    @type  count: int
+    @param count: Number of buffers in the ring. Use L{in_flight} when the
+        blocks are passed to L{put_blocks}.
+
+    @rtype:  iterator of buffer
+    @return: Read only view of the data of each block, valid only until
+        C{count} more blocks are read. It can be hashed, encoded and written
+        like a string, but it must be copied with C{str()} to keep it.
+    """
+    ring = BufferRing(size, count)
+    while 1:
+        block  = ring.next()
+        length = read_into(infile, block)
+        if not length:
+            break
+        yield buffer(block, 0, length)
+
+#------------------------------------------------------------------------------
+
+def run_workers(function, items, count = 8):
+    """Call a function for each item in a pool of threads.
+
+    Items are taken from the iterator only as workers become free, so at
+    most twice as many as there are workers are in memory at once.
+
+    This is a private function and you shouldn't need to use it.
+
+    @type  count: int
+    @param count: Number of worker threads.
+
+    @rtype:  iterator of tuple(object, object, tuple)
+    @return: Item, return value and exception info (C{None} on success),
+        in the order the calls finish.
+    """
+    tasks   = Queue.Queue()
+    results = Queue.Queue()
+    def work():
+        while 1:
+            item = tasks.get()
+            if item is None:
+                return
+            try:
+                results.put( (item, function(item), None) )
+            except:
+                results.put( (item, None, sys.exc_info()) )
+    threads = []
+    for number in xrange(count):
+        thread = threading.Thread(target = work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    try:
+        pending = 0
+        for item in items:
+            tasks.put(item)
+            pending = pending + 1
+            while pending >= count * 2:
+                yield results.get()
+                pending = pending - 1
+        while pending:
+            yield results.get()
+            pending = pending - 1
+
+        # All the workers are idle by now, wait for them to go away.
+        for thread in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+        threads = []
+    finally:
+
+        # Drop the tasks that weren't started if we're stopping early.
+        try:
+            while 1:
+                tasks.get_nowait()
+        except Queue.Empty:
+            pass
+        for thread in threads:
+            tasks.put(None)
+
+def run_ordered(function, items, count = 8):
+    """Call a function for each item in a pool of threads, and return the
+    results in the same order as the items.
+
+    At most twice as many items as there are workers are in flight or
+    waiting for a slower one before them, so a single slow call stalls the
+    pipeline instead of letting the results pile up in memory.
+
+    This is a private function and you shouldn't need to use it.
+
+    @type  count: int
+    @param count: Number of worker threads.
+
+    @rtype:  iterator of tuple(object, object, tuple)
+    @return: Item, return value and exception info (C{None} on success).
+    """
+    tasks   = Queue.Queue()
+    results = Queue.Queue()
+    def work():
+        while 1:
+            task = tasks.get()
+            if task is None:
+                return
+            index, item = task
+            try:
+                results.put( (index, (item, function(item), None)) )
+            except:
+                results.put( (index, (item, None, sys.exc_info())) )
+    threads = []
+    for number in xrange(count):
+        thread = threading.Thread(target = work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    try:
+        items     = enumerate(items)
+        finished  = dict()
+        submitted = 0
+        returned  = 0
+        exhausted = False
+        while 1:
+            while not exhausted and submitted - returned < count * 2:
+                try:
+                    tasks.put( items.next() )
+                except StopIteration:
+                    exhausted = True
+                    break
+                submitted = submitted + 1
+            if returned == submitted:
+                break
+            while returned not in finished:
+                index, result = results.get()
+                finished[index] = result
+            yield finished.pop(returned)
+            returned = returned + 1
+
+        # All the workers are idle by now, wait for them to go away.
+        for thread in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+        threads = []
+    finally:
+
+        # Drop the tasks that weren't started if we're stopping early.
+        try:
+            while 1:
+                tasks.get_nowait()
+        except Queue.Empty:
+            pass
+        for thread in threads:
+            tasks.put(None)